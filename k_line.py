@@ -1,76 +1,302 @@
 import requests
 import json
+import os
+import time
+import unittest
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from datetime import datetime, timedelta
 
+# (bar, series) names of each Alpha Vantage series, for labels
+SERIES_NAMES = {
+    'TIME_SERIES_MONTHLY': ('month', 'Monthly'),
+    'TIME_SERIES_MONTHLY_ADJUSTED': ('month', 'Monthly'),
+    'TIME_SERIES_WEEKLY': ('week', 'Weekly'),
+    'TIME_SERIES_WEEKLY_ADJUSTED': ('week', 'Weekly'),
+    'TIME_SERIES_DAILY': ('day', 'Daily'),
+    'TIME_SERIES_DAILY_ADJUSTED': ('day', 'Daily'),
+}
+OHLCV_FIELDS = {'open': '1. open', 'high': '2. high', 'low': '3. low', 'close': '4. close'}
+COLUMNS = ['dates', 'open', 'high', 'low', 'close', 'volume']
+# Alpha Vantage quotes prices to at most 4 decimals
+PRICE_SCALE = 10 ** 4
+
 class KLine:
-    def __init__(self, symbol, api_key, function='TIME_SERIES_MONTHLY', years_to_display=20, significant_change_threshold=0.05):
+    def __init__(self, symbol, api_key, function='TIME_SERIES_MONTHLY', years_to_display=20, significant_change_threshold=0.05,
+                 interval='5min'):
         self.symbol = symbol
         self.api_key = api_key
         self.function = function
+        self.interval = interval
+        self.is_intraday = function == 'TIME_SERIES_INTRADAY'
+        self.bar_name, self.series_name = ((interval, f'{interval} Intraday') if self.is_intraday
+                                           else SERIES_NAMES.get(function, ('bar', '')))
         self.years_to_display = years_to_display
         self.url = f'https://www.alphavantage.co/query?function={self.function}&symbol={self.symbol}&apikey={self.api_key}'
+        if function in ('TIME_SERIES_DAILY', 'TIME_SERIES_DAILY_ADJUSTED') or self.is_intraday:
+            # The default compact output stops at the latest 100 bars
+            self.url += '&outputsize=full'
+        if self.is_intraday:
+            self.url += f'&interval={interval}'
+        self.store_dir = f'kline_{self.function}_{self.symbol}' + (f'_{interval}' if self.is_intraday else '')
         self.data = None
-        self.filtered_dates = []
-        self.filtered_prices = []
+        self.columns = None
+        self.filtered_dates = np.array([], dtype='datetime64[s]')
+        self.filtered_prices = np.array([], dtype=np.float64)
+        # Index of the first displayed bar in the stored columns
+        self.window_start = 0
         self.best_short_period = 5
         self.best_long_period = 20
         self.max_crossovers = 0
         self.significant_change_threshold = significant_change_threshold
         self.inflection_points = []
 
-    def fetch_data(self):
+    def fetch_data(self, update=False):
+        """
+        Downloads the series into the store; returns the number of bars it gained.
+
+        With update and a store on disk, daily and intraday series request only the
+        compact output, which is the latest 100 bars. Those bars replace the stored
+        bars from their first date on, so a revised last bar is corrected too.
+        Monthly and weekly payloads are small and merge the same way. If the recent
+        bars do not reach back to the stored ones, bars would be missing, so the
+        full output is fetched and merged the same way. The full intraday output
+        covers only about a month, so older stored bars are kept rather than lost.
+        """
+        if update and os.path.exists(os.path.join(self.store_dir, 'close.npy')):
+            stored = self.load_store()
+            self.data = requests.get(self.url.replace('&outputsize=full', '&outputsize=compact')).json()
+            recent = self.parse_time_series(self.data)
+            if not (len(recent['dates']) and len(stored['dates']) and recent['dates'][0] <= stored['dates'][-1]):
+                self.data = requests.get(self.url).json()
+                recent = self.parse_time_series(self.data)
+            self.columns = self.merge_columns(stored, recent)
+            self.save_store()
+            return len(self.columns['dates']) - len(stored['dates'])
         r = requests.get(self.url)
         self.data = r.json()
-        self.save_json()
+        self.columns = self.parse_time_series(self.data)
+        self.save_store()
+        return len(self.columns['dates'])
 
-    def save_json(self):
-        filename = f'kline_{self.function}_{self.symbol}.json'
-        with open(filename, 'w') as f:
-            json.dump(self.data, f, indent=4)
+    @staticmethod
+    def merge_columns(stored, recent):
+        """Stored bars older than the first recent bar, followed by all the recent bars."""
+        if not len(recent['dates']):
+            return {column: np.asarray(stored[column]) for column in COLUMNS}
+        keep = int(np.searchsorted(stored['dates'], recent['dates'][0]))
+        return {column: np.concatenate([stored[column][:keep], recent[column]]) for column in COLUMNS}
+
+    @staticmethod
+    def parse_time_series(data):
+        """
+        Columns of any Alpha Vantage time series payload, oldest bar first.
+
+        Monthly, weekly, daily and intraday payloads differ only in the series key,
+        so the key is found rather than assumed. Dates become datetime64[s] and
+        prices float64. Adjusted series keep their raw close and volume.
+        """
+        series_keys = [key for key in data if 'Time Series' in key]
+        if not series_keys:
+            message = data.get('Error Message') or data.get('Note') or data.get('Information') or 'no time series'
+            raise ValueError(f"Alpha Vantage returned no time series: {message}")
+        time_series = data[series_keys[0]]
+        dates = np.array(list(time_series.keys()), dtype='datetime64[s]')
+        bars = list(time_series.values())
+        columns = {'dates': dates}
+        for column, field in OHLCV_FIELDS.items():
+            columns[column] = np.fromiter((bar[field] for bar in bars), dtype=np.float64, count=len(bars))
+        volume_field = '6. volume' if bars and '6. volume' in bars[0] else '5. volume'
+        columns['volume'] = np.fromiter((bar.get(volume_field, 0) for bar in bars), dtype=np.float64, count=len(bars))
+        order = np.argsort(dates, kind='stable')
+        return {column: values[order] for column, values in columns.items()}
+
+    def save_store(self):
+        """Writes one .npy file per column, each replaced atomically, so loads can memory-map them."""
+        os.makedirs(self.store_dir, exist_ok=True)
+        for column in COLUMNS:
+            path = os.path.join(self.store_dir, f'{column}.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(self.columns[column]))
+            os.replace(path + '.tmp', path)
+
+    def load_store(self):
+        """Memory-maps the stored columns; only the pages analysis touches are read."""
+        self.columns = {column: np.load(os.path.join(self.store_dir, f'{column}.npy'), mmap_mode='r')
+                        for column in COLUMNS}
+        return self.columns
 
     def process_data(self):
-        time_series = self.data.get('Monthly Time Series', {})
-        dates = []
-        prices = []
-        for date, values in time_series.items():
-            dates.append(datetime.strptime(date, '%Y-%m-%d'))
-            prices.append(float(values['4. close']))
-        dates.reverse()
-        prices.reverse()
-
-        cutoff_date = datetime.now() - timedelta(days=self.years_to_display * 365)
-        self.filtered_dates = [date for date in dates if date > cutoff_date]
-        self.filtered_prices = prices[-len(self.filtered_dates):]
+        if self.columns is None:
+            self.load_store()
+        dates = self.columns['dates']
+        cutoff_date = np.datetime64(datetime.now() - timedelta(days=self.years_to_display * 365), 's')
+        start = int(np.searchsorted(dates, cutoff_date, side='right'))
+        self.window_start = start
+        self.filtered_dates = np.asarray(dates[start:])
+        self.filtered_prices = np.asarray(self.columns['close'][start:], dtype=np.float64)
 
     @staticmethod
     def calculate_ma(data, period):
-        return np.convolve(data, np.ones(period)/period, mode='valid')
+        # Same arithmetic as moving_averages, so plotted crossovers match the sweep's counts exactly
+        return KLine.moving_averages(data, [period])[0, period - 1:]
 
     @staticmethod
     def find_crossovers(short_ma, long_ma):
         return np.where(np.diff(np.sign(short_ma - long_ma)))[0]
 
-    def find_best_ma_periods(self):
-        for short_test in range(3, 30):
-            for long_test in range(short_test + 1, 50):
-                short_ma = self.calculate_ma(self.filtered_prices, short_test)
-                long_ma = self.calculate_ma(self.filtered_prices, long_test)
-                
-                min_length = min(len(short_ma), len(long_ma))
-                short_ma = short_ma[-min_length:]
-                long_ma = long_ma[-min_length:]
-                
-                crossovers = self.find_crossovers(short_ma, long_ma)
-                
-                if len(crossovers) > self.max_crossovers:
-                    self.max_crossovers = len(crossovers)
-                    self.best_short_period = short_test
-                    self.best_long_period = long_test
+    @staticmethod
+    def price_ticks(prices):
+        """Prices as int64 multiples of 1/PRICE_SCALE; None if any is off that grid or their sum exceeds float precision."""
+        scaled = np.asarray(prices, dtype=np.float64) * PRICE_SCALE
+        ticks = np.round(scaled)
+        if not np.all(np.abs(scaled - ticks) <= 1e-6) or np.abs(ticks).sum() >= 2 ** 53:
+            return None
+        return ticks.astype(np.int64)
+
+    @staticmethod
+    def moving_averages(prices, periods):
+        """
+        Simple moving averages for several periods from one cumulative sum.
+
+        Row r holds the periods[r]-bar average ending at each bar, NaN where fewer
+        than periods[r] bars are available, so every row is aligned to the series.
+        Quoted prices are summed as whole ticks, which is exact, and each average is
+        a single correctly rounded division. Averages that are equal as fractions
+        are therefore equal as floats, so ties stay ties however long the series.
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        ticks = KLine.price_ticks(prices)
+        if ticks is not None:
+            sums, scale = np.concatenate([[0], np.cumsum(ticks)]), PRICE_SCALE
+        else:
+            sums, scale = np.concatenate([[0.0], np.cumsum(prices)]), 1
+        averages = np.full((len(periods), len(prices)), np.nan)
+        for row, period in enumerate(periods):
+            if period <= len(prices):
+                averages[row, period - 1:] = (sums[period:] - sums[:-period]) / (period * scale)
+        return averages
+
+    @staticmethod
+    def sweep_ma_crossovers(prices, short_periods=range(3, 30), long_periods=range(4, 50), max_cells=2 ** 23,
+                            first_bar=1):
+        """
+        Crossover counts for every (short, long) moving-average pair, long > short.
+
+        Returns a len(short_periods) x len(long_periods) array, -1 for pairs that do
+        not apply. Each pair is compared over the bars where its long average exists,
+        counting sign changes of short - long the way find_crossovers does. The
+        averages are computed once; pairs are compared by broadcasting, a block of
+        short periods at a time so that no block exceeds max_cells values.
+
+        With first_bar, only changes into bars first_bar onwards are counted and only
+        those bars are compared. The averages still come from the whole series, so
+        their values match a full sweep exactly.
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        short_periods = np.asarray(short_periods)
+        long_periods = np.asarray(long_periods)
+        counts = np.full((len(short_periods), len(long_periods)), -1, dtype=np.int64)
+        if len(prices) < 2 or not len(short_periods) or not len(long_periods):
+            return counts
+        first_bar = max(first_bar, 1)
+        short_ma = KLine.moving_averages(prices, short_periods)[:, first_bar - 1:]
+        long_ma = KLine.moving_averages(prices, long_periods)[:, first_bar - 1:]
+        # A change between bars t-1 and t counts once the long average exists at t-1
+        counted = np.arange(first_bar, len(prices))[None, :] >= long_periods[:, None]
+        applies = (long_periods[None, :] > short_periods[:, None]) & (long_periods[None, :] <= len(prices))
+
+        block = max(1, max_cells // (len(long_periods) * max(short_ma.shape[1], 1)))
+        for start in range(0, len(short_periods), block):
+            difference = short_ma[start:start + block, None, :] - long_ma[None, :, :]
+            signs = np.sign(difference)
+            changes = (signs[:, :, 1:] != signs[:, :, :-1]) & counted[None, :, :]
+            counts[start:start + block] = np.where(applies[start:start + block], changes.sum(axis=2), -1)
+        return counts
+
+    def find_best_ma_periods(self, short_periods=range(3, 30), long_periods=range(4, 50)):
+        counts = self.sweep_ma_crossovers(self.filtered_prices, short_periods, long_periods)
+        self.choose_best_periods(counts, short_periods, long_periods)
+
+    def choose_best_periods(self, counts, short_periods, long_periods):
+        """Picks the pair with the most crossovers; ties go to the smallest short, then long, period."""
+        if counts.size == 0:
+            return
+        best = np.unravel_index(np.argmax(counts), counts.shape)
+        if counts[best] > self.max_crossovers:
+            self.max_crossovers = int(counts[best])
+            self.best_short_period = int(short_periods[best[0]])
+            self.best_long_period = int(long_periods[best[1]])
 
     @staticmethod
     def find_significant_inflections(prices, window=3, threshold=0.10, min_distance=2):
+        """
+        Indexes of local extrema that are min_distance apart and moved at least threshold from the last one kept.
+
+        Vectorized form of find_significant_inflections_loop, with identical results.
+        A sliding-window view over the prices finds, in one pass, every bar that is
+        strictly above (below) both neighbours and at least as high (low) as the
+        window bars on each side. Only those candidates go through the serial filter.
+        The filter compares each candidate with the last point kept, so it cannot be
+        vectorized. It uses Python floats, so the threshold arithmetic is the same
+        as in the loop.
+        """
+        values = np.asarray(prices, dtype=np.float64)
+        return KLine.filter_inflections(values, KLine.find_extrema(values, window), threshold, min_distance)
+
+    @staticmethod
+    def find_extrema(values, window=3):
+        """Indexes of the bars that pass the local maximum or minimum test of find_significant_inflections."""
+        count = len(values)
+        if count < 2 * window + 1:
+            return []
+        windows = sliding_window_view(values, 2 * window + 1)
+        center = values[window:count - window]
+        before = values[window - 1:count - window - 1]
+        after = values[window + 1:count - window + 1]
+        # The neighbour test rules out most bars; window extrema are only taken for the rest
+        peaks = np.flatnonzero((center > before) & (center > after))
+        peaks = peaks[(center[peaks] >= windows[peaks, :window].max(axis=1))
+                      & (center[peaks] >= windows[peaks, window + 1:].max(axis=1))]
+        troughs = np.flatnonzero((center < before) & (center < after))
+        troughs = troughs[(center[troughs] <= windows[troughs, :window].min(axis=1))
+                          & (center[troughs] <= windows[troughs, window + 1:].min(axis=1))]
+        return (np.sort(np.concatenate([peaks, troughs])) + window).tolist()
+
+    @staticmethod
+    def filter_inflections(values, potential_points, threshold=0.10, min_distance=2, kept=None):
+        """The serial filter of find_significant_inflections, continuing after the points already kept."""
+        candidate_prices = values[potential_points].tolist()
+        inflection_points = list(kept or [])
+        last_price = float(values[inflection_points[-1]]) if inflection_points else None
+        for point, price in zip(potential_points, candidate_prices):
+            if not inflection_points or (point - inflection_points[-1] >= min_distance):
+                if not inflection_points or abs((price - last_price) / last_price) >= threshold:
+                    inflection_points.append(point)
+                    last_price = price
+        return inflection_points
+
+    @staticmethod
+    def update_significant_inflections(prices, previous_points, first_changed, window=3, threshold=0.10,
+                                       min_distance=2):
+        """
+        find_significant_inflections for prices that changed from index first_changed on, given the earlier result.
+
+        Whether a bar is an extremum depends only on the window bars on each side of
+        it, and the filter only looks back. So the points before first_changed -
+        window stand, and the search resumes from there.
+        """
+        values = np.asarray(prices, dtype=np.float64)
+        resume = max(first_changed - window, 0)
+        kept = [int(point) for point in previous_points if point < resume]
+        start = max(resume - window, 0)
+        candidates = [point + start for point in KLine.find_extrema(values[start:], window) if point + start >= resume]
+        return KLine.filter_inflections(values, candidates, threshold, min_distance, kept)
+
+    @staticmethod
+    def find_significant_inflections_loop(prices, window=3, threshold=0.10, min_distance=2):
+        """Reference implementation of find_significant_inflections, one bar at a time."""
         inflection_points = []
         
         def is_significant_change(current_idx, last_idx):
@@ -106,8 +332,71 @@ class KLine:
         
         return inflection_points
 
+    def analyze(self, short_periods=range(3, 30), long_periods=range(4, 50), window=3, min_distance=2):
+        """
+        Best moving-average pair and significant inflections of the stored prices, recomputing only the changed tail.
+
+        Both are computed over the whole stored series, not the display window,
+        whose start moves forward every day; the window only limits which
+        inflection points are kept for plotting and reporting. The crossover counts
+        and inflection indexes are saved to the store together with the prices they
+        came from. When the store starts on the same bar and the settings are
+        unchanged, the next call finds the first bar that differs, whether appended
+        or revised. It recounts crossovers only from that bar and resumes the
+        inflection search window bars before it. Results are identical to a full run.
+        """
+        if self.columns is None:
+            self.load_store()
+        dates = self.columns['dates']
+        prices = np.asarray(self.columns['close'], dtype=np.float64)
+        if not len(prices):
+            return
+        short_periods, long_periods = np.asarray(short_periods), np.asarray(long_periods)
+        settings = {'short_periods': short_periods, 'long_periods': long_periods, 'window': window,
+                    'threshold': self.significant_change_threshold, 'min_distance': min_distance}
+        state = self.load_analysis()
+        if (state is not None and state['start'] == dates[0]
+                and all(np.array_equal(state[key], value) for key, value in settings.items())
+                and min(len(state['prices']), len(prices)) >= long_periods.max(initial=0)
+                and (self.price_ticks(state['prices']) is None) == (self.price_ticks(prices) is None)):
+            previous = state['prices']
+            common = min(len(previous), len(prices))
+            changed = np.flatnonzero(previous[:common] != prices[:common])
+            first_changed = int(changed[0]) if changed.size else common
+            counts = (state['counts']
+                      + self.sweep_ma_crossovers(prices, short_periods, long_periods, first_bar=first_changed)
+                      - self.sweep_ma_crossovers(previous, short_periods, long_periods, first_bar=first_changed))
+            inflection_points = self.update_significant_inflections(
+                prices, state['inflections'].tolist(), first_changed, window, self.significant_change_threshold,
+                min_distance)
+        else:
+            counts = self.sweep_ma_crossovers(prices, short_periods, long_periods)
+            inflection_points = self.find_significant_inflections(prices, window, self.significant_change_threshold,
+                                                                  min_distance)
+        self.max_crossovers = 0
+        self.choose_best_periods(counts, short_periods, long_periods)
+        # Indexes into the filtered prices, as plot and save_inflection_points expect
+        self.inflection_points = [point - self.window_start for point in inflection_points
+                                  if point >= self.window_start]
+        self.save_analysis(start=dates[0], prices=prices, counts=counts,
+                           inflections=np.array(inflection_points, dtype=np.int64), **settings)
+
+    def save_analysis(self, **state):
+        os.makedirs(self.store_dir, exist_ok=True)
+        path = os.path.join(self.store_dir, 'analysis.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **state)
+        os.replace(path + '.tmp', path)
+
+    def load_analysis(self):
+        path = os.path.join(self.store_dir, 'analysis.npz')
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as state:
+            return {key: state[key] for key in state.files}
+
     def plot(self):
-        self.find_best_ma_periods()
+        self.analyze()
         short_ma = self.calculate_ma(self.filtered_prices, self.best_short_period)
         long_ma = self.calculate_ma(self.filtered_prices, self.best_long_period)
 
@@ -120,8 +409,8 @@ class KLine:
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 12))
 
         ax1.plot(self.filtered_dates, self.filtered_prices, label='Price', alpha=0.5)
-        ax1.plot(ma_dates, short_ma, label=f'{self.best_short_period}-month MA')
-        ax1.plot(ma_dates, long_ma, label=f'{self.best_long_period}-month MA')
+        ax1.plot(ma_dates, short_ma, label=f'{self.best_short_period}-{self.bar_name} MA')
+        ax1.plot(ma_dates, long_ma, label=f'{self.best_long_period}-{self.bar_name} MA')
 
         crossovers = self.find_crossovers(short_ma, long_ma)
         for idx in crossovers:
@@ -129,25 +418,19 @@ class KLine:
             ax1.plot(ma_dates[idx], crossover_price, 'ro', markersize=10, 
                      label='Crossover' if idx == crossovers[0] else "")
 
-        ax1.set_title(f'{self.symbol} Monthly Stock Prices with Dynamic Moving Averages (Last {self.years_to_display} Years)')
+        ax1.set_title(f'{self.symbol} {self.series_name} Stock Prices with Dynamic Moving Averages (Last {self.years_to_display} Years)')
         ax1.set_xlabel('Date')
         ax1.set_ylabel('Price (USD)')
         ax1.grid(True)
         ax1.legend()
 
-        window_size = 3
-
-        self.inflection_points = self.find_significant_inflections(self.filtered_prices, 
-                                                              window=window_size,
-                                                              threshold=self.significant_change_threshold)
-
         ax2.plot(self.filtered_dates, self.filtered_prices, label='Price', alpha=0.8)
 
         for idx in self.inflection_points:
             ax2.plot(self.filtered_dates[idx], self.filtered_prices[idx], 'go', markersize=10,
                      label='Inflection Point' if idx == self.inflection_points[0] else "")
 
-        ax2.set_title(f'{self.symbol} Monthly Stock Prices with Inflection Points (>{self.significant_change_threshold*100}% change)')
+        ax2.set_title(f'{self.symbol} {self.series_name} Stock Prices with Inflection Points (>{self.significant_change_threshold*100}% change)')
         ax2.set_xlabel('Date')
         ax2.set_ylabel('Price (USD)')
         ax2.grid(True)
@@ -166,8 +449,8 @@ class KLine:
     def save_inflection_points(self):
         inflection_data = [
             {
-                "date": self.filtered_dates[idx].strftime('%Y-%m-%d'),
-                "price": self.filtered_prices[idx],
+                "date": np.datetime_as_string(self.filtered_dates[idx], unit='m' if self.is_intraday else 'D'),
+                "price": float(self.filtered_prices[idx]),
                 "index": idx
             } for idx in self.inflection_points
         ]
@@ -177,8 +460,300 @@ class KLine:
             json.dump(inflection_data, f, indent=4)
         print(f"Inflection points saved to {filename}")
 
+def refresh_symbols(symbols, api_key, function='TIME_SERIES_DAILY', **options):
+    """
+    Brings the stored series of many symbols up to date; returns the bars gained per symbol.
+
+    Each symbol costs one compact request, then analyze recomputes its changed tail
+    and the inflection points file is rewritten.
+    """
+    added = {}
+    for symbol in symbols:
+        kline = KLine(symbol, api_key, function=function, **options)
+        try:
+            added[symbol] = kline.fetch_data(update=True)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Could not update {symbol}: {e}")
+            continue
+        kline.process_data()
+        kline.analyze()
+        kline.save_inflection_points()
+    return added
+
+class TestMovingAverageSweep(unittest.TestCase):
+    """The sweep must count what the old per-pair loop counted, with ties on rounded prices kept as ties."""
+
+    def series(self, seed, length):
+        rng = np.random.default_rng(seed)
+        return np.round(50 * np.exp(np.cumsum(rng.normal(0, 0.03, length))), 2)
+
+    @staticmethod
+    def loop_counts(prices, short_periods, long_periods):
+        counts = np.full((len(short_periods), len(long_periods)), -1, dtype=np.int64)
+        for i, short_test in enumerate(short_periods):
+            for j, long_test in enumerate(long_periods):
+                if long_test > short_test and long_test <= len(prices):
+                    short_ma = np.convolve(prices, np.ones(short_test) / short_test, mode='valid')
+                    long_ma = np.convolve(prices, np.ones(long_test) / long_test, mode='valid')
+                    min_length = min(len(short_ma), len(long_ma))
+                    counts[i, j] = len(KLine.find_crossovers(short_ma[-min_length:], long_ma[-min_length:]))
+        return counts
+
+    @staticmethod
+    def exact_counts(prices, short_periods, long_periods):
+        # Window sums in whole cents, compared by cross-multiplying, so no rounding at all
+        sums = np.concatenate([[0], np.cumsum(np.round(prices * 100).astype(np.int64))])
+        counts = np.full((len(short_periods), len(long_periods)), -1, dtype=np.int64)
+        for i, short_test in enumerate(short_periods):
+            for j, long_test in enumerate(long_periods):
+                if long_test > short_test and long_test <= len(prices):
+                    short_sums = (sums[short_test:] - sums[:-short_test])[long_test - short_test:]
+                    long_sums = sums[long_test:] - sums[:-long_test]
+                    signs = np.sign(short_sums * long_test - long_sums * short_test)
+                    counts[i, j] = np.count_nonzero(np.diff(signs))
+        return counts
+
+    def test_matches_loop_on_monthly_series(self):
+        # The loop's convolved averages are off by a rounding error here and there, so a few of its
+        # cells differ from exact arithmetic; the pair it chose and its count are what must match
+        short_periods, long_periods = range(3, 30), range(4, 50)
+        for seed in range(40):
+            with self.subTest(seed=seed):
+                prices = self.series(seed, 240)
+                self.assertTrue(np.array_equal(KLine.sweep_ma_crossovers(prices),
+                                               self.exact_counts(prices, short_periods, long_periods)))
+                expected = self.loop_counts(prices, short_periods, long_periods)
+                kline = KLine('OXY', 'key')
+                kline.filtered_prices = prices
+                kline.find_best_ma_periods()
+                best = np.unravel_index(np.argmax(expected), expected.shape)
+                self.assertEqual((kline.best_short_period, kline.best_long_period, kline.max_crossovers),
+                                 (short_periods[best[0]], long_periods[best[1]], int(expected[best])))
+
+    def test_ties_stay_ties_on_daily_series(self):
+        # Over thousands of bars the old loop's float averages drift apart; exact sums do not
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                prices = self.series(seed, 5000)
+                self.assertTrue(np.array_equal(KLine.sweep_ma_crossovers(prices),
+                                               self.exact_counts(prices, range(3, 30), range(4, 50))))
+
+    def test_off_grid_prices_fall_back_to_floats(self):
+        prices = self.series(0, 240) + 1e-7
+        self.assertIsNone(KLine.price_ticks(prices))
+        averages = KLine.moving_averages(prices, [3])[0, 2:]
+        self.assertTrue(np.allclose(averages, np.convolve(prices, np.ones(3) / 3, mode='valid')))
+
+class TestFindSignificantInflections(unittest.TestCase):
+    """The vectorized inflection search must match the loop exactly, and be faster on long series."""
+
+    def series(self, seed, length, rounded):
+        rng = np.random.default_rng(seed)
+        prices = 50 * np.exp(np.cumsum(rng.normal(0, 0.03, length)))
+        # Rounded prices produce plateaus and ties at window edges
+        return [round(float(p), 0 if rounded else 2) for p in prices]
+
+    def test_matches_loop(self):
+        cases = [(seed, length, rounded, window, threshold, min_distance)
+                 for seed, length in enumerate([0, 1, 5, 7, 50, 240, 1000])
+                 for rounded in (False, True)
+                 for window, threshold, min_distance in [(1, 0.0, 1), (3, 0.05, 2), (3, 0.10, 2), (5, 0.2, 4),
+                                                         (12, 0.05, 1)]]
+        for seed, length, rounded, window, threshold, min_distance in cases:
+            prices = self.series(seed, length, rounded)
+            with self.subTest(length=length, rounded=rounded, window=window, threshold=threshold):
+                self.assertEqual(KLine.find_significant_inflections(prices, window, threshold, min_distance),
+                                 KLine.find_significant_inflections_loop(prices, window, threshold, min_distance))
+
+    def test_accepts_arrays(self):
+        prices = self.series(3, 300, False)
+        self.assertEqual(KLine.find_significant_inflections(np.array(prices)),
+                         KLine.find_significant_inflections_loop(prices))
+
+    def test_faster_on_daily_series(self):
+        prices = self.series(7, 20000, False)
+
+        def best_time(function):
+            timings = []
+            for _ in range(3):
+                started = time.perf_counter()
+                result = function(prices, window=10, threshold=0.05)
+                timings.append(time.perf_counter() - started)
+            return min(timings), result
+
+        loop_time, expected = best_time(KLine.find_significant_inflections_loop)
+        vectorized_time, result = best_time(KLine.find_significant_inflections)
+        self.assertEqual(result, expected)
+        self.assertLess(vectorized_time * 3, loop_time)
+
+class TestColumnarStore(unittest.TestCase):
+    """Payloads of every series shape parse into sorted columns that survive a store round trip."""
+
+    def payload(self, series_key, timestamps, volume_field='5. volume'):
+        return {'Meta Data': {}, series_key: {
+            timestamp: {'1. open': '10.0', '2. high': '12.0', '3. low': '9.5', '4. close': str(10 + i),
+                        volume_field: str(1000 * i)}
+            for i, timestamp in reversed(list(enumerate(timestamps)))
+        }}
+
+    def test_round_trip(self):
+        import tempfile
+        cases = [
+            ('TIME_SERIES_MONTHLY', 'Monthly Time Series', ['2024-01-31', '2024-02-29', '2024-03-28'], '5. volume'),
+            ('TIME_SERIES_DAILY_ADJUSTED', 'Time Series (Daily)', ['2024-03-26', '2024-03-27', '2024-03-28'],
+             '6. volume'),
+            ('TIME_SERIES_INTRADAY', 'Time Series (5min)',
+             ['2024-03-28 15:50:00', '2024-03-28 15:55:00', '2024-03-28 16:00:00'], '5. volume'),
+        ]
+        with tempfile.TemporaryDirectory() as workdir:
+            for function, series_key, timestamps, volume_field in cases:
+                with self.subTest(function=function):
+                    kline = KLine('OXY', 'key', function=function, years_to_display=100)
+                    kline.store_dir = os.path.join(workdir, kline.store_dir)
+                    kline.columns = kline.parse_time_series(self.payload(series_key, timestamps, volume_field))
+                    kline.save_store()
+
+                    stored = KLine('OXY', 'key', function=function, years_to_display=100)
+                    stored.store_dir = kline.store_dir
+                    stored.process_data()
+                    self.assertIsInstance(stored.columns['close'], np.memmap)
+                    self.assertEqual(stored.filtered_dates.tolist(),
+                                     np.array(timestamps, dtype='datetime64[s]').tolist())
+                    self.assertEqual(stored.filtered_prices.tolist(), [10.0, 11.0, 12.0])
+                    self.assertEqual(stored.columns['volume'].tolist(), [0.0, 1000.0, 2000.0])
+
+    def test_window_matches_baseline_cutoff(self):
+        from unittest import mock
+        # Monthly bars fall on the last trading day, so near month end the cutoff lands between them
+        timestamps = ['2024-01-31', '2024-02-29', '2024-03-28', '2024-04-30', '2025-02-28', '2025-03-28']
+        kline = KLine('OXY', 'key', years_to_display=1)
+        kline.columns = kline.parse_time_series(self.payload('Monthly Time Series', timestamps))
+        for now in (datetime(2025, 3, 29, 9, 30), datetime(2025, 3, 31, 16, 0), datetime(2025, 4, 30, 0, 0)):
+            with self.subTest(now=now), mock.patch(f'{__name__}.datetime', wraps=datetime) as patched:
+                patched.now.return_value = now
+                kline.process_data()
+                cutoff = now - timedelta(days=365)
+                expected = [d for d in timestamps if datetime.strptime(d, '%Y-%m-%d') > cutoff]
+                self.assertEqual([str(d)[:10] for d in kline.filtered_dates.astype('datetime64[D]')], expected)
+
+    def test_error_payload(self):
+        with self.assertRaises(ValueError):
+            KLine.parse_time_series({'Note': 'Thank you for using Alpha Vantage! Our standard API rate limit is 25 requests per day.'})
+
+class TestIncrementalUpdate(unittest.TestCase):
+    """Updating the store and the analysis from the changed tail must give the same results as starting over."""
+
+    def prices(self, seed, length):
+        rng = np.random.default_rng(seed)
+        return np.round(50 * np.exp(np.cumsum(rng.normal(0, 0.03, length))), 1)
+
+    def test_tail_recomputation_matches_full(self):
+        for seed in range(20):
+            old = self.prices(seed, 600)
+            new = np.concatenate([old[:-3], self.prices(seed + 100, 10)])
+            for first_changed in (597, 600):
+                if first_changed == 600:
+                    new = np.concatenate([old, self.prices(seed + 100, 10)])
+                with self.subTest(seed=seed, first_changed=first_changed):
+                    previous = KLine.find_significant_inflections(old, 3, 0.05)
+                    self.assertEqual(KLine.update_significant_inflections(new, previous, first_changed, 3, 0.05),
+                                     KLine.find_significant_inflections(new, 3, 0.05))
+                    counts = (KLine.sweep_ma_crossovers(old) + KLine.sweep_ma_crossovers(new, first_bar=first_changed)
+                              - KLine.sweep_ma_crossovers(old, first_bar=first_changed))
+                    self.assertTrue(np.array_equal(counts, KLine.sweep_ma_crossovers(new)))
+
+    def test_update_fetches_compact_window(self):
+        import tempfile
+        from unittest import mock
+        dates = np.arange(np.datetime64('2020-01-01'), np.datetime64('2020-01-01') + 700)
+        prices = self.prices(7, 700)
+
+        def payload(start, stop, revise_last=False):
+            series = {str(dates[i]): {'1. open': '1', '2. high': '1', '3. low': '1', '4. close': str(prices[i]),
+                                      '5. volume': '100'} for i in range(start, stop)}
+            if revise_last:
+                series[str(dates[stop - 1])]['4. close'] = str(prices[stop - 1] + 1)
+            return mock.Mock(json=mock.Mock(return_value={'Time Series (Daily)': series}))
+
+        with tempfile.TemporaryDirectory() as workdir:
+            kline = KLine('OXY', 'key', function='TIME_SERIES_DAILY', years_to_display=100)
+            kline.store_dir = os.path.join(workdir, kline.store_dir)
+            with mock.patch('requests.get', return_value=payload(0, 650, revise_last=True)):
+                self.assertEqual(kline.fetch_data(), 650)
+            kline.process_data()
+            kline.analyze()
+
+            # The compact window overlaps the store and revises its last bar
+            with mock.patch('requests.get', return_value=payload(600, 700)) as get:
+                updated = KLine('OXY', 'key', function='TIME_SERIES_DAILY', years_to_display=100)
+                updated.store_dir = kline.store_dir
+                self.assertEqual(updated.fetch_data(update=True), 50)
+            self.assertIn('outputsize=compact', get.call_args[0][0])
+            updated.process_data()
+            self.assertEqual(updated.filtered_prices.tolist(), prices.tolist())
+            with mock.patch.object(KLine, 'find_significant_inflections', side_effect=AssertionError):
+                updated.analyze()
+
+            full = KLine('OXY', 'key', function='TIME_SERIES_DAILY', years_to_display=100)
+            full.filtered_dates, full.filtered_prices = updated.filtered_dates, updated.filtered_prices
+            full.find_best_ma_periods()
+            self.assertEqual(updated.inflection_points,
+                             KLine.find_significant_inflections(prices, 3, full.significant_change_threshold))
+            self.assertEqual((updated.best_short_period, updated.best_long_period, updated.max_crossovers),
+                             (full.best_short_period, full.best_long_period, full.max_crossovers))
+
+            # A gap past the compact window falls back to the full output, merged like the compact one;
+            # stored bars older than the full output (a month, for intraday) must survive
+            with mock.patch('requests.get', return_value=payload(0, 500)):
+                updated.fetch_data()
+            with mock.patch('requests.get', side_effect=[payload(600, 700), payload(300, 700)]) as get:
+                self.assertEqual(updated.fetch_data(update=True), 200)
+            self.assertIn('outputsize=full', get.call_args[0][0])
+            updated.load_store()
+            self.assertEqual(updated.columns['dates'].tolist(), dates.astype('datetime64[s]').tolist())
+            self.assertEqual(updated.columns['close'].tolist(), prices.tolist())
+
+    def test_default_window_reuses_analysis_across_days(self):
+        import tempfile
+        from unittest import mock
+        # More than the default 20 years of daily bars, so the window start moves with the clock
+        dates = np.arange(np.datetime64('2000-01-03'), np.datetime64('2026-10-20')).astype('datetime64[s]')
+        prices = self.prices(11, len(dates))
+        with tempfile.TemporaryDirectory() as workdir:
+            kline = KLine('OXY', 'key', function='TIME_SERIES_DAILY')
+            kline.store_dir = os.path.join(workdir, kline.store_dir)
+            kline.columns = {'dates': dates[:-1], 'close': prices[:-1]}
+            kline.columns.update({column: np.zeros(len(dates) - 1) for column in ('open', 'high', 'low', 'volume')})
+            kline.save_store()
+            with mock.patch(f'{__name__}.datetime', wraps=datetime) as patched:
+                patched.now.return_value = datetime(2026, 10, 18, 18, 0)
+                kline.process_data()
+                kline.analyze()
+
+                kline.columns = {column: np.concatenate([values, values[-1:]]) for column, values in kline.columns.items()}
+                kline.columns['dates'][-1], kline.columns['close'][-1] = dates[-1], prices[-1]
+                kline.save_store()
+                updated = KLine('OXY', 'key', function='TIME_SERIES_DAILY')
+                updated.store_dir = kline.store_dir
+                patched.now.return_value = datetime(2026, 10, 19, 18, 0)
+                updated.process_data()
+                self.assertEqual(updated.window_start, kline.window_start + 1)
+                with mock.patch.object(KLine, 'find_significant_inflections', side_effect=AssertionError):
+                    updated.analyze()
+
+                os.remove(os.path.join(updated.store_dir, 'analysis.npz'))
+                full = KLine('OXY', 'key', function='TIME_SERIES_DAILY')
+                full.store_dir = updated.store_dir
+                full.process_data()
+                full.analyze()
+        self.assertEqual(updated.inflection_points, full.inflection_points)
+        self.assertTrue(all(0 <= point < len(updated.filtered_prices) for point in updated.inflection_points))
+        self.assertEqual((updated.best_short_period, updated.best_long_period, updated.max_crossovers),
+                         (full.best_short_period, full.best_long_period, full.max_crossovers))
+
 # Usage example:
-kline = KLine('OXY', 'AYTLT9XYXR8L9OSZ')
-kline.fetch_data()
-kline.process_data()
-kline.plot()
\ No newline at end of file
+if __name__ == "__main__":
+    kline = KLine('OXY', 'AYTLT9XYXR8L9OSZ')
+    kline.fetch_data()
+    kline.process_data()
+    kline.plot()
\ No newline at end of file
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from news_extraction_engine import article_id, extract_articles, is_skipped
+from news_clustering import propagate_results
+
+class ExtractionLedger:
+    """
+    Append-only JSON Lines ledger of per-article extraction outcomes.
+
+    Every success, skip and failure is written and fsynced as soon as it is produced, so
+    a crash or Ctrl-C loses at most the calls in flight. With resume=True the
+    existing ledger is kept and completed_ids() tells the caller what to skip.
+    Otherwise any previous ledger is moved aside rather than overwritten.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        # Byte length of the complete entries; a torn tail past it is cut off before appending
+        end = 0
+        if os.path.exists(path):
+            if resume:
+                end = self._load()
+                logging.info(f"Resuming from {path}: {len(self.completed_ids())} articles already completed")
+            else:
+                backup = f"{path}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
+                os.replace(path, backup)
+                logging.info(f"Moved previous ledger to {backup}")
+        self.file = open(path, 'a', encoding='utf-8')
+        self.file.truncate(end)
+
+    def _load(self):
+        """Reads the complete entries and returns the byte offset just past the last one."""
+        end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('unterminated entry')
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash mid-write can leave a torn final line; everything before it is intact
+                    logging.warning(f"Dropping torn ledger entry at byte {end} of {self.path}")
+                    break
+                self.entries[entry['article_id']] = entry
+                end += len(line)
+        return end
+
+    def _append(self, entry):
+        entry['recorded_at'] = time.time()
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[entry['article_id']] = entry
+
+    def record_success(self, article_id, result, article_index=None):
+        self._append({'article_id': article_id, 'article_index': article_index,
+                      'status': 'success', 'result': result})
+
+    def record_failure(self, article_id, failure, article_index=None):
+        self._append({'article_id': article_id, 'article_index': article_index,
+                      'status': 'failure', 'failure': failure})
+
+    def record_skip(self, article_id, skip, article_index=None):
+        self._append({'article_id': article_id, 'article_index': article_index,
+                      'status': 'skipped', 'result': skip})
+
+    def completed_ids(self):
+        """Articles with a successful or skipped result; failures are retried on resume."""
+        return {entry_id for entry_id, entry in self.entries.items() if entry['status'] in ('success', 'skipped')}
+
+    def close(self):
+        self.file.close()
+
+def extract_articles_with_ledger(backend_name, articles, ledger, clusterer=None, **engine_options):
+    """
+    Runs extract_articles on the articles the ledger has not completed yet.
+
+    Each outcome is recorded in the ledger the moment it arrives. Returns one result
+    per article, in article order, drawn from the ledger so that results from
+    earlier interrupted runs are included. With a clusterer only one representative
+    per near-duplicate story is extracted and its result is copied to the others.
+    """
+    if clusterer is not None:
+        representatives, clusters = clusterer.representatives(articles)
+        results = extract_articles_with_ledger(backend_name, representatives, ledger, **engine_options)
+        return propagate_results(articles, clusters, results)
+
+    ids = [article_id(article) for article in articles]
+    completed = ledger.completed_ids()
+    pending = [i for i, current_id in enumerate(ids) if current_id not in completed]
+    if len(pending) < len(articles):
+        logging.info(f"Skipping {len(articles) - len(pending)} articles completed in a previous run")
+
+    def on_result(position, article, result):
+        i = pending[position]
+        if 'error' in result:
+            ledger.record_failure(ids[i], result, i)
+        elif is_skipped(result):
+            ledger.record_skip(ids[i], result, i)
+        else:
+            ledger.record_success(ids[i], result, i)
+
+    extract_articles(backend_name, [articles[i] for i in pending], on_result=on_result, **engine_options)
+
+    results = []
+    for current_id in ids:
+        entry = ledger.entries.get(current_id)
+        if entry is None:
+            results.append({"error": "Article was not processed"})
+        elif entry['status'] in ('success', 'skipped'):
+            results.append(entry['result'])
+        else:
+            results.append(entry['failure'])
+    return results
+
+def add_checkpoint_arguments(parser, default_ledger):
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the ledger, skipping articles that already succeeded')
+    parser.add_argument('--ledger', default=default_ledger, help='Path of the append-only results ledger')
+    return parser
+
+class TestExtractionLedger(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, 'ledger.jsonl')
+        self.articles = [{'url': f'https://example.com/{i}', 'content': f'Article {i}'} for i in range(3)]
+        self.extracted = []
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def stand_in_extract(self, backend_name, articles, on_result=None, **engine_options):
+        # Article 0 is turned away by the relevance filter, article 1 fails, article 2 succeeds
+        for position, article in enumerate(articles):
+            self.extracted.append(article['url'])
+            if article['url'].endswith('/0'):
+                result = {"status": "skipped", "reason": "Skipped as irrelevant", "relevance": 0.05}
+            elif article['url'].endswith('/1'):
+                result = {"error": "Max retries reached"}
+            else:
+                result = {"id": article['url']}
+            on_result(position, article, result)
+
+    def run_ledger(self, resume):
+        ledger = ExtractionLedger(self.path, resume=resume)
+        try:
+            with patch(f'{__name__}.extract_articles', self.stand_in_extract):
+                return extract_articles_with_ledger('claude', self.articles, ledger)
+        finally:
+            ledger.close()
+
+    def test_skips_are_completed_and_failures_retried(self):
+        results = self.run_ledger(resume=False)
+        self.assertTrue(is_skipped(results[0]))
+        self.assertEqual(results[1], {"error": "Max retries reached"})
+        self.assertEqual(results[2], {"id": 'https://example.com/2'})
+
+        self.extracted.clear()
+        resumed = self.run_ledger(resume=True)
+        self.assertEqual(self.extracted, ['https://example.com/1'])
+        self.assertEqual(resumed, results)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            statuses = [json.loads(line)['status'] for line in f]
+        self.assertEqual(statuses, ['skipped', 'failure', 'success', 'failure'])
+
+    def test_torn_entry_is_cut_off_before_appending(self):
+        ledger = ExtractionLedger(self.path)
+        ledger.record_success('a', {'id': 'a'})
+        ledger.close()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('{"article_id": "b", "sta')
+
+        ledger = ExtractionLedger(self.path, resume=True)
+        self.assertEqual(ledger.completed_ids(), {'a'})
+        ledger.record_success('c', {'id': 'c'})
+        ledger.close()
+
+        ledger = ExtractionLedger(self.path, resume=True)
+        ledger.close()
+        self.assertEqual(ledger.completed_ids(), {'a', 'c'})
+
+if __name__ == "__main__":
+    unittest.main()
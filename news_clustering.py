@@ -0,0 +1,263 @@
+import ast
+import copy
+import logging
+import os
+import re
+import sqlite3
+import unittest
+import zlib
+import numpy as np
+from urllib.parse import urlsplit
+from news_content_store import column_names
+from news_extraction_engine import is_skipped
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+DEFAULT_SIMILARITY_THRESHOLD = 0.5
+DEFAULT_HINT_THRESHOLD = 0.2
+
+def normalize_url(url):
+    """Scheme-, www- and trailing-slash-insensitive form of a URL, for matching provider hints to articles."""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parts.path.rstrip('/')
+    return f"{host}{path}?{parts.query}" if parts.query else f"{host}{path}"
+
+def shingles(text, size=5):
+    """Hashed word k-shingles; rewrites that share most sentences share most shingles."""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))} if words else set()
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+def parse_listing(value):
+    """Reads a list stored with str(), as the news fetchers store their list columns."""
+    if not value:
+        return []
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return []
+    return parsed if isinstance(parsed, list) else []
+
+def load_provider_hints(tickertick_db='tickertick_news.db', marketaux_db='marketaux_news.db'):
+    """
+    Groups of URLs the news providers already consider the same story.
+
+    TickerTick lists similar_stories by story id, resolved to URLs through the same
+    table. MarketAux lists similar articles with their URLs. Databases or columns
+    that do not exist yet are skipped.
+    """
+    groups = []
+    if tickertick_db and os.path.exists(tickertick_db):
+        conn = sqlite3.connect(tickertick_db)
+        if 'similar_stories' in column_names(conn, 'tickertick_news'):
+            rows = conn.execute('SELECT id, url, similar_stories FROM tickertick_news').fetchall()
+            url_by_id = {story_id: url for story_id, url, _ in rows}
+            for _, url, similar in rows:
+                group = [url]
+                for story in parse_listing(similar):
+                    if isinstance(story, dict):
+                        group.append(story.get('url') or url_by_id.get(story.get('id')))
+                    else:
+                        group.append(url_by_id.get(story))
+                group = [u for u in group if u]
+                if len(group) > 1:
+                    groups.append(group)
+        conn.close()
+    if marketaux_db and os.path.exists(marketaux_db):
+        conn = sqlite3.connect(marketaux_db)
+        if 'similar' in column_names(conn, 'marketaux_news'):
+            for url, similar in conn.execute('SELECT url, similar FROM marketaux_news'):
+                group = [url] + [item.get('url') for item in parse_listing(similar) if isinstance(item, dict)]
+                group = [u for u in group if u]
+                if len(group) > 1:
+                    groups.append(group)
+        conn.close()
+    return groups
+
+class StoryClusterer:
+    """
+    Groups near-duplicate articles (syndicated rewrites of one story) with MinHash/LSH.
+
+    Each article's word shingles are reduced to a num_perm MinHash signature. The
+    signature is split into bands, and articles sharing any band bucket become
+    candidate pairs. A candidate pair is joined when its estimated Jaccard similarity
+    reaches threshold. Pairs named by provider hints (TickerTick similar_stories,
+    MarketAux similar) seed the clusters. They only need hint_threshold, so loosely
+    rewritten syndications the hints vouch for are still merged. The representative
+    of a cluster is the member with the most distinct text.
+    """
+
+    def __init__(self, threshold=DEFAULT_SIMILARITY_THRESHOLD, hint_threshold=DEFAULT_HINT_THRESHOLD,
+                 hint_groups=(), num_perm=128, bands=32, shingle_size=5, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.hint_threshold = hint_threshold
+        self.hint_groups = [[normalize_url(u) for u in group] for group in hint_groups]
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # Full-range coefficients: with small ones, a * hash + b rarely wraps, so the
+        # smallest shingle hash would win almost every permutation
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set):
+        if not shingle_set:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        hashes = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+        # The product wraps modulo 2**64 before the reduction, as in the usual NumPy MinHash
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % np.uint64(MERSENNE_PRIME)
+        return (permuted & np.uint64(MAX_HASH)).min(axis=1)
+
+    def similarity(self, signatures, i, j):
+        return float(np.mean(signatures[i] == signatures[j]))
+
+    def cluster(self, articles):
+        """Returns clusters as lists of article positions, representative first; singletons included."""
+        shingle_sets = [shingles(a.get('content') or '', self.shingle_size) for a in articles]
+        signatures = np.array([self.signature(s) for s in shingle_sets]).reshape(len(articles), self.num_perm)
+        parent = list(range(len(articles)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def join(i, j, threshold):
+            if not shingle_sets[i] or not shingle_sets[j]:
+                return
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j and self.similarity(signatures, i, j) >= threshold:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        positions_by_url = {}
+        for position, article in enumerate(articles):
+            if article.get('url'):
+                positions_by_url.setdefault(normalize_url(article['url']), []).append(position)
+        for group in self.hint_groups:
+            members = [p for url in group for p in positions_by_url.get(url, [])]
+            for other in members[1:]:
+                join(members[0], other, self.hint_threshold)
+
+        rows = self.num_perm // self.bands
+        for band in range(self.bands):
+            buckets = {}
+            for position in range(len(articles)):
+                if shingle_sets[position]:
+                    key = signatures[position, band * rows:(band + 1) * rows].tobytes()
+                    buckets.setdefault(key, []).append(position)
+            for members in buckets.values():
+                for other in members[1:]:
+                    join(members[0], other, self.threshold)
+
+        clusters = {}
+        for position in range(len(articles)):
+            clusters.setdefault(find(position), []).append(position)
+        ordered = []
+        for members in clusters.values():
+            representative = max(members, key=lambda p: (len(shingle_sets[p]), -p))
+            ordered.append([representative] + [p for p in members if p != representative])
+        return sorted(ordered, key=lambda members: min(members))
+
+    def representatives(self, articles):
+        """Returns (one article per cluster, clusters); logs how much extraction the clustering saves."""
+        clusters = self.cluster(articles)
+        duplicates = len(articles) - len(clusters)
+        if duplicates:
+            logging.info(f"Clustered {len(articles)} articles into {len(clusters)} stories; "
+                         f"skipping extraction of {duplicates} near-duplicates")
+        return [articles[members[0]] for members in clusters], clusters
+
+def propagate_results(articles, clusters, representative_results):
+    """
+    Expands one result per cluster back to one result per article, in article order.
+
+    Members get a copy of their representative's result with their own URL and a
+    duplicate_of pointer, so downstream code can tell propagated results apart.
+    """
+    results = [None] * len(articles)
+    for members, result in zip(clusters, representative_results):
+        results[members[0]] = result
+        for member in members[1:]:
+            if not isinstance(result, dict) or 'error' in result or is_skipped(result):
+                results[member] = result
+                continue
+            copied = copy.deepcopy(result)
+            if isinstance(copied.get('news_article'), dict) and articles[member].get('url'):
+                copied['news_article']['url'] = articles[member]['url']
+            copied['duplicate_of'] = articles[members[0]].get('url')
+            results[member] = copied
+    return results
+
+def add_clustering_arguments(parser):
+    parser.add_argument('--no-dedup', action='store_true', help='Extract every near-duplicate copy of a story')
+    parser.add_argument('--similarity-threshold', type=float, default=DEFAULT_SIMILARITY_THRESHOLD,
+                        help='Estimated Jaccard similarity at which two articles are the same story')
+    return parser
+
+def clusterer_from_args(args):
+    if args.no_dedup:
+        return None
+    return StoryClusterer(args.similarity_threshold, hint_groups=load_provider_hints())
+
+class TestStoryClusterer(unittest.TestCase):
+    def text(self, words):
+        return ' '.join(f'{prefix}{i}' for prefix, i in words)
+
+    def setUp(self):
+        story = [('story', i) for i in range(100)]
+        # A syndicated copy with one phrase changed, a loose rewrite sharing its first half, and another story
+        self.articles = [
+            {'url': 'https://www.reuters.com/oxy-earnings/', 'content': self.text(story)},
+            {'url': 'https://finance.yahoo.com/oxy-earnings', 'content': self.text(
+                story[:50] + [('edited', i) for i in range(5)] + story[55:] + [('extra', 0)])},
+            {'url': 'https://marketwatch.com/oxy-rewrite', 'content': self.text(
+                story[:50] + [('rewrite', i) for i in range(50)])},
+            {'url': 'https://cnbc.com/other', 'content': self.text([('other', i) for i in range(100)])},
+        ]
+
+    def test_signature_similarity_estimates_jaccard(self):
+        clusterer = StoryClusterer(num_perm=512, bands=32)
+        shingle_sets = [shingles(article['content']) for article in self.articles]
+        signatures = np.array([clusterer.signature(s) for s in shingle_sets])
+        for i, j in [(0, 1), (0, 2), (1, 2), (0, 3)]:
+            jaccard = len(shingle_sets[i] & shingle_sets[j]) / len(shingle_sets[i] | shingle_sets[j])
+            with self.subTest(pair=(i, j)):
+                self.assertAlmostEqual(clusterer.similarity(signatures, i, j), jaccard, delta=0.08)
+
+    def test_near_duplicates_share_a_cluster(self):
+        self.assertEqual(StoryClusterer().cluster(self.articles), [[1, 0], [2], [3]])
+
+    def test_provider_hints_merge_looser_rewrites(self):
+        hints = [['http://reuters.com/oxy-earnings', 'https://www.marketwatch.com/oxy-rewrite/']]
+        clusterer = StoryClusterer(hint_groups=hints)
+        self.assertEqual(clusterer.cluster(self.articles), [[1, 0, 2], [3]])
+        representatives, clusters = clusterer.representatives(self.articles)
+        self.assertEqual([a['url'] for a in representatives], [self.articles[1]['url'], self.articles[3]['url']])
+
+    def test_results_propagate_to_duplicates(self):
+        clusters = [[1, 0, 2], [3]]
+        extracted = {'news_article': {'url': self.articles[1]['url']}, 'company': {'ticker': 'OXY'}}
+        skip = {'status': 'skipped', 'reason': 'Skipped as irrelevant'}
+        results = propagate_results(self.articles, clusters, [extracted, skip])
+        self.assertIs(results[1], extracted)
+        for member in (0, 2):
+            self.assertEqual(results[member]['news_article']['url'], self.articles[member]['url'])
+            self.assertEqual(results[member]['duplicate_of'], self.articles[1]['url'])
+        self.assertEqual(extracted['news_article']['url'], self.articles[1]['url'])
+        self.assertIs(results[3], skip)
+
+    def test_failed_representative_is_not_copied(self):
+        failure = {'error': 'Max retries reached'}
+        results = propagate_results(self.articles[:2], [[0, 1]], [failure])
+        self.assertEqual(results, [failure, failure])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,23 @@
 import requests
 import json
 import gzip
+import itertools
+import os
 from io import BytesIO
-import concurrent.futures
+import queue
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import unittest
+import unittest.mock
+import zlib
 import logging
+from pathlib import Path
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from news_content_store import ContentCodec, column_names, recompress_column, train_dictionary
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -17,8 +27,80 @@ logging.basicConfig(level=logging.INFO,
                         logging.StreamHandler()
                     ])
 
+class CDXCache:
+    """
+    Local SQLite cache of CommonCrawl CDX lookups.
+
+    Published crawl indexes are immutable, so results are stored per
+    (crawl id, URL pattern, page) and never expire. Only the index list itself,
+    which grows when a new crawl is published, is refreshed after index_list_ttl.
+    """
+
+    def __init__(self, db_path='commoncrawl_cdx_cache.db', index_list_ttl=24 * 3600):
+        self.db_path = db_path
+        self.index_list_ttl = index_list_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cdx_results (
+                crawl_id TEXT,
+                url_pattern TEXT,
+                page INTEGER,
+                results BLOB,
+                fetched_at REAL,
+                PRIMARY KEY (crawl_id, url_pattern, page)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS index_list (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                body TEXT,
+                fetched_at REAL
+            )
+        ''')
+        self.conn.commit()
+        logging.debug(f"Opened CDX cache at {db_path}")
+
+    def get_results(self, crawl_id, url_pattern, page=0):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT results FROM cdx_results WHERE crawl_id = ? AND url_pattern = ? AND page = ?',
+                (crawl_id, url_pattern, page)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put_results(self, crawl_id, url_pattern, page, results):
+        blob = zlib.compress(json.dumps(results).encode('utf-8'))
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cdx_results (crawl_id, url_pattern, page, results, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                (crawl_id, url_pattern, page, blob, time.time())
+            )
+            self.conn.commit()
+
+    def get_index_list(self):
+        with self.lock:
+            row = self.conn.execute('SELECT body, fetched_at FROM index_list WHERE id = 0').fetchone()
+        if row is None or time.time() - row[1] > self.index_list_ttl:
+            return None
+        return row[0]
+
+    def put_index_list(self, body):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO index_list (id, body, fetched_at) VALUES (0, ?, ?)',
+                (body, time.time())
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
 class CommonCrawlAPI:
-    def __init__(self):
+    def __init__(self, pool_size=10, cache=None):
+        self.cache = cache if cache is not None else CDXCache()
         self.session = requests.Session()
         retries = Retry(
             total=5,
@@ -26,7 +108,8 @@ class CommonCrawlAPI:
             status_forcelist=[500, 502, 503, 504],
             allowed_methods=["GET"]
         )
-        adapter = HTTPAdapter(max_retries=retries)
+        # Size the connection pool for the number of concurrent pipeline workers
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
         self.session.mount("https://", adapter)
         self.session.mount("http://", adapter)
         logging.info("Initialized CommonCrawlAPI instance with enhanced retry strategy.")
@@ -39,9 +122,15 @@ class CommonCrawlAPI:
         """Fetches the latest Common Crawl index."""
         index_list_url = "https://index.commoncrawl.org/"
         try:
-            response = self.session.get(index_list_url, timeout=10)
-            response.raise_for_status()
-            indices = response.text.strip().split('\n')
+            body = self.cache.get_index_list()
+            if body is None:
+                response = self.session.get(index_list_url, timeout=10)
+                response.raise_for_status()
+                body = response.text
+                self.cache.put_index_list(body)
+            else:
+                logging.debug("Using cached Common Crawl index list.")
+            indices = body.strip().split('\n')
             # Assuming indices are sorted and the latest is the last one
             latest = indices[-1] if indices else None
             if latest:
@@ -53,18 +142,30 @@ class CommonCrawlAPI:
             logging.error(f"Error fetching latest index from Common Crawl: {e}")
             return None
 
-    def search_index(self, url_pattern):
+    def search_index(self, url_pattern, page=0):
+        cached = self.cache.get_results(self.latest_index, url_pattern, page)
+        if cached is not None:
+            logging.info(f"Found {len(cached)} cached results for pattern: {url_pattern} (page {page})")
+            return cached
+
         api_url = f"https://index.commoncrawl.org/{self.latest_index}-index"
         params = {
             'url': url_pattern,
-            'output': 'json'
+            'output': 'json',
+            'page': page
         }
         logging.debug(f"Searching index with pattern: {url_pattern}")
 
         try:
             response = self.session.get(api_url, params=params, timeout=30)  # Increased timeout
+            if response.status_code == 404:
+                # The CDX server answers 404 when a pattern has no captures; that is final too
+                logging.info(f"No captures for pattern: {url_pattern} (page {page})")
+                self.cache.put_results(self.latest_index, url_pattern, page, [])
+                return []
             response.raise_for_status()
             results = [json.loads(line) for line in response.text.strip().split('\n') if line]
+            self.cache.put_results(self.latest_index, url_pattern, page, results)
             logging.info(f"Found {len(results)} results for pattern: {url_pattern}")
             return results
         except requests.exceptions.RequestException as e:
@@ -74,32 +175,53 @@ class CommonCrawlAPI:
             logging.error(f"JSON decoding failed for pattern '{url_pattern}': {e}")
             return []
 
-    def fetch_page_content(self, warc_path, offset, length):
+    def fetch_warc_record(self, warc_path, offset, length):
+        """Fetches the raw (gzip-compressed) WARC record bytes with a range request."""
+        offset, length = int(offset), int(length)
         headers = {'Range': f'bytes={offset}-{offset+length-1}'}
         url = f'https://commoncrawl.s3.amazonaws.com/{warc_path}'
-        logging.debug(f"Fetching page content from {url} with headers {headers}")
+        logging.debug(f"Fetching WARC record from {url} with headers {headers}")
 
         try:
             response = self.session.get(url, headers=headers, timeout=30)  # Increased timeout
             response.raise_for_status()
             if response.status_code == 206:
-                with gzip.GzipFile(fileobj=BytesIO(response.content)) as gz:
-                    content = gz.read()
-                decoded_content = content.decode('utf-8', errors='ignore')
-                logging.info(f"Successfully fetched and decoded content from {url}")
-                return decoded_content
-            else:
-                logging.warning(f"Unexpected status code {response.status_code} for URL: {url}")
-                return None
+                return response.content
+            logging.warning(f"Unexpected status code {response.status_code} for URL: {url}")
+            return None
         except requests.exceptions.RequestException as e:
             logging.error(f"Error fetching page content from {url}: {e}")
             return None
-        except gzip.BadGzipFile as e:
-            logging.error(f"Gzip decompression failed for URL {url}: {e}")
+
+    @staticmethod
+    def decode_warc_record(raw_record):
+        """Decompresses and decodes a raw WARC record fetched by fetch_warc_record."""
+        try:
+            with gzip.GzipFile(fileobj=BytesIO(raw_record)) as gz:
+                content = gz.read()
+            return content.decode('utf-8', errors='ignore')
+        except (gzip.BadGzipFile, EOFError, OSError) as e:
+            logging.error(f"Gzip decompression failed: {e}")
             return None
-        except Exception as e:
-            logging.error(f"Unexpected error fetching content from {url}: {e}")
+
+    @staticmethod
+    def extract_http_body(record_text):
+        """Strips the WARC and HTTP header blocks from a decoded record, leaving the page body."""
+        if record_text is None or not record_text.startswith('WARC/'):
+            return record_text
+        parts = record_text.split('\r\n\r\n', 2)
+        if len(parts) < 3:
+            return record_text
+        return parts[2]
+
+    def fetch_page_content(self, warc_path, offset, length):
+        raw_record = self.fetch_warc_record(warc_path, offset, length)
+        if raw_record is None:
             return None
+        decoded_content = self.decode_warc_record(raw_record)
+        if decoded_content is not None:
+            logging.info(f"Successfully fetched and decoded content from {warc_path}")
+        return decoded_content
 
 def get_financial_domains():
     """Returns a list of financial domains to search for"""
@@ -120,27 +242,34 @@ def get_financial_domains():
     logging.info(f"Financial domains to search: {domains}")
     return domains
 
-def process_pattern(api, pattern):
+def build_record(result):
+    """Maps a CDX index result onto a financial_urls row."""
+    return {
+        'url': result['url'],
+        'domain': result['url'].split('/')[2],
+        'timestamp': result['timestamp'],
+        'filename': result.get('filename'),
+        'offset': result.get('offset'),
+        'length': result.get('length')
+    }
+
+def has_warc_location(result):
+    return all(key in result for key in ['filename', 'offset', 'length'])
+
+def process_pattern(api, pattern, results_per_pattern=5):
     logging.debug(f"Processing pattern: {pattern}")
     results = api.search_index(pattern)
     processed_data = []
 
-    for result in results[:5]:  # Limit to first 5 results per pattern
+    for result in results[:results_per_pattern]:  # Limit to first results per pattern
         try:
-            data = {
-                'url': result['url'],
-                'domain': result['url'].split('/')[2],
-                'timestamp': result['timestamp'],
-                'filename': result.get('filename'),
-                'offset': result.get('offset'),
-                'length': result.get('length')
-            }
-
-            if all(key in result for key in ['filename', 'offset', 'length']):
+            data = build_record(result)
+
+            if has_warc_location(result):
                 content = api.fetch_page_content(result['filename'], 
                                                  result['offset'], 
                                                  result['length'])
-                data['content'] = content
+                data['content'] = api.extract_http_body(content)
 
             processed_data.append(data)
             logging.debug(f"Processed data for URL: {data['url']}")
@@ -149,129 +278,730 @@ def process_pattern(api, pattern):
     logging.info(f"Processed {len(processed_data)} items for pattern: {pattern}")
     return processed_data
 
+def open_financial_urls_db(db_path='financial_urls.db'):
+    """
+    Opens financial_urls.db with page bodies split out into financial_url_contents.
+
+    Bodies are compressed and live in their own table, so scans over the metadata
+    columns never read body pages. Databases that still carry the old TEXT content
+    column are migrated on first open. This is the writer's open; queries use
+    open_financial_urls_reader, which never changes the database.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS financial_urls (
+            url TEXT PRIMARY KEY,
+            domain TEXT,
+            timestamp TEXT,
+            filename TEXT,
+            offset INTEGER,
+            length INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS financial_url_contents (
+            url TEXT PRIMARY KEY,
+            content BLOB
+        )
+    ''')
+    conn.commit()
+    codec = ContentCodec(conn)
+    if 'content' in column_names(conn, 'financial_urls'):
+        migrate_inline_content(conn, codec)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_financial_urls_domain_timestamp ON financial_urls (domain, timestamp, url)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_financial_urls_timestamp ON financial_urls (timestamp, url)')
+    conn.commit()
+    return conn, codec
+
+def open_financial_urls_reader(db_path='financial_urls.db'):
+    """
+    Opens financial_urls.db read-only for queries.
+
+    Nothing is created, migrated or indexed here, so reads never take a write lock.
+    A database still in the legacy layout, with bodies inline in financial_urls, is
+    read as it is: a temporary view stands in for financial_url_contents and strips
+    the WARC and HTTP headers the way the migration does. Opening it once with
+    open_financial_urls_db (a harvest, or --migrate) moves it to the current layout.
+    """
+    conn = sqlite3.connect(f"{Path(db_path).absolute().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        metadata_columns = column_names(conn, 'financial_urls')
+        if not metadata_columns:
+            raise sqlite3.OperationalError(f"{db_path} has no financial_urls table")
+        if 'content' in metadata_columns:
+            # The bodies stay inline until the migration has copied all of them, so they are complete
+            logging.info(f"{db_path} is in the legacy layout; run news_commoncrawl.py --migrate to convert it")
+            conn.create_function('http_body', 1, CommonCrawlAPI.extract_http_body, deterministic=True)
+            conn.execute('CREATE TEMP VIEW financial_url_contents AS SELECT url, http_body(content) AS content '
+                         'FROM main.financial_urls WHERE content IS NOT NULL')
+        elif not column_names(conn, 'financial_url_contents'):
+            raise sqlite3.OperationalError(f"{db_path} has no financial_url_contents table")
+        codec = ContentCodec()
+        if column_names(conn, 'compression_dicts'):
+            codec.load_dictionaries(conn)
+        return conn, codec
+    except Exception:
+        conn.close()
+        raise
+
+def migrate_inline_content(conn, codec, batch_size=500):
+    """Moves legacy financial_urls.content values into the compressed contents table."""
+    logging.info("Migrating financial_urls.content into compressed financial_url_contents")
+    migrated = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            'SELECT rowid, url, content FROM financial_urls WHERE rowid > ? AND content IS NOT NULL ORDER BY rowid LIMIT ?',
+            (last_rowid, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            'INSERT OR REPLACE INTO financial_url_contents (url, content) VALUES (?, ?)',
+            [(url, codec.compress(CommonCrawlAPI.extract_http_body(content))) for _, url, content in rows]
+        )
+        conn.commit()
+        migrated += len(rows)
+        last_rowid = rows[-1][0]
+    try:
+        conn.execute('ALTER TABLE financial_urls DROP COLUMN content')
+    except sqlite3.OperationalError:
+        # SQLite < 3.35 cannot drop columns; clearing the values still frees the pages
+        conn.execute('UPDATE financial_urls SET content = NULL')
+    conn.commit()
+    logging.info(f"Migrated {migrated} bodies; run VACUUM to reclaim the freed space.")
+
+class DatabaseWriter:
+    """Single long-lived connection to financial_urls.db that writes rows in batches."""
+
+    def __init__(self, db_path='financial_urls.db', batch_size=100):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.pending = []
+        self.total_written = 0
+        self.conn, self.codec = open_financial_urls_db(db_path)
+        logging.debug(f"Opened {db_path} and ensured financial_urls tables exist.")
+
+    def add(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows = [(
+            item['url'],
+            item['domain'],
+            item['timestamp'],
+            item.get('filename'),
+            item.get('offset'),
+            item.get('length')
+        ) for item in self.pending]
+        contents = []
+        for item in self.pending:
+            if 'content_blob' in item:
+                contents.append((item['url'], item['content_blob']))
+            elif item.get('content') is not None:
+                contents.append((item['url'], self.codec.compress(item['content'])))
+        try:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO financial_urls 
+                (url, domain, timestamp, filename, offset, length)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO financial_url_contents (url, content)
+                VALUES (?, ?)
+            ''', contents)
+            self.conn.commit()
+            self.total_written += len(rows)
+            logging.info(f"Committed {len(rows)} rows to the database ({self.total_written} total).")
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Database error while writing batch of {len(rows)} rows: {e}")
+        self.pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+            logging.debug("Closed database connection.")
+
 def store_in_database(data):
     if not data:
         logging.warning("No data to store in database.")
         return
 
+    writer = DatabaseWriter()
     try:
-        conn = sqlite3.connect('financial_urls.db')
-        cursor = conn.cursor()
-        logging.debug("Connected to financial_urls.db")
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS financial_urls (
-                url TEXT PRIMARY KEY,
-                domain TEXT,
-                timestamp TEXT,
-                filename TEXT,
-                offset INTEGER,
-                length INTEGER,
-                content TEXT
-            )
-        ''')
-        logging.debug("Ensured financial_urls table exists.")
-        
         for item in data:
+            writer.add(item)
+    finally:
+        writer.close()
+
+_STAGE_DONE = object()
+
+class CommonCrawlHarvester:
+    """
+    Pipelined harvester: index search -> WARC range fetch -> extraction -> DB write.
+
+    Each stage runs its own worker threads and hands work to the next stage through a
+    bounded queue, so a slow stage applies back-pressure instead of buffering everything.
+    A single writer thread owns the database connection and commits in batches.
+    """
+
+    def __init__(self, api, db_path='financial_urls.db', results_per_pattern=5,
+                 search_workers=2, fetch_workers=8, extract_workers=2,
+                 queue_size=100, write_batch_size=100, flush_interval=5.0):
+        self.api = api
+        self.db_path = db_path
+        self.results_per_pattern = results_per_pattern
+        self.search_workers = search_workers
+        self.fetch_workers = fetch_workers
+        self.extract_workers = extract_workers
+        self.write_batch_size = write_batch_size
+        self.flush_interval = flush_interval
+        self.pattern_queue = queue.Queue()
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.extract_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.writer = None
+        self.writer_error = None
+        self.total_urls = 0
+
+    def _put(self, q, item):
+        # Re-check the stop flag while blocked on a full queue so Ctrl-C can't deadlock us
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop_event.is_set():
             try:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO financial_urls 
-                    (url, domain, timestamp, filename, offset, length, content)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['url'],
-                    item['domain'],
-                    item['timestamp'],
-                    item.get('filename'),
-                    item.get('offset'),
-                    item.get('length'),
-                    item.get('content')
-                ))
-                logging.debug(f"Inserted/Updated URL: {item['url']}")
-            except sqlite3.IntegrityError as e:
-                logging.error(f"Integrity error for URL {item['url']}: {e}")
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _STAGE_DONE
+
+    def _search_worker(self):
+        while True:
+            pattern = self._get(self.pattern_queue)
+            if pattern is _STAGE_DONE:
+                return
+            try:
+                results = self.api.search_index(pattern)
             except Exception as e:
-                logging.error(f"Unexpected error inserting URL {item['url']}: {e}")
-        
-        conn.commit()
-        logging.info("Committed all changes to the database.")
-    except sqlite3.Error as e:
-        logging.error(f"Database error: {e}")
-    finally:
-        conn.close()
-        logging.debug("Closed database connection.")
-    
+                logging.error(f"Error searching pattern {pattern}: {e}")
+                continue
+            for result in results[:self.results_per_pattern]:
+                try:
+                    record = build_record(result)
+                except Exception as e:
+                    logging.error(f"Error processing result {result}: {e}")
+                    continue
+                if not self._put(self.fetch_queue, record):
+                    return
+            logging.info(f"Queued {min(len(results), self.results_per_pattern)} items for pattern: {pattern}")
+
+    def _fetch_worker(self):
+        while True:
+            record = self._get(self.fetch_queue)
+            if record is _STAGE_DONE:
+                return
+            raw_record = None
+            if has_warc_location(record) and all(record[key] is not None for key in ['filename', 'offset', 'length']):
+                try:
+                    raw_record = self.api.fetch_warc_record(record['filename'], record['offset'], record['length'])
+                except Exception as e:
+                    logging.error(f"Error fetching WARC record for {record['url']}: {e}")
+            if not self._put(self.extract_queue, (record, raw_record)):
+                return
+
+    def _extract_worker(self):
+        while True:
+            item = self._get(self.extract_queue)
+            if item is _STAGE_DONE:
+                return
+            record, raw_record = item
+            if raw_record is not None:
+                body = self.api.extract_http_body(self.api.decode_warc_record(raw_record))
+                if body is not None:
+                    # Compress here so the single writer thread only does I/O
+                    record['content_blob'] = self.writer.codec.compress(body)
+            if not self._put(self.write_queue, record):
+                return
+
+    def _writer(self):
+        writer = self.writer
+        try:
+            try:
+                while True:
+                    try:
+                        record = self.write_queue.get(timeout=self.flush_interval)
+                    except queue.Empty:
+                        writer.flush()
+                        self.total_urls = writer.total_written
+                        if self.stop_event.is_set():
+                            return
+                        continue
+                    if record is _STAGE_DONE:
+                        return
+                    writer.add(record)
+                    # Only committed rows count; a batch whose insert failed is not found URLs
+                    self.total_urls = writer.total_written
+            finally:
+                writer.close()
+        except Exception as e:
+            logging.error(f"Database writer failed: {e}")
+            self.writer_error = e
+        finally:
+            self.total_urls = writer.total_written
+            # Nothing drains write_queue any more; stop the workers blocked on it
+            self.stop_event.set()
+
+    @staticmethod
+    def _start(target, count, name):
+        threads = [threading.Thread(target=target, name=f"{name}-{i}", daemon=True) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _join(threads):
+        # Join with a timeout so KeyboardInterrupt is still delivered to the main thread
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+
+    def _close_stage(self, threads, next_queue, next_workers):
+        self._join(threads)
+        for _ in range(next_workers):
+            self._put(next_queue, _STAGE_DONE)
+
+    def run(self, patterns):
+        self.writer = DatabaseWriter(self.db_path, batch_size=self.write_batch_size)
+        for pattern in patterns:
+            self.pattern_queue.put(pattern)
+        for _ in range(self.search_workers):
+            self.pattern_queue.put(_STAGE_DONE)
+
+        writer_thread = self._start(self._writer, 1, 'writer')
+        search_threads = self._start(self._search_worker, self.search_workers, 'search')
+        fetch_threads = self._start(self._fetch_worker, self.fetch_workers, 'fetch')
+        extract_threads = self._start(self._extract_worker, self.extract_workers, 'extract')
+
+        try:
+            self._close_stage(search_threads, self.fetch_queue, self.fetch_workers)
+            self._close_stage(fetch_threads, self.extract_queue, self.extract_workers)
+            self._close_stage(extract_threads, self.write_queue, 1)
+            self._join(writer_thread)
+        except KeyboardInterrupt:
+            logging.warning("Process interrupted by user. Flushing pending rows and shutting down.")
+            self.stop_event.set()
+            self._join(writer_thread)
+        if self.writer_error is not None:
+            raise self.writer_error
+        return self.total_urls
+
 def get_commoncrawl_urls():
     api = CommonCrawlAPI()
     domains = get_financial_domains()
     logging.info(f"Searching for {len(domains)} domains")
-    
-    total_urls = 0
-    
-    # Reduced the number of max_workers to 2 to lessen the load on the API
+
+    harvester = CommonCrawlHarvester(api)
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            future_to_pattern = {executor.submit(process_pattern, api, pattern): pattern for pattern in domains}
-            for future in concurrent.futures.as_completed(future_to_pattern):
-                pattern = future_to_pattern[future]
-                try:
-                    pattern_results = future.result()
-                    store_in_database(pattern_results)
-                    total_urls += len(pattern_results)
-                    logging.info(f"Processed pattern: {pattern} with {len(pattern_results)} URLs")
-                except Exception as e:
-                    logging.error(f"Error processing pattern {pattern}: {e}")
-                
-                # Rate limiting to prevent overwhelming the API
-                time.sleep(2)
-    except KeyboardInterrupt:
-        logging.warning("Process interrupted by user. Shutting down gracefully.")
+        total_urls = harvester.run(domains)
     except Exception as e:
-        logging.error(f"Error during parallel processing: {e}")
+        logging.error(f"Error during pipelined harvesting: {e}")
+        # Batches committed before the failure are in the database
+        total_urls = harvester.total_urls
     
     logging.info(f"\nTotal URLs found: {total_urls}")
     return total_urls
 
-def query_database(domain=None, start_date=None, end_date=None, limit=100):
-    """Query the database with optional filters"""
+def load_contents(urls, db_path='financial_urls.db'):
+    """Fetches and decompresses page bodies for the given URLs; metadata queries never touch them."""
+    conn, codec = open_financial_urls_reader(db_path)
+    try:
+        contents = {}
+        urls = list(urls)
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i+500]
+            placeholders = ','.join('?' for _ in chunk)
+            for url, blob in conn.execute(
+                    f'SELECT url, content FROM financial_url_contents WHERE url IN ({placeholders})', chunk):
+                contents[url] = codec.decompress(blob)
+        return contents
+    finally:
+        conn.close()
+
+def train_content_dictionary(db_path='financial_urls.db', recompress=True):
+    """Trains a zstd dictionary on stored financial pages and optionally recompresses existing bodies with it."""
+    conn, codec = open_financial_urls_db(db_path)
+    try:
+        dict_id = train_dictionary(conn, codec, 'financial_url_contents', 'content')
+        if dict_id is not None and recompress:
+            recompress_column(conn, codec, 'financial_url_contents', 'url', 'content')
+        return dict_id
+    finally:
+        conn.close()
+
+METADATA_COLUMNS = ['url', 'domain', 'timestamp', 'filename', 'offset', 'length']
+
+def iter_financial_urls(domain=None, start_date=None, end_date=None, columns=None,
+                        include_content=False, after=None, page_size=1000, db_path='financial_urls.db'):
+    """
+    Streams financial_urls rows as dicts in (timestamp, url) order.
+
+    Rows are read in keyset-paginated pages of page_size, so memory stays constant
+    however large the result is. Only the requested metadata columns are read.
+    Page bodies are joined in and decompressed only when include_content is set.
+    after is a (timestamp, url) cursor; pass the last row's values to resume.
+    """
+    columns = list(columns) if columns else list(METADATA_COLUMNS)
+    unknown = [column for column in columns if column not in METADATA_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown financial_urls columns: {unknown}")
+    select_columns = [f"f.{column}" for column in columns]
+    # The keyset columns are always read, even when not projected
+    select_columns += ['f.timestamp AS _cursor_timestamp', 'f.url AS _cursor_url']
+    query = f"SELECT {', '.join(select_columns)}"
+    if include_content:
+        query += ", c.content FROM financial_urls f LEFT JOIN financial_url_contents c ON c.url = f.url"
+    else:
+        query += " FROM financial_urls f"
+    query += " WHERE 1=1"
+    params = []
+
+    if domain:
+        query += " AND f.domain = ?"
+        params.append(domain)
+    if start_date:
+        query += " AND f.timestamp >= ?"
+        params.append(start_date)
+    if end_date:
+        query += " AND f.timestamp <= ?"
+        params.append(end_date)
+
+    conn, codec = open_financial_urls_reader(db_path)
+    try:
+        cursor = tuple(after) if after else None
+        while True:
+            page_query = query
+            page_params = list(params)
+            if cursor is not None:
+                page_query += " AND (f.timestamp, f.url) > (?, ?)"
+                page_params.extend(cursor)
+            page_query += " ORDER BY f.timestamp, f.url LIMIT ?"
+            page_params.append(page_size)
+            logging.debug(f"Executing query: {page_query} with params: {page_params}")
+
+            rows = conn.execute(page_query, page_params).fetchall()
+            for row in rows:
+                record = dict(zip(columns, row[:len(columns)]))
+                if include_content:
+                    record['content'] = codec.decompress(row[-1])
+                yield record
+            if len(rows) < page_size:
+                return
+            last = rows[-1]
+            cursor = (last[len(columns)], last[len(columns) + 1])
+    finally:
+        conn.close()
+
+def query_page(domain=None, start_date=None, end_date=None, columns=None,
+               include_content=False, after=None, limit=100, db_path='financial_urls.db'):
+    """Returns one page of rows plus the (timestamp, url) cursor for the next page, or None at the end."""
+    columns = list(columns) if columns else list(METADATA_COLUMNS)
+    # Read the keyset columns even when they are not projected, then drop them
+    read_columns = columns + [column for column in ('timestamp', 'url') if column not in columns]
+    rows = list(itertools.islice(
+        iter_financial_urls(domain, start_date, end_date, read_columns, include_content, after,
+                            page_size=limit + 1, db_path=db_path),
+        limit + 1
+    ))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]['timestamp'], rows[-1]['url'])
+    page = [{key: value for key, value in row.items() if key in columns or key == 'content'} for row in rows]
+    return page, next_cursor
+
+def export_financial_urls(output_file, include_content=False, db_path='financial_urls.db', **filters):
+    """Streams matching rows to a JSON Lines file in constant memory."""
+    count = 0
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for record in iter_financial_urls(include_content=include_content, db_path=db_path, **filters):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+    logging.info(f"Exported {count} rows to {output_file}")
+    return count
+
+def query_database(domain=None, start_date=None, end_date=None, limit=100, include_content=True,
+                   db_path='financial_urls.db'):
+    """
+    Query the database with optional filters
+
+    Rows are (url, domain, timestamp, filename, offset, length, content) tuples, with
+    the page body decompressed. include_content=False leaves the body out and never
+    reads it. As with SQLite's LIMIT, a negative limit returns every matching row.
+    """
+    limit = int(limit)
+    columns = METADATA_COLUMNS + ['content'] if include_content else METADATA_COLUMNS
     try:
-        conn = sqlite3.connect('financial_urls.db')
-        cursor = conn.cursor()
-        logging.debug("Connected to financial_urls.db for querying.")
-        
-        query = "SELECT * FROM financial_urls WHERE 1=1"
-        params = []
-        
-        if domain:
-            query += " AND domain = ?"
-            params.append(domain)
-            logging.debug(f"Filtering by domain: {domain}")
-        
-        if start_date:
-            query += " AND timestamp >= ?"
-            params.append(start_date)
-            logging.debug(f"Filtering by start_date: {start_date}")
-            
-        if end_date:
-            query += " AND timestamp <= ?"
-            params.append(end_date)
-            logging.debug(f"Filtering by end_date: {end_date}")
-            
-        query += f" LIMIT {limit}"
-        logging.debug(f"Executing query: {query} with params: {params}")
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
+        results = [
+            tuple(record[column] for column in columns)
+            for record in itertools.islice(iter_financial_urls(domain, start_date, end_date,
+                                                               include_content=include_content,
+                                                               page_size=1000 if limit < 0 else max(1, min(limit, 1000)),
+                                                               db_path=db_path),
+                                           None if limit < 0 else limit)
+        ]
         logging.info(f"Query returned {len(results)} results.")
         return results
     except sqlite3.Error as e:
         logging.error(f"Database error during query: {e}")
         return []
-    finally:
+
+class StandInCrawlAPI(CommonCrawlAPI):
+    """CommonCrawlAPI with the index and WARC fetches answered locally."""
+
+    def __init__(self, results_per_pattern=2):
+        self.results_per_pattern = results_per_pattern
+
+    def search_index(self, url_pattern, page=0):
+        domain = url_pattern.split('/')[0]
+        return [{'url': f'https://{domain}/story-{i}', 'timestamp': f'2024030{i}120000',
+                 'filename': 'crawl.warc.gz', 'offset': i, 'length': 100}
+                for i in range(self.results_per_pattern)]
+
+    def fetch_warc_record(self, warc_path, offset, length):
+        record = f"WARC/1.0\r\nWARC-Type: response\r\n\r\nHTTP/1.1 200 OK\r\n\r\n<p>story {offset}</p>"
+        return gzip.compress(record.encode('utf-8'))
+
+class TestCommonCrawlHarvester(unittest.TestCase):
+    """The pipeline stores every record, counts only committed rows, and fails rather than hangs."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.workdir.name, 'financial_urls.db')
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def run_harvester(self, harvester, patterns):
+        # A hang is a failure too; run in a thread so the test can give up on it
+        outcome = {}
+
+        def target():
+            try:
+                outcome['total'] = harvester.run(patterns)
+            except Exception as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(timeout=20)
+        self.assertFalse(thread.is_alive(), "harvester did not finish")
+        return outcome
+
+    def test_pipeline_stores_records_and_bodies(self):
+        harvester = CommonCrawlHarvester(StandInCrawlAPI(), self.db_path, queue_size=2, write_batch_size=3,
+                                         flush_interval=0.2)
+        outcome = self.run_harvester(harvester, ['reuters.com/markets/*', 'cnbc.com/markets/*', 'barrons.com/*'])
+        self.assertEqual(outcome, {'total': 6})
+        contents = load_contents(['https://cnbc.com/story-1', 'https://barrons.com/story-0'], self.db_path)
+        self.assertEqual(contents, {'https://cnbc.com/story-1': '<p>story 1</p>',
+                                    'https://barrons.com/story-0': '<p>story 0</p>'})
+
+    def test_rows_of_a_failed_batch_are_not_counted(self):
+        conn, _ = open_financial_urls_db(self.db_path)
+        conn.execute("CREATE TRIGGER reject_cnbc BEFORE INSERT ON financial_urls WHEN NEW.domain = 'cnbc.com' "
+                     "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+        conn.commit()
+        conn.close()
+        harvester = CommonCrawlHarvester(StandInCrawlAPI(), self.db_path, write_batch_size=1, flush_interval=0.2)
+        outcome = self.run_harvester(harvester, ['reuters.com/markets/*', 'cnbc.com/markets/*'])
+        self.assertEqual(outcome, {'total': 2})
+
+    def test_committed_rows_are_reported_after_a_writer_failure(self):
+        original_add = DatabaseWriter.add
+
+        def add_then_fail(writer, item):
+            if writer.total_written >= 2:
+                raise sqlite3.OperationalError('disk I/O error')
+            original_add(writer, item)
+            writer.flush()
+
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        try:
+            with unittest.mock.patch(f'{__name__}.CommonCrawlAPI', StandInCrawlAPI), \
+                    unittest.mock.patch.object(DatabaseWriter, 'add', add_then_fail):
+                total_urls = get_commoncrawl_urls()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(total_urls, 2)
+        self.assertEqual(len(query_database(include_content=False, db_path=self.db_path)), 2)
+
+    def test_writer_failure_stops_the_pipeline(self):
+        harvester = CommonCrawlHarvester(StandInCrawlAPI(results_per_pattern=50), self.db_path, queue_size=1,
+                                         write_batch_size=10, flush_interval=0.2)
+
+        def failing_add(item):
+            raise sqlite3.OperationalError('disk I/O error')
+
+        original_init = DatabaseWriter.__init__
+
+        def init(writer, *args, **kwargs):
+            original_init(writer, *args, **kwargs)
+            writer.add = failing_add
+
+        with unittest.mock.patch.object(DatabaseWriter, '__init__', init):
+            outcome = self.run_harvester(harvester, [f'site{i}.com/*' for i in range(10)])
+        self.assertIsInstance(outcome.get('error'), sqlite3.OperationalError)
+        self.assertTrue(harvester.stop_event.is_set())
+
+class TestFinancialUrlQueries(unittest.TestCase):
+    """Reads leave the database as they found it; the writer's open migrates it."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.workdir.name, 'financial_urls.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE financial_urls (url TEXT PRIMARY KEY, domain TEXT, timestamp TEXT, '
+                     'filename TEXT, offset INTEGER, length INTEGER, content TEXT)')
+        conn.executemany('INSERT INTO financial_urls VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            (f'https://reuters.com/story-{i}', 'reuters.com', f'2024030{i}120000', 'crawl.warc.gz', i, 100,
+             f"WARC/1.0\r\n\r\nHTTP/1.1 200 OK\r\n\r\n<p>story {i}</p>") for i in range(3)
+        ])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def schema(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return (conn.execute('PRAGMA journal_mode').fetchone()[0],
+                    sorted(row[0] for row in conn.execute("SELECT name FROM sqlite_master")))
+        finally:
+            conn.close()
+
+    def test_reads_do_not_migrate(self):
+        before = self.schema()
+        rows = query_database(db_path=self.db_path)
+        self.assertEqual([row[-1] for row in rows], [f'<p>story {i}</p>' for i in range(3)])
+        self.assertEqual(load_contents(['https://reuters.com/story-0'], self.db_path),
+                         {'https://reuters.com/story-0': '<p>story 0</p>'})
+        self.assertEqual(self.schema(), before)
+
+    def test_legacy_and_migrated_reads_agree(self):
+        legacy = query_database(limit=-1, db_path=self.db_path)
+        conn, _ = open_financial_urls_db(self.db_path)
         conn.close()
-        logging.debug("Closed database connection after querying.")
+        self.assertEqual(query_database(limit=-1, db_path=self.db_path), legacy)
+
+    def test_rows_keep_their_content_after_migration(self):
+        conn, _ = open_financial_urls_db(self.db_path)
+        conn.close()
+        rows = query_database(db_path=self.db_path)
+        self.assertEqual(rows[0], ('https://reuters.com/story-0', 'reuters.com', '20240300120000', 'crawl.warc.gz',
+                                   0, 100, '<p>story 0</p>'))
+        self.assertEqual(len(query_database(limit=2, db_path=self.db_path)), 2)
+        self.assertEqual(len(query_database(limit=-1, db_path=self.db_path)), 3)
+        self.assertEqual([len(row) for row in query_database(include_content=False, db_path=self.db_path)], [6] * 3)
+        with self.assertRaises(ValueError):
+            query_database(limit='ten', db_path=self.db_path)
+
+class StandInResponse:
+    """A canned requests response for the CDX server."""
+
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error")
+
+class TestCDXCache(unittest.TestCase):
+    """Lookups against a published crawl are answered from the cache after the first request."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.cache = CDXCache(os.path.join(self.workdir.name, 'cdx_cache.db'))
+        self.responses = {'https://index.commoncrawl.org/': StandInResponse("CC-MAIN-2024-10\nCC-MAIN-2024-18\n")}
+        self.requested = []
+
+    def tearDown(self):
+        self.cache.close()
+        self.workdir.cleanup()
+
+    def get(self, url, params=None, timeout=None):
+        self.requested.append((url, (params or {}).get('url')))
+        return self.responses[url]
+
+    def make_api(self):
+        with unittest.mock.patch.object(requests.Session, 'get', side_effect=self.get):
+            return CommonCrawlAPI(cache=self.cache)
+
+    def search(self, api, pattern, page=0):
+        with unittest.mock.patch.object(api.session, 'get', side_effect=self.get):
+            return api.search_index(pattern, page)
+
+    def test_results_are_served_from_the_cache(self):
+        api = self.make_api()
+        self.assertEqual(api.latest_index, 'CC-MAIN-2024-18')
+        self.responses['https://index.commoncrawl.org/CC-MAIN-2024-18-index'] = StandInResponse(
+            '{"url": "https://reuters.com/a"}\n{"url": "https://reuters.com/b"}\n')
+        first = self.search(api, 'reuters.com/*')
+        second = self.search(api, 'reuters.com/*')
+        self.assertEqual(first, [{'url': 'https://reuters.com/a'}, {'url': 'https://reuters.com/b'}])
+        self.assertEqual(second, first)
+        self.assertEqual(self.requested.count(('https://index.commoncrawl.org/CC-MAIN-2024-18-index', 'reuters.com/*')), 1)
+
+    def test_no_captures_is_cached_but_errors_are_not(self):
+        api = self.make_api()
+        index_url = 'https://index.commoncrawl.org/CC-MAIN-2024-18-index'
+        self.responses[index_url] = StandInResponse('', status_code=404)
+        self.assertEqual(self.search(api, 'empty.com/*'), [])
+        self.assertEqual(self.cache.get_results('CC-MAIN-2024-18', 'empty.com/*'), [])
+        self.responses[index_url] = StandInResponse('', status_code=503)
+        self.assertEqual(self.search(api, 'flaky.com/*'), [])
+        self.assertIsNone(self.cache.get_results('CC-MAIN-2024-18', 'flaky.com/*'))
+
+    def test_results_are_keyed_by_crawl_and_page(self):
+        self.cache.put_results('CC-MAIN-2024-10', 'reuters.com/*', 0, [{'url': 'old'}])
+        self.cache.put_results('CC-MAIN-2024-18', 'reuters.com/*', 1, [{'url': 'second page'}])
+        self.assertEqual(self.cache.get_results('CC-MAIN-2024-10', 'reuters.com/*'), [{'url': 'old'}])
+        self.assertIsNone(self.cache.get_results('CC-MAIN-2024-18', 'reuters.com/*'))
+        self.assertEqual(self.cache.get_results('CC-MAIN-2024-18', 'reuters.com/*', 1), [{'url': 'second page'}])
+
+    def test_index_list_expires(self):
+        self.make_api()
+        self.assertEqual(self.requested, [('https://index.commoncrawl.org/', None)])
+        self.make_api()
+        self.assertEqual(len(self.requested), 1)
+        self.cache.index_list_ttl = -1
+        self.assertIsNone(self.cache.get_index_list())
 
 if __name__ == '__main__':
+    if '--migrate' in sys.argv[1:]:
+        migrated_conn, _ = open_financial_urls_db()
+        migrated_conn.close()
+        logging.info("financial_urls.db is in the current layout")
+        sys.exit(0)
     try:
         total_urls = get_commoncrawl_urls()
         logging.info(f"Completed processing with {total_urls} total URLs found")
@@ -0,0 +1,156 @@
+import re
+import unittest
+
+# Section key in the compact output -> (full key, field order inside its positional array)
+COMPACT_LAYOUT = {
+    'n': ('news_article', ['title', 'publishedDate', 'source', 'type']),
+    'c': ('company', ['ticker', 'name', 'exchange']),
+    'm': ('market_event', ['type', 'key_points', 'major_shareholders']),
+    'a': ('analysis', ['key_findings', 'sentiment', 'risk_factors']),
+    'e': ('event_classification', ['primary_type', 'sub_type', 'severity', 'confidence', 'impact_duration']),
+    'ip': ('inflection_point', ['date', 'price', 'relevance_ranking', 'reasoning']),
+}
+SHAREHOLDER_FIELDS = ['name', 'ownership_percentage', 'type']
+
+# A typical extraction is ~440 estimated tokens as indented full JSON and ~185 in compact
+# form; budget compact responses at 40% of the backends' 1000-token full-form estimate
+COMPACT_OUTPUT_TOKENS = 400
+
+ENUM_CODES = {
+    ('analysis', 'sentiment'): {'+': 'positive', '-': 'negative', '0': 'neutral'},
+    ('event_classification', 'primary_type'): {'G': 'Corporate Governance', 'F': 'Financial', 'P': 'Product',
+                                               'M': 'Market'},
+    ('event_classification', 'impact_duration'): {'S': 'SHORT_TERM', 'M': 'MEDIUM_TERM', 'L': 'LONG_TERM'},
+}
+
+COMPACT_FIELD_RULES = """Field rules:
+- publishedDate: ISO format date
+- type (in "n"): type of news article; event_type: the main event type
+- key_points: object of key numerical or factual points
+- shareholders: [] unless the article is ownership related; ownership_percentage is a number
+- sentiment: "+" positive, "-" negative, "0" neutral
+- primary_type: "G" Corporate Governance, "F" Financial, "P" Product, "M" Market
+- sub_type: more specific classification
+- severity: 1-5 scale; confidence: 0-1 scale
+- impact_duration: "S" short term, "M" medium term, "L" long term"""
+
+def compact_schema(multi_article=False, inflection_point=False):
+    """Output-structure block for the compact mode; the counterpart of the full schema in the instructions."""
+    lines = ['{']
+    if multi_article:
+        lines.append('    "x": article_index,        // The n from the article\'s [ARTICLE n] label')
+    lines += [
+        '    "n": [title, publishedDate, source, type],',
+        '    "c": [ticker, name, exchange],',
+        '    "m": [event_type, key_points, [[shareholder_name, ownership_percentage, shareholder_type], ...]],',
+        '    "a": [[key_finding, ...], sentiment, [risk_factor, ...]],',
+        '    "e": [primary_type, sub_type, severity, confidence, impact_duration]' + (',' if inflection_point else ''),
+    ]
+    if inflection_point:
+        lines.append('    "ip": [date, price, relevance_ranking, reasoning]   // reasoning: chain of thought in 140 characters')
+    lines.append('}')
+    schema = '\n'.join(lines)
+    if multi_article:
+        schema = '[\n' + '\n'.join('  ' + line for line in schema.splitlines()) + '\n]'
+    return (f"1. Output Structure Required (compact form: use exactly these short keys, and give each "
+            f"array's values in the order shown, without field names):\n{schema}\n\n{COMPACT_FIELD_RULES}")
+
+COMPACT_EXTRACTION_INSTRUCTIONS = f"""You are a financial news analyzer. Your task is to extract structured information from financial news articles and output it in JSON format. Follow these specific guidelines:
+
+{compact_schema()}
+
+Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted."""
+
+def is_compact(obj):
+    return isinstance(obj, dict) and any(key in obj for key in COMPACT_LAYOUT) and 'news_article' not in obj
+
+def expand_section(section, fields, value):
+    if isinstance(value, dict):
+        # The model spelled the fields out; accept them as they are
+        expanded = dict(value)
+    elif isinstance(value, list):
+        expanded = {field: value[i] if i < len(value) else None for i, field in enumerate(fields)}
+    else:
+        return value
+    for field in fields:
+        codes = ENUM_CODES.get((section, field))
+        if codes and isinstance(expanded.get(field), str):
+            expanded[field] = codes.get(expanded[field].strip(), expanded[field])
+    if section == 'market_event':
+        shareholders = expanded.get('major_shareholders')
+        if isinstance(shareholders, list):
+            expanded['major_shareholders'] = [
+                {f: item[i] if i < len(item) else None for i, f in enumerate(SHAREHOLDER_FIELDS)}
+                if isinstance(item, list) else item
+                for item in shareholders
+            ]
+    return expanded
+
+def expand_compact(obj, article=None):
+    """
+    Expands a compact-mode object back into the full extraction structure.
+
+    Full-form objects and error records are returned unchanged, so the decoder can
+    sit on any response path. The fields left out of the compact form are rebuilt
+    locally. news_article.url comes from the article that was sent, and
+    news_article.id is built as ticker_date_type, as the full prompt asks the model to.
+    """
+    if not is_compact(obj):
+        return obj
+    expanded = {}
+    if 'x' in obj:
+        expanded['article_index'] = obj['x']
+    for key, (section, fields) in COMPACT_LAYOUT.items():
+        if key in obj:
+            expanded[section] = expand_section(section, fields, obj[key])
+
+    news_article = expanded.get('news_article')
+    if isinstance(news_article, dict):
+        company = expanded.get('company') if isinstance(expanded.get('company'), dict) else {}
+        date = str(news_article.get('publishedDate') or '')[:10]
+        id_parts = [company.get('ticker'), date, news_article.get('type')]
+        news_article.setdefault('id', '_'.join(re.sub(r'\s+', '-', str(part)) for part in id_parts if part))
+        news_article.setdefault('url', (article or {}).get('url'))
+        # Keep the full schema's key order
+        expanded['news_article'] = {key: news_article.get(key)
+                                    for key in ['id', 'title', 'publishedDate', 'source', 'url', 'type']}
+    return expanded
+
+class TestExpandCompact(unittest.TestCase):
+    def test_expands_to_the_full_structure(self):
+        compact = {
+            "x": 4,
+            "n": ["Oxy beats estimates", "2024-03-04T13:00:00Z", "Reuters", "earnings report"],
+            "c": ["OXY", "Occidental Petroleum", "NYSE"],
+            "m": ["earnings", {"eps": 0.65}, [["Berkshire Hathaway", 28.2, "institutional"]]],
+            "a": [["EPS above consensus"], "+", ["Oil price volatility"]],
+            "e": ["F", "earnings", 3, 0.9, "S"],
+            "ip": ["2024-03-01", 61.2, 2, "Beat preceded the rally"],
+        }
+        expanded = expand_compact(compact, {'url': 'https://example.com/oxy'})
+        self.assertEqual(expanded['article_index'], 4)
+        self.assertEqual(expanded['news_article'], {
+            'id': 'OXY_2024-03-04_earnings-report', 'title': 'Oxy beats estimates',
+            'publishedDate': '2024-03-04T13:00:00Z', 'source': 'Reuters', 'url': 'https://example.com/oxy',
+            'type': 'earnings report'})
+        self.assertEqual(expanded['market_event']['major_shareholders'],
+                         [{'name': 'Berkshire Hathaway', 'ownership_percentage': 28.2, 'type': 'institutional'}])
+        self.assertEqual(expanded['analysis']['sentiment'], 'positive')
+        self.assertEqual(expanded['event_classification'],
+                         {'primary_type': 'Financial', 'sub_type': 'earnings', 'severity': 3, 'confidence': 0.9,
+                          'impact_duration': 'SHORT_TERM'})
+        self.assertEqual(expanded['inflection_point']['relevance_ranking'], 2)
+
+    def test_short_arrays_and_spelled_out_sections(self):
+        expanded = expand_compact({"c": ["OXY"], "a": {"sentiment": "-", "key_findings": []}})
+        self.assertEqual(expanded['company'], {'ticker': 'OXY', 'name': None, 'exchange': None})
+        self.assertEqual(expanded['analysis'], {'sentiment': 'negative', 'key_findings': []})
+
+    def test_full_form_and_errors_pass_through(self):
+        full = {'news_article': {'title': 'x'}, 'company': {'ticker': 'OXY'}}
+        error = {'error': 'Failed to parse'}
+        self.assertIs(expand_compact(full), full)
+        self.assertIs(expand_compact(error), error)
+
+if __name__ == "__main__":
+    unittest.main()
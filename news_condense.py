@@ -0,0 +1,223 @@
+import logging
+import re
+import unittest
+from news_extraction_engine import estimate_tokens
+
+DEFAULT_CONTENT_BUDGET = 1500
+# Title, date and source lines are kept outside the budget: the first HEADER_LINES lines of
+# the page, and any date or byline line, as long as it is no longer than HEADER_MAX_WORDS
+HEADER_LINES = 3
+HEADER_MAX_WORDS = 30
+
+FINANCIAL_KEYWORDS = [
+    'revenue', 'earnings', 'profit', 'loss', 'income', 'eps', 'per share', 'dividend', 'guidance',
+    'forecast', 'outlook', 'quarter', 'fiscal', 'margin', 'cash flow', 'debt', 'buyback', 'repurchase',
+    'acquisition', 'merger', 'deal', 'stake', 'shares', 'shareholder', 'investor', 'analyst', 'rating',
+    'upgrade', 'downgrade', 'price target', 'stock', 'valuation', 'production', 'output', 'barrels',
+    'capex', 'capital expenditure', 'ceo', 'cfo', 'board', 'sec', 'filing', 'lawsuit', 'settlement',
+    'bankruptcy', 'ipo', 'offering', 'billion', 'million',
+]
+
+# Page furniture that survives BeautifulSoup.get_text(): navigation, consent banners, legal footers
+BOILERPLATE_PATTERNS = re.compile(
+    r'forward-looking statements|all rights reserved|cookie|privacy policy|terms of (use|service)|'
+    r'subscribe|sign up|newsletter|click here|read more|advertisement|follow us|share this|'
+    r'copyright|©|disclaimer|not investment advice|javascript',
+    re.IGNORECASE
+)
+
+KEYWORD_PATTERN = re.compile(r'\b(' + '|'.join(re.escape(k) for k in FINANCIAL_KEYWORDS) + r')\b', re.IGNORECASE)
+FIGURE_PATTERN = re.compile(r'[$€£]\s?\d[\d,.]*|\d[\d,.]*\s?(%|percent|billion|million|bn|mln)', re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r'\d[\d,.]*')
+DATE_PATTERN = re.compile(
+    r'\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}/\d{1,2}/\d{2,4}\b|'
+    r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+\d{1,2}(st|nd|rd|th)?,?\s+\d{4}\b|'
+    r'\b\d{1,2}\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?,?\s+\d{4}\b|'
+    r'\b(published|updated|posted)\b',
+    re.IGNORECASE
+)
+BYLINE_PATTERN = re.compile(r'^(by|from|source:|written by)\s+\S|\((reuters|bloomberg|ap|afp)\)|^(reuters|bloomberg)\b',
+                            re.IGNORECASE)
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+(?=["\'(A-Z0-9$])')
+COMPANY_SUFFIXES = {'inc', 'corp', 'corporation', 'co', 'company', 'ltd', 'plc', 'llc', 'group', 'holdings'}
+
+def split_sentences(text):
+    """
+    Splits article text into (paragraph, sentence) pairs.
+
+    Scraped pages keep their layout as line breaks, so every non-empty line is its
+    own paragraph; lines are then split on sentence-ending punctuation.
+    """
+    sentences = []
+    for paragraph, line in enumerate(l.strip() for l in text.splitlines()):
+        if not line:
+            continue
+        for sentence in SENTENCE_BOUNDARY.split(line):
+            sentence = sentence.strip()
+            if sentence:
+                sentences.append((paragraph, sentence))
+    return sentences
+
+def header_paragraphs(text):
+    """Paragraph indices (as numbered by split_sentences) of the title, date and byline lines."""
+    headers = set()
+    seen = 0
+    for paragraph, line in enumerate(l.strip() for l in text.splitlines()):
+        if not line:
+            continue
+        seen += 1
+        if len(line.split()) > HEADER_MAX_WORDS:
+            continue
+        if seen <= HEADER_LINES or DATE_PATTERN.search(line) or BYLINE_PATTERN.search(line):
+            headers.add(paragraph)
+    return headers
+
+class ContentCondenser:
+    """
+    Keeps the sentences of an article most relevant to the target company.
+
+    Sentences are scored on mentions of the ticker and company name, financial
+    keywords and figures (amounts, percentages), with a penalty for boilerplate
+    and bare navigation fragments. The best ones are kept, in their original order,
+    until token_budget is reached. Sentences carrying figures score highest so key
+    numbers survive the cut. The header lines (title, date, byline) are always kept
+    and do not count against the budget, so the extraction still sees when and where
+    the article was published. Articles already within budget are left untouched.
+    """
+
+    def __init__(self, token_budget=DEFAULT_CONTENT_BUDGET, ticker=None, company=None):
+        self.token_budget = token_budget
+        self.ticker_pattern = (re.compile(r'(?<![A-Za-z])\$?' + re.escape(ticker) + r'(?![A-Za-z])')
+                               if ticker else None)
+        self.company_pattern = re.compile(re.escape(company), re.IGNORECASE) if company else None
+        name_terms = [term for term in re.findall(r'[A-Za-z]{3,}', company or '')
+                      if term.lower() not in COMPANY_SUFFIXES]
+        self.name_term_pattern = (re.compile(r'\b(' + '|'.join(map(re.escape, name_terms)) + r')\b', re.IGNORECASE)
+                                  if name_terms else None)
+
+    def score(self, sentence):
+        score = 0.0
+        if self.ticker_pattern and self.ticker_pattern.search(sentence):
+            score += 3
+        if self.company_pattern and self.company_pattern.search(sentence):
+            score += 3
+        elif self.name_term_pattern and self.name_term_pattern.search(sentence):
+            score += 2
+        score += min(len(KEYWORD_PATTERN.findall(sentence)), 3)
+        score += min(len(FIGURE_PATTERN.findall(sentence)), 3) * 1.5
+        score += min(len(NUMBER_PATTERN.findall(sentence)), 3) * 0.5
+        if BOILERPLATE_PATTERNS.search(sentence):
+            score -= 5
+        if len(sentence.split()) < 4:
+            score -= 1
+        return score
+
+    def condense(self, text):
+        """Returns (condensed_text, kept_ratio) for one article's content."""
+        original_tokens = estimate_tokens(text)
+        if not self.token_budget or original_tokens <= self.token_budget:
+            return text, 1.0
+
+        sentences = split_sentences(text)
+        headers = header_paragraphs(text)
+        header = [i for i, (paragraph, _) in enumerate(sentences) if paragraph in headers]
+        body = [i for i, (paragraph, _) in enumerate(sentences) if paragraph not in headers]
+        ranked = sorted(body, key=lambda i: (-self.score(sentences[i][1]), i))
+        kept = []
+        used = 0
+        for i in ranked:
+            if self.score(sentences[i][1]) <= 0:
+                break
+            tokens = estimate_tokens(sentences[i][1])
+            if used + tokens > self.token_budget:
+                continue
+            kept.append(i)
+            used += tokens
+
+        if not kept:
+            # Nothing recognisably relevant: fall back to the head of the article
+            condensed = text[:self.token_budget * 4]
+            missing = [sentences[i][1] for i in header if sentences[i][1] not in condensed]
+            if missing:
+                condensed = condensed + '\n' + '\n'.join(missing)
+        else:
+            parts = []
+            previous_paragraph = None
+            for i in sorted(kept + header):
+                paragraph, sentence = sentences[i]
+                if previous_paragraph is not None:
+                    parts.append(' ' if paragraph == previous_paragraph else '\n')
+                parts.append(sentence)
+                previous_paragraph = paragraph
+            condensed = ''.join(parts)
+        return condensed, estimate_tokens(condensed) / original_tokens
+
+    def condense_article(self, article):
+        """Copy of the article with condensed content; the original dict is not modified."""
+        if not article.get('content'):
+            return article
+        condensed, ratio = self.condense(article['content'])
+        if ratio < 1.0:
+            logging.info(f"Condensed {article.get('url') or 'article'}: kept {ratio:.0%} of "
+                         f"{estimate_tokens(article['content'])} estimated tokens")
+        return dict(article, content=condensed)
+
+    def condense_articles(self, articles):
+        condensed = [self.condense_article(article) for article in articles]
+        before = sum(estimate_tokens(a['content']) for a in articles if a.get('content'))
+        after = sum(estimate_tokens(a['content']) for a in condensed if a.get('content'))
+        if before:
+            logging.info(f"Condensed {len(articles)} articles from {before} to {after} estimated tokens "
+                         f"({after / before:.0%})")
+        return condensed
+
+def add_condense_arguments(parser):
+    parser.add_argument('--content-budget', type=int, default=DEFAULT_CONTENT_BUDGET,
+                        help='Estimated tokens of article content to keep per article (0 sends it whole)')
+    parser.add_argument('--ticker', default=None, help='Ticker the articles are about, used to rank sentences')
+    parser.add_argument('--company', default=None, help='Company name the articles are about, used to rank sentences')
+    return parser
+
+def condenser_from_args(args):
+    return ContentCondenser(args.content_budget, ticker=args.ticker, company=args.company)
+
+
+class TestContentCondenser(unittest.TestCase):
+    FILLER = 'The weather in the region stayed mild and the local team won its weekend match again.'
+
+    def article(self, body_lines=60):
+        lines = ['Acme Corp beats estimates', 'March 4, 2024', 'By Jane Doe']
+        for n in range(body_lines):
+            lines.append(self.FILLER)
+            if n == body_lines // 2:
+                lines.append('Acme Corp reported revenue of $12.5 billion, up 8% from a year earlier.')
+        lines.append('Updated 2024-03-05 09:30')
+        return '\n'.join(lines)
+
+    def test_keeps_header_lines_outside_the_budget(self):
+        condenser = ContentCondenser(token_budget=40, ticker='ACME', company='Acme Corp')
+        condensed, ratio = condenser.condense(self.article())
+        self.assertLess(ratio, 1.0)
+        lines = condensed.splitlines()
+        self.assertEqual(lines[:3], ['Acme Corp beats estimates', 'March 4, 2024', 'By Jane Doe'])
+        self.assertIn('Acme Corp reported revenue of $12.5 billion, up 8% from a year earlier.', lines)
+        self.assertEqual(lines[-1], 'Updated 2024-03-05 09:30')
+        self.assertNotIn(self.FILLER, condensed)
+
+    def test_fallback_keeps_header_lines(self):
+        condenser = ContentCondenser(token_budget=40)
+        text = self.article().replace('Acme Corp reported revenue of $12.5 billion, up 8% from a year earlier.', '')
+        condensed, _ = condenser.condense(text)
+        self.assertTrue(condensed.startswith('Acme Corp beats estimates\nMarch 4, 2024\nBy Jane Doe'))
+        self.assertTrue(condensed.endswith('Updated 2024-03-05 09:30'))
+
+    def test_long_first_paragraph_is_not_a_header(self):
+        lead = ' '.join(['Filler words without any figures'] * 20) + '.'
+        self.assertEqual(header_paragraphs(lead + '\nShort line'), {1})
+
+    def test_short_article_is_untouched(self):
+        text = 'Acme Corp beats estimates\nRevenue rose 8%.'
+        self.assertEqual(ContentCondenser().condense(text), (text, 1.0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+import logging
+import sqlite3
+import threading
+import time
+import unittest
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; bodies fall back to zlib without it
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def ensure_dictionary_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB,
+            trained_at REAL
+        )
+    ''')
+    # dict_id is the rowid, so training order has to be recorded separately
+    if 'trained_at' not in column_names(conn, 'compression_dicts'):
+        conn.execute('ALTER TABLE compression_dicts ADD COLUMN trained_at REAL')
+    conn.commit()
+
+class ContentCodec:
+    """
+    Compresses article bodies for storage and decompresses them on read.
+
+    Bodies are written as zstd frames, using the most recently trained dictionary
+    when one exists. Each frame records its dictionary id, and every dictionary is
+    kept in the compression_dicts table, so retraining never orphans old rows.
+    Without the zstandard package, bodies are written with zlib instead.
+    Plain TEXT values from before compression was introduced are returned as-is.
+    """
+
+    def __init__(self, conn=None, level=10):
+        self.level = level
+        self.dicts = {}
+        self.active_dict = None
+        self._local = threading.local()
+        if conn is not None:
+            ensure_dictionary_table(conn)
+            self.load_dictionaries(conn)
+
+    def load_dictionaries(self, conn):
+        if zstandard is None:
+            return
+        for dict_id, data in conn.execute('SELECT dict_id, data FROM compression_dicts ORDER BY trained_at'):
+            self.dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+            self.active_dict = self.dicts[dict_id]
+        if self.dicts:
+            logging.debug(f"Loaded {len(self.dicts)} compression dictionaries")
+
+    def _compressor(self):
+        # zstd compressors are not thread-safe, so each pipeline thread gets its own
+        cached = getattr(self._local, 'compressor', None)
+        if cached is None or cached[0] is not self.active_dict:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.active_dict)
+            cached = (self.active_dict, compressor)
+            self._local.compressor = cached
+        return cached[1]
+
+    def compress(self, text):
+        if text is None:
+            return None
+        data = text.encode('utf-8')
+        if zstandard is None:
+            return zlib.compress(data, 6)
+        return self._compressor().compress(data)
+
+    def decompress(self, blob):
+        if blob is None or isinstance(blob, str):
+            return blob
+        blob = bytes(blob)
+        if blob[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed content")
+            dict_id = zstandard.get_frame_parameters(blob).dict_id
+            dict_data = self.dicts.get(dict_id) if dict_id else None
+            if dict_id and dict_data is None:
+                raise KeyError(f"Compression dictionary {dict_id} is missing")
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(blob).decode('utf-8')
+        return zlib.decompress(blob).decode('utf-8')
+
+def train_dictionary(conn, codec, table, column, sample_limit=5000, dict_size=112640):
+    """
+    Trains a zstd dictionary on stored bodies and makes it the active one for new rows.
+
+    Returns the new dictionary id, or None when zstandard is unavailable or there
+    are too few samples to train on.
+    """
+    if zstandard is None:
+        logging.warning("zstandard is not installed; skipping dictionary training")
+        return None
+
+    samples = []
+    for (blob,) in conn.execute(f'SELECT {column} FROM {table} WHERE {column} IS NOT NULL LIMIT ?', (sample_limit,)):
+        text = codec.decompress(blob)
+        if text:
+            samples.append(text.encode('utf-8'))
+    if len(samples) < 10:
+        logging.warning(f"Only {len(samples)} samples available; skipping dictionary training")
+        return None
+
+    try:
+        dictionary = zstandard.train_dictionary(dict_size, samples)
+    except zstandard.ZstdError as e:
+        logging.error(f"Dictionary training failed: {e}")
+        return None
+
+    ensure_dictionary_table(conn)
+    conn.execute('INSERT OR REPLACE INTO compression_dicts (dict_id, data, trained_at) VALUES (?, ?, ?)',
+                 (dictionary.dict_id(), dictionary.as_bytes(), time.time()))
+    conn.commit()
+    codec.dicts[dictionary.dict_id()] = dictionary
+    codec.active_dict = dictionary
+    logging.info(f"Trained compression dictionary {dictionary.dict_id()} on {len(samples)} samples")
+    return dictionary.dict_id()
+
+def recompress_column(conn, codec, table, key_column, column, batch_size=500):
+    """Rewrites every body in a table with the codec's active dictionary."""
+    rewritten = 0
+    last_key = None
+    while True:
+        if last_key is None:
+            rows = conn.execute(f'SELECT {key_column}, {column} FROM {table} ORDER BY {key_column} LIMIT ?',
+                                (batch_size,)).fetchall()
+        else:
+            rows = conn.execute(f'SELECT {key_column}, {column} FROM {table} WHERE {key_column} > ? '
+                                f'ORDER BY {key_column} LIMIT ?', (last_key, batch_size)).fetchall()
+        if not rows:
+            break
+        conn.executemany(f'UPDATE {table} SET {column} = ? WHERE {key_column} = ?',
+                         [(codec.compress(codec.decompress(blob)), key) for key, blob in rows])
+        conn.commit()
+        rewritten += len(rows)
+        last_key = rows[-1][0]
+    logging.info(f"Recompressed {rewritten} rows in {table}.{column}")
+    return rewritten
+
+def column_names(conn, table):
+    try:
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    except sqlite3.Error:
+        return []
+
+class TestContentCodec(unittest.TestCase):
+    """Bodies survive compression, and rows written under an old dictionary stay readable."""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE articles (url TEXT PRIMARY KEY, content BLOB)')
+        self.bodies = {f'https://reuters.com/story-{i}': f"<p>Shares of company {i} rose {i} percent after "
+                       f"quarterly earnings beat estimates; revenue guidance was raised to {i * 7} million.</p>" * 4
+                       for i in range(200)}
+
+    def tearDown(self):
+        self.conn.close()
+
+    def store(self, codec):
+        self.conn.executemany('INSERT OR REPLACE INTO articles VALUES (?, ?)',
+                              [(url, codec.compress(body)) for url, body in self.bodies.items()])
+        self.conn.commit()
+
+    def stored(self, codec):
+        return {url: codec.decompress(blob) for url, blob in self.conn.execute('SELECT url, content FROM articles')}
+
+    def test_round_trip(self):
+        codec = ContentCodec(self.conn)
+        self.store(codec)
+        self.assertEqual(self.stored(codec), self.bodies)
+        self.assertIsNone(codec.compress(None))
+        self.assertIsNone(codec.decompress(None))
+        self.assertEqual(codec.decompress('<p>stored before compression</p>'), '<p>stored before compression</p>')
+        self.assertEqual(codec.decompress(zlib.compress(b'<p>zlib body</p>')), '<p>zlib body</p>')
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_old_rows_stay_readable_after_retraining(self):
+        codec = ContentCodec(self.conn)
+        self.store(codec)
+        first = train_dictionary(self.conn, codec, 'articles', 'content', dict_size=4096)
+        self.assertIsNotNone(first)
+        recompress_column(self.conn, codec, 'articles', 'url', 'content', batch_size=64)
+        self.bodies['https://reuters.com/late'] = "<p>A story written after the first dictionary.</p>"
+        self.store(codec)
+        second = train_dictionary(self.conn, codec, 'articles', 'content', dict_size=8192)
+        self.assertNotEqual(first, second)
+
+        # A fresh codec only knows what the table holds
+        reopened = ContentCodec(self.conn)
+        self.assertEqual(set(reopened.dicts), {first, second})
+        self.assertEqual(reopened.active_dict.dict_id(), second)
+        self.assertEqual(self.stored(reopened), self.bodies)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_missing_dictionary_is_reported(self):
+        codec = ContentCodec(self.conn)
+        self.store(codec)
+        train_dictionary(self.conn, codec, 'articles', 'content', dict_size=4096)
+        blob = codec.compress("<p>needs the dictionary</p>")
+        with self.assertRaises(KeyError):
+            ContentCodec().decompress(blob)
+
+    def test_too_few_samples_skip_training(self):
+        codec = ContentCodec(self.conn)
+        self.bodies = dict(list(self.bodies.items())[:3])
+        self.store(codec)
+        self.assertIsNone(train_dictionary(self.conn, codec, 'articles', 'content'))
+        self.assertIsNone(codec.active_dict)
+
+    def test_column_names(self):
+        self.assertEqual(column_names(self.conn, 'articles'), ['url', 'content'])
+        self.assertEqual(column_names(self.conn, 'missing'), [])
+
+if __name__ == "__main__":
+    unittest.main()
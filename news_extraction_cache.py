@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+
+def normalize_content(article_text):
+    """Collapses whitespace so trivially re-scraped copies of an article hash the same."""
+    return re.sub(r'\s+', ' ', article_text).strip()
+
+def content_hash(article_text):
+    return hashlib.sha256(normalize_content(article_text).encode('utf-8')).hexdigest()
+
+def prompt_hash(prompt_template, prompt_version):
+    return hashlib.sha256(f"{prompt_version}\n{prompt_template}".encode('utf-8')).hexdigest()[:16]
+
+class ExtractionCache:
+    """
+    Durable cache of successful LLM extractions.
+
+    Entries are keyed by (provider, model, prompt hash, article content hash). The
+    prompt hash covers the template text and PROMPT_VERSION, so editing the prompt
+    or bumping the version misses cleanly instead of serving stale structures.
+    """
+
+    def __init__(self, db_path='extraction_cache.db'):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                provider TEXT,
+                model TEXT,
+                prompt_hash TEXT,
+                content_hash TEXT,
+                result TEXT,
+                created_at REAL,
+                PRIMARY KEY (provider, model, prompt_hash, content_hash)
+            )
+        ''')
+        self.conn.commit()
+
+    def get(self, provider, model, prompt_key, article_text):
+        row = self.conn.execute(
+            'SELECT result FROM extraction_cache WHERE provider = ? AND model = ? AND prompt_hash = ? AND content_hash = ?',
+            (provider, model, prompt_key, content_hash(article_text))
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, provider, model, prompt_key, article_text, result):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO extraction_cache (provider, model, prompt_hash, content_hash, result, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (provider, model, prompt_key, content_hash(article_text), json.dumps(result, ensure_ascii=False), time.time())
+        )
+        self.conn.commit()
+
+    def close(self):
+        logging.info(f"Extraction cache: {self.hits} hits, {self.misses} misses")
+        self.conn.close()
@@ -0,0 +1,839 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from news_extraction_cache import ExtractionCache, normalize_content, prompt_hash
+from news_compact import COMPACT_EXTRACTION_INSTRUCTIONS, COMPACT_OUTPUT_TOKENS, expand_compact
+from news_schema import REPAIR_INSTRUCTIONS, SchemaValidator
+from news_telemetry import METRICS_DB, TelemetryStore
+
+# Bump whenever the extraction instructions change in a way the template text doesn't show
+PROMPT_VERSION = 1
+
+# The instructions are a fixed prefix shared by every request, so providers can cache them;
+# only the article part that follows them changes per call.
+EXTRACTION_INSTRUCTIONS = """You are a financial news analyzer. Your task is to extract structured information from financial news articles and output it in JSON format. Follow these specific guidelines:
+
+1. Output Structure Required:
+{
+    "news_article": {
+        "id": string,            // Create unique based on ticker_date_type
+        "title": string,
+        "publishedDate": string, // ISO format
+        "source": string,
+        "url": string,
+        "type": string          // Type of news article
+    },
+    "company": {
+        "ticker": string,
+        "name": string,
+        "exchange": string
+    },
+    "market_event": {
+        "type": string,         // Main event type
+        "key_points": object,   // Key numerical or factual points
+        "major_shareholders": [ // If ownership related
+            {
+                "name": string,
+                "ownership_percentage": number,
+                "type": string
+            }
+        ]
+    },
+    "analysis": {
+        "key_findings": string[],
+        "sentiment": string,    // positive, negative, neutral
+        "risk_factors": string[]
+    },
+    "event_classification": {
+        "primary_type": string, // Corporate Governance, Financial, Product, Market
+        "sub_type": string,     // More specific classification
+        "severity": number,     // 1-5 scale
+        "confidence": number,   // 0-1 scale
+        "impact_duration": string // SHORT_TERM, MEDIUM_TERM, LONG_TERM
+    }
+}
+
+Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted."""
+
+ARTICLE_TEMPLATE = """Please process the following news article and output the JSON according to these specifications:
+
+{article_text}"""
+
+def extraction_prompt_key(instructions=EXTRACTION_INSTRUCTIONS, article_template=ARTICLE_TEMPLATE):
+    """Cache key component identifying the prompt an extraction was produced with."""
+    return prompt_hash(instructions + "\n" + article_template, PROMPT_VERSION)
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for rate limiting and budgeting."""
+    return len(text) // 4 + 1
+
+def parse_json_response(text, provider):
+    """Parses a model response as JSON, tolerating a surrounding ```json fence."""
+    json_content = re.sub(r'^```json\s*|\s*```$', '', text.strip())
+    try:
+        parsed_response = json.loads(json_content)
+        logging.info(f"Successfully parsed {provider}'s response as JSON")
+        return parsed_response
+    except json.JSONDecodeError as e:
+        logging.error(f"Failed to parse {provider}'s response as JSON: {e}")
+        return {
+            "error": f"Failed to parse {provider}'s response as JSON",
+            "raw_response": text,
+            "parse_error": str(e)
+        }
+
+def article_id(article):
+    """Stable id for an article across runs: derived from its URL when known, otherwise its content."""
+    key = article.get('url') or normalize_content(article.get('content') or '')
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+def is_skipped(result):
+    """True for the record of an article deliberately not extracted (see news_relevance.RelevanceFilter)."""
+    return isinstance(result, dict) and result.get('status') == 'skipped'
+
+class RateLimitError(Exception):
+    """Raised by a backend when the provider answers 429 / quota exhausted."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TransientBackendError(Exception):
+    """Raised by a backend for failures worth retrying (5xx, timeouts, dropped connections)."""
+
+class RateLimiter:
+    """
+    Async requests-per-minute and tokens-per-minute limiter.
+
+    Both budgets refill continuously. On a 429 the effective limits are halved
+    (down to min_fraction of the configured ones) and all callers pause for the
+    provider's retry-after. Each success then restores recovery_step of the
+    configured limit, so throughput settles just under the real quota.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, min_fraction=0.1, recovery_step=0.05):
+        self.max_rpm = requests_per_minute
+        self.max_tpm = tokens_per_minute
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.min_fraction = min_fraction
+        self.recovery_step = recovery_step
+        self.request_allowance = self._request_burst()
+        self.token_allowance = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _request_burst(self):
+        # Allow at most ~5 seconds worth of requests to be sent back to back
+        return max(1.0, self.rpm / 12.0)
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_allowance = min(self._request_burst(), self.request_allowance + elapsed * self.rpm / 60.0)
+        self.token_allowance = min(self.tpm, self.token_allowance + elapsed * self.tpm / 60.0)
+
+    async def acquire(self, tokens):
+        # A single request larger than the whole minute budget could never fit otherwise
+        tokens = min(tokens, self.tpm)
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.request_allowance >= 1 and self.token_allowance >= tokens:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+                else:
+                    wait = max((1 - self.request_allowance) * 60.0 / self.rpm,
+                               (tokens - self.token_allowance) * 60.0 / self.tpm,
+                               0.01)
+            await asyncio.sleep(wait)
+
+    def headroom(self, tokens):
+        """Share of the current request and token allowance left after a call of this size, from 0 to 1."""
+        self._refill(time.monotonic())
+        requests = min(1.0, self.request_allowance / self._request_burst())
+        return max(0.0, min(requests, (self.token_allowance - tokens) / self.tpm))
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Corrects the token budget once the provider reports what a call really cost."""
+        self.token_allowance = min(self.tpm, self.token_allowance + estimated_tokens - actual_tokens)
+
+    def on_rate_limited(self, retry_after=None):
+        self.rpm = max(self.max_rpm * self.min_fraction, self.rpm / 2)
+        self.tpm = max(self.max_tpm * self.min_fraction, self.tpm / 2)
+        pause = retry_after if retry_after else 60.0 / self.rpm
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        logging.warning(f"Rate limited; pausing {pause:.1f}s and lowering limits to "
+                        f"{self.rpm:.0f} RPM / {self.tpm:.0f} TPM")
+
+    def on_success(self):
+        self.rpm = min(self.max_rpm, self.rpm + self.max_rpm * self.recovery_step)
+        self.tpm = min(self.max_tpm, self.tpm + self.max_tpm * self.recovery_step)
+
+def cached_system_prompt(instructions):
+    """System prompt block marked for Anthropic prompt caching; requests sharing it reuse the cached prefix."""
+    return [
+        {
+            "type": "text",
+            "text": instructions,
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+
+class ClaudeBackend:
+    name = 'claude'
+    label = 'Claude'
+    default_requests_per_minute = 50
+    default_tokens_per_minute = 40000
+
+    def __init__(self, model="claude-3-opus-20240229", max_tokens=4000, api_key=None, base_url=None):
+        import anthropic
+
+        api_key = api_key or os.getenv('ANTHROPIC_API_KEY')
+        if not api_key:
+            raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+        self.anthropic = anthropic
+        self.model = model
+        self.max_tokens = max_tokens
+        self.expected_output_tokens = 1000
+        # Retries are handled by the engine so they count against the rate limiter
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0)
+
+    async def complete(self, instructions, user_content):
+        # Streamed only so the first event can be timed; the text is taken from the final message
+        started = time.monotonic()
+        ttfb = None
+        try:
+            async with self.client.messages.stream(
+                model=self.model,
+                max_tokens=self.max_tokens,
+                temperature=0,
+                system=cached_system_prompt(instructions),
+                messages=[
+                    {
+                        "role": "user",
+                        "content": user_content
+                    }
+                ]
+            ) as stream:
+                async for _ in stream:
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started
+                message = await stream.get_final_message()
+        except self.anthropic.RateLimitError as e:
+            retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+            raise RateLimitError(str(e), float(retry_after) if retry_after else None)
+        except (self.anthropic.APIConnectionError, self.anthropic.InternalServerError) as e:
+            raise TransientBackendError(str(e))
+        usage = message.usage
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return {
+            'text': message.content[0].text,
+            'input_tokens': usage.input_tokens + cache_read + cache_write,
+            'cached_input_tokens': cache_read,
+            'cache_write_tokens': cache_write,
+            'output_tokens': usage.output_tokens,
+            'ttfb': ttfb,
+            'finish_reason': message.stop_reason
+        }
+
+    async def close(self):
+        await self.client.close()
+
+class XAIBackend:
+    name = 'xai'
+    label = 'X.AI'
+    default_requests_per_minute = 60
+    default_tokens_per_minute = 100000
+
+    def __init__(self, model="grok-beta", api_key=None, base_url="https://api.x.ai/v1"):
+        import httpx
+
+        api_key = api_key or os.getenv('XAI_API_KEY')
+        if not api_key:
+            raise ValueError("XAI_API_KEY environment variable is not set")
+        self.httpx = httpx
+        self.model = model
+        self.expected_output_tokens = 1000
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {api_key}"
+            },
+            timeout=120.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+
+    async def complete(self, instructions, user_content):
+        # xAI caches repeated prompt prefixes automatically; keeping the instructions
+        # as an identical leading system message is what makes them hit
+        data = {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": instructions
+                },
+                {
+                    "role": "user",
+                    "content": user_content
+                }
+            ],
+            "model": self.model,
+            "stream": False,
+            "temperature": 0
+        }
+        try:
+            # Not streamed: the headers only arrive with the whole completion, so there is no TTFB to report
+            response = await self.client.post("/chat/completions", json=data)
+        except self.httpx.TransportError as e:
+            raise TransientBackendError(str(e))
+        if response.status_code == 429:
+            retry_after = response.headers.get('retry-after')
+            raise RateLimitError(response.text, float(retry_after) if retry_after else None)
+        if response.status_code >= 500:
+            raise TransientBackendError(f"HTTP {response.status_code}: {response.text}")
+        response.raise_for_status()
+        body = response.json()
+        usage = body.get('usage', {})
+        return {
+            'text': body['choices'][0]['message']['content'],
+            'input_tokens': usage.get('prompt_tokens', 0),
+            'cached_input_tokens': (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0),
+            'output_tokens': usage.get('completion_tokens', 0),
+            'finish_reason': body['choices'][0].get('finish_reason')
+        }
+
+    async def close(self):
+        await self.client.aclose()
+
+class GeminiBackend:
+    name = 'gemini'
+    label = 'Gemini'
+    default_requests_per_minute = 60
+    default_tokens_per_minute = 1000000
+
+    def __init__(self, model="gemini-1.5-flash", api_key=None, max_output_tokens=8192):
+        import google.generativeai as genai
+        from google.api_core import exceptions as google_exceptions
+
+        self.genai = genai
+        self.google_exceptions = google_exceptions
+        genai.configure(api_key=api_key or os.environ["GEMINI_API_KEY"])
+        self.model = model
+        self.expected_output_tokens = 1000
+        self.generation_config = {
+            "temperature": 0,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": max_output_tokens,
+            "response_mime_type": "text/plain",
+        }
+        self.clients = {}
+
+    def client_for(self, instructions):
+        """
+        Returns a model bound to the given instructions, creating it on first use.
+
+        The instructions go in the system instruction, a stable prefix on every call.
+        They are far below the 32k tokens Gemini needs before it will create a
+        CachedContent, so no explicit context cache is made.
+        """
+        client = self.clients.get(instructions)
+        if client is None:
+            client = self.genai.GenerativeModel(
+                model_name=self.model,
+                generation_config=self.generation_config,
+                system_instruction=instructions,
+            )
+            self.clients[instructions] = client
+        return client
+
+    async def complete(self, instructions, user_content):
+        started = time.monotonic()
+        ttfb = None
+        try:
+            response = await self.client_for(instructions).generate_content_async(user_content, stream=True)
+            # The response aggregates the chunks, so text and usage are read from it once they are all in
+            async for _ in response:
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+        except self.google_exceptions.ResourceExhausted as e:
+            raise RateLimitError(str(e))
+        except (self.google_exceptions.ServiceUnavailable, self.google_exceptions.InternalServerError,
+                self.google_exceptions.DeadlineExceeded) as e:
+            raise TransientBackendError(str(e))
+        usage = response.usage_metadata
+        return {
+            'text': response.text,
+            'input_tokens': usage.prompt_token_count,
+            'cached_input_tokens': getattr(usage, 'cached_content_token_count', 0) or 0,
+            'output_tokens': usage.candidates_token_count,
+            'ttfb': ttfb,
+            'finish_reason': response.candidates[0].finish_reason.name if response.candidates else None
+        }
+
+    async def close(self):
+        pass
+
+BACKENDS = {
+    'claude': ClaudeBackend,
+    'xai': XAIBackend,
+    'gemini': GeminiBackend,
+}
+
+class ExtractionEngine:
+    """
+    Runs article extraction against one backend with bounded concurrency.
+
+    Up to `concurrency` requests are in flight at once, each admitted by the
+    shared RateLimiter. The instructions are sent as a separate, identical prefix
+    on every call so the backends' prompt caching applies. Rate-limit and
+    transient errors are retried with backoff; everything else becomes an
+    {"error": ...} result for that article rather than an exception. An optional relevance_filter
+    (news_relevance.RelevanceFilter) skips articles unlikely to matter without calling
+    the backend, and an optional condenser (news_condense.ContentCondenser) trims the
+    rest to their relevant sentences first. Parsed results are checked against the
+    extraction schema and invalid fields are repaired with a small follow-up call.
+    With compact=True the model answers in the short-key form of news_compact,
+    which is expanded locally before validation, so callers see the same structure.
+    Each request's tokens, latency, retries and cost go to an optional TelemetryStore.
+    """
+
+    def __init__(self, backend, concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, instructions=EXTRACTION_INSTRUCTIONS, article_template=ARTICLE_TEMPLATE, cache=None,
+                 condenser=None, relevance_filter=None, validator=None, max_repairs=1, telemetry=None,
+                 compact=False):
+        if compact and instructions == EXTRACTION_INSTRUCTIONS:
+            instructions = COMPACT_EXTRACTION_INSTRUCTIONS
+        self.backend = backend
+        self.compact = compact
+        self.telemetry = telemetry
+        self.validator = validator if validator is not None else SchemaValidator()
+        self.max_repairs = max_repairs
+        self.cache = cache
+        self.condenser = condenser
+        self.relevance_filter = relevance_filter
+        self.prompt_key = extraction_prompt_key(instructions, article_template)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.instructions = instructions
+        self.article_template = article_template
+        self.limiter = RateLimiter(requests_per_minute or backend.default_requests_per_minute,
+                                   tokens_per_minute or backend.default_tokens_per_minute)
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(self, instructions, user_content, expected_output_tokens=None, purpose='extract'):
+        """
+        Sends one request through the limiter, retrying rate-limit and transient errors.
+
+        Returns the backend response dict, or an {"error": ...} dict once retries are spent.
+        Every call is recorded in the telemetry store when one is configured. That
+        includes the extra provider calls a routing backend lists under "attempts",
+        such as failovers and hedges that lost the race.
+        """
+        stats = {'retries': 0, 'wait': 0.0, 'latency': 0.0, 'attempts': []}
+        response = await self._call(instructions, user_content, expected_output_tokens, stats)
+        if self.telemetry is not None:
+            for attempt in stats['attempts']:
+                self.telemetry.record(purpose=purpose, **attempt)
+            self.telemetry.record(
+                provider=response.get('provider', self.backend.name),
+                model=response.get('model', self.backend.model),
+                purpose=purpose,
+                input_tokens=response.get('input_tokens'),
+                cached_input_tokens=response.get('cached_input_tokens'),
+                cache_write_tokens=response.get('cache_write_tokens'),
+                output_tokens=response.get('output_tokens'),
+                ttfb=response.get('ttfb'),
+                latency=stats['latency'],
+                wait=stats['wait'],
+                retries=stats['retries'],
+                error=response.get('error'),
+            )
+        return response
+
+    async def _call(self, instructions, user_content, expected_output_tokens, stats):
+        estimated_tokens = (estimate_tokens(instructions) + estimate_tokens(user_content)
+                            + (expected_output_tokens or self.backend.expected_output_tokens))
+        retry_delay = 1
+
+        for attempt in range(self.max_retries):
+            stats['retries'] = attempt
+            async with self.semaphore:
+                queued = time.monotonic()
+                await self.limiter.acquire(estimated_tokens)
+                sent = time.monotonic()
+                stats['wait'] += sent - queued
+                logging.info(f"Sending request to {self.backend.label}")
+                try:
+                    response = await self.backend.complete(instructions, user_content)
+                except RateLimitError as e:
+                    stats['latency'] += time.monotonic() - sent
+                    stats['attempts'].extend(getattr(e, 'attempts', []))
+                    self.limiter.on_rate_limited(e.retry_after)
+                    if attempt < self.max_retries - 1:
+                        continue
+                    logging.error("Max retries reached. Unable to process article.")
+                    return {"error": "Rate limit exceeded"}
+                except TransientBackendError as e:
+                    stats['latency'] += time.monotonic() - sent
+                    stats['attempts'].extend(getattr(e, 'attempts', []))
+                    if attempt < self.max_retries - 1:
+                        logging.warning(f"Request failed. Retrying in {retry_delay} seconds... Error: {str(e)}")
+                        await asyncio.sleep(retry_delay)
+                        stats['wait'] += retry_delay
+                        retry_delay *= 2  # Exponential backoff
+                        continue
+                    logging.error(f"Max retries reached. Unable to process article. Error: {str(e)}")
+                    return {"error": f"Max retries reached. Error: {str(e)}"}
+                except Exception as e:
+                    stats['latency'] += time.monotonic() - sent
+                    stats['attempts'].extend(getattr(e, 'attempts', []))
+                    logging.error(f"An error occurred: {str(e)}")
+                    return {"error": str(e)}
+                stats['latency'] += time.monotonic() - sent
+                stats['attempts'].extend(response.pop('attempts', []))
+
+            logging.info(f"Received response from {self.backend.label}")
+            self.limiter.on_success()
+            self.limiter.record_usage(estimated_tokens, response['input_tokens'] + response['output_tokens'])
+            return response
+
+        return {"error": "Max retries reached"}
+
+    async def extract(self, article_text, url=None):
+        if self.cache is not None:
+            cached = self.cache.get(self.backend.name, self.backend.model, self.prompt_key, article_text)
+            if cached is not None:
+                logging.info(f"Using cached {self.backend.label} extraction")
+                return cached
+
+        response = await self.call(self.instructions, self.article_template.format(article_text=article_text),
+                                   expected_output_tokens=COMPACT_OUTPUT_TOKENS if self.compact else None)
+        if 'error' in response:
+            return response
+        parsed = parse_json_response(response['text'], self.backend.label)
+        if self.compact:
+            parsed = expand_compact(parsed, {'url': url})
+        if 'error' not in parsed and self.validator is not None:
+            parsed = await self.validate(parsed, article_text)
+        if self.cache is not None and 'error' not in parsed and 'validation_errors' not in parsed:
+            self.cache.put(self.backend.name, self.backend.model, self.prompt_key, article_text, parsed)
+        return parsed
+
+    async def validate(self, parsed, article_text):
+        """
+        Checks a parsed extraction against the schema and repairs only the invalid fields.
+
+        Local coercions are tried first. Anything still invalid is sent in a small
+        follow-up request, up to max_repairs times. Fields that stay invalid are
+        listed under "validation_errors" rather than failing the article.
+        """
+        if not isinstance(parsed, dict):
+            return {"error": "Extraction is not a JSON object", "raw_response": parsed}
+        errors = self.validator.coerce(parsed)
+        for attempt in range(self.max_repairs):
+            if not errors:
+                break
+            logging.info(f"Repairing {len(errors)} invalid fields: {', '.join(e['path'] for e in errors)}")
+            response = await self.call(REPAIR_INSTRUCTIONS, self.validator.repair_request(parsed, errors, article_text),
+                                       expected_output_tokens=50 * len(errors), purpose='repair')
+            if 'error' in response:
+                break
+            patch = parse_json_response(response['text'], self.backend.label)
+            if isinstance(patch, dict) and 'error' not in patch:
+                self.validator.apply_patch(parsed, patch, errors)
+            errors = self.validator.coerce(parsed)
+        if errors:
+            logging.warning(f"Extraction still has invalid fields: {', '.join(e['path'] for e in errors)}")
+            parsed['validation_errors'] = [{'path': e['path'], 'error': e['error']} for e in errors]
+        return parsed
+
+    async def run(self, articles, on_result=None):
+        """
+        Extracts every article and returns results in article order.
+
+        Articles without content get an {"error": "Article has no content"} result, and
+        articles the relevance filter turns away get its {"status": "skipped", ...} record.
+        on_result(index, article, result) is called as each article completes.
+        """
+        results = [None] * len(articles)
+        completed = 0
+
+        async def process(i, article):
+            nonlocal completed
+            skip = self.relevance_filter.check(article) if self.relevance_filter and article.get('content') else None
+            if skip is not None:
+                results[i] = skip
+            elif article.get('content'):
+                condensed = self.condenser.condense_article(article) if self.condenser is not None else article
+                results[i] = await self.extract(condensed['content'], article.get('url'))
+            else:
+                logging.warning(f"Article {i+1} has no content, skipping")
+                results[i] = {"error": "Article has no content"}
+            completed += 1
+            logging.info(f"Completed article {i+1} ({completed}/{len(articles)})")
+            if on_result:
+                on_result(i, article, results[i])
+
+        await asyncio.gather(*(process(i, article) for i, article in enumerate(articles)))
+        return results
+
+def extract_articles(backend_name, articles, backend_options=None, on_result=None, use_cache=True,
+                     cache_path='extraction_cache.db', use_metrics=True, metrics_path=METRICS_DB, **engine_options):
+    """Synchronous entry point: builds the backend, runs the engine and closes the client."""
+
+    async def run():
+        backend = BACKENDS[backend_name](**(backend_options or {}))
+        cache = ExtractionCache(cache_path) if use_cache else None
+        telemetry = TelemetryStore(metrics_path) if use_metrics else None
+        try:
+            engine = ExtractionEngine(backend, cache=cache, telemetry=telemetry, **engine_options)
+            return await engine.run(articles, on_result=on_result)
+        finally:
+            await backend.close()
+            if cache is not None:
+                cache.close()
+            if telemetry is not None:
+                logging.info(f"Call metrics for run {telemetry.run_id} written to {metrics_path}")
+                telemetry.close()
+
+    return asyncio.run(run())
+
+def add_engine_arguments(parser):
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum in-flight requests')
+    parser.add_argument('--requests-per-minute', type=int, default=None, help='Provider request quota')
+    parser.add_argument('--tokens-per-minute', type=int, default=None, help='Provider token quota')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore and do not fill the extraction cache')
+    parser.add_argument('--no-metrics', action='store_true', help='Do not record per-call metrics')
+    parser.add_argument('--max-repairs', type=int, default=1,
+                        help='Follow-up requests allowed per article to fix fields that fail schema validation')
+    parser.add_argument('--compact-output', action='store_true',
+                        help='Ask for short-key output and expand it locally; fewer output tokens per article')
+    return parser
+
+def engine_options_from_args(args):
+    return {
+        'concurrency': args.concurrency,
+        'requests_per_minute': args.requests_per_minute,
+        'tokens_per_minute': args.tokens_per_minute,
+        'use_cache': not args.no_cache,
+        'max_repairs': args.max_repairs,
+        'use_metrics': not args.no_metrics,
+        'compact': args.compact_output,
+    }
+
+class ScriptedBackend:
+    """Backend stand-in: raises the scripted errors in turn, then answers with the article it was sent."""
+    name = label = model = 'scripted'
+    default_requests_per_minute = 6000
+    default_tokens_per_minute = 100000000
+    expected_output_tokens = 100
+
+    def __init__(self, errors=(), delay=0.01):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def complete(self, instructions, user_content):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.errors:
+                raise self.errors.pop(0)
+        finally:
+            self.in_flight -= 1
+        return {'text': json.dumps({'article': user_content.rsplit('Article ', 1)[-1].strip()}),
+                'input_tokens': 100, 'output_tokens': 20}
+
+    async def close(self):
+        pass
+
+class AcceptingValidator:
+    """Validator stand-in that finds nothing to repair."""
+
+    def coerce(self, parsed):
+        return []
+
+class TestExtractionEngine(unittest.TestCase):
+    def articles(self, count):
+        return [{'url': f'https://example.com/{i}', 'content': f'Article {i}'} for i in range(count)]
+
+    def test_bounded_concurrency_and_article_order(self):
+        backend = ScriptedBackend()
+        engine = ExtractionEngine(backend, concurrency=3, validator=AcceptingValidator())
+        articles = self.articles(10) + [{'url': 'https://example.com/empty', 'content': ''}]
+        completed = []
+        results = asyncio.run(engine.run(articles, on_result=lambda i, article, result: completed.append(i)))
+        self.assertEqual([result.get('article') for result in results[:10]], [str(i) for i in range(10)])
+        self.assertEqual(results[10], {"error": "Article has no content"})
+        self.assertEqual(sorted(completed), list(range(11)))
+        self.assertEqual(backend.max_in_flight, 3)
+
+    def test_rate_limit_and_transient_errors_are_retried(self):
+        backend = ScriptedBackend([RateLimitError('429', retry_after=0.01), TransientBackendError('503')])
+        engine = ExtractionEngine(backend, concurrency=1, validator=AcceptingValidator())
+        results = asyncio.run(engine.run(self.articles(1)))
+        self.assertEqual(results, [{'article': '0'}])
+        self.assertEqual(backend.calls, 3)
+        self.assertLess(engine.limiter.rpm, engine.limiter.max_rpm)
+
+    def test_other_errors_fail_the_article(self):
+        backend = ScriptedBackend([ValueError('bad request')])
+        engine = ExtractionEngine(backend, validator=AcceptingValidator())
+        self.assertEqual(asyncio.run(engine.run(self.articles(1))), [{"error": "bad request"}])
+        self.assertEqual(backend.calls, 1)
+
+    def test_cached_extraction_skips_the_backend(self):
+        class FlaggingValidator:
+            def coerce(self, parsed):
+                return [{'path': 'article', 'error': 'flagged'}] if parsed.get('article') == '1' else []
+
+        with tempfile.TemporaryDirectory() as workdir:
+            cache = ExtractionCache(os.path.join(workdir, 'cache.db'))
+            try:
+                first = ScriptedBackend()
+                engine = ExtractionEngine(first, cache=cache, validator=FlaggingValidator(), max_repairs=0)
+                asyncio.run(engine.run(self.articles(2)))
+                self.assertEqual(first.calls, 2)
+
+                # Re-scraped whitespace hits the cache; the result with validation errors was not cached
+                second = ScriptedBackend()
+                engine = ExtractionEngine(second, cache=cache, validator=FlaggingValidator(), max_repairs=0)
+                articles = [dict(article, content=f"  {article['content']}\n") for article in self.articles(2)]
+                results = asyncio.run(engine.run(articles))
+                self.assertEqual(second.calls, 1)
+                self.assertEqual(results[0], {'article': '0'})
+                self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+                # A different prompt misses
+                engine = ExtractionEngine(ScriptedBackend(), cache=cache, validator=FlaggingValidator(),
+                                          max_repairs=0, compact=True)
+                self.assertNotEqual(engine.prompt_key, extraction_prompt_key())
+            finally:
+                cache.close()
+
+class StandInGeminiStream:
+    """What generate_content_async(..., stream=True) returns: chunks to iterate, then the aggregated response."""
+
+    def __init__(self, chunks, delay):
+        self.chunks = chunks
+        self.delay = delay
+        self.text = ''.join(chunks)
+        self.usage_metadata = SimpleNamespace(prompt_token_count=900, cached_content_token_count=0,
+                                              candidates_token_count=30)
+        self.candidates = [SimpleNamespace(finish_reason=SimpleNamespace(name='STOP'))]
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(text=chunk)
+
+class StandInClaudeStream:
+    """What messages.stream() returns: an async context manager over events, then the final message."""
+
+    def __init__(self, events, message, delay):
+        self.events = events
+        self.message = message
+        self.delay = delay
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for event in self.events:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(type=event)
+
+    async def get_final_message(self):
+        return self.message
+
+class TestStreamedTimeToFirstByte(unittest.TestCase):
+    """Claude and Gemini engine calls are streamed, so the telemetry row carries a TTFB."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.telemetry = TelemetryStore(os.path.join(self.workdir.name, 'metrics.db'))
+
+    def tearDown(self):
+        self.telemetry.close()
+        self.workdir.cleanup()
+
+    def run_engine(self, backend):
+        engine = ExtractionEngine(backend, validator=AcceptingValidator(), telemetry=self.telemetry)
+
+        async def run():
+            try:
+                return await engine.run([{'url': 'https://example.com/0', 'content': 'Article 0'}])
+            finally:
+                await backend.close()
+
+        results = asyncio.run(run())
+        rows = self.telemetry.conn.execute(
+            'SELECT input_tokens, output_tokens, ttfb_ms, latency_ms, status FROM llm_calls').fetchall()
+        return results, rows
+
+    def test_claude_stream(self):
+        backend = ClaudeBackend(api_key='test-key')
+        usage = SimpleNamespace(input_tokens=10, cache_read_input_tokens=800, cache_creation_input_tokens=0,
+                                output_tokens=12)
+        message = SimpleNamespace(content=[SimpleNamespace(text=json.dumps({'article': '0'}))], usage=usage,
+                                  stop_reason='end_turn')
+        stream = StandInClaudeStream(['message_start', 'content_block_delta', 'message_stop'], message, delay=0.05)
+        sent = []
+
+        def messages_stream(**params):
+            sent.append(params)
+            return stream
+
+        backend.client = SimpleNamespace(messages=SimpleNamespace(stream=messages_stream),
+                                         close=backend.client.close)
+        results, rows = self.run_engine(backend)
+        self.assertEqual(sent[0]['system'], cached_system_prompt(EXTRACTION_INSTRUCTIONS))
+        self.assertEqual(results, [{'article': '0'}])
+        (input_tokens, output_tokens, ttfb_ms, latency_ms, status), = rows
+        self.assertEqual((input_tokens, output_tokens, status), (810, 12, 'ok'))
+        self.assertIsNotNone(ttfb_ms)
+        self.assertLess(ttfb_ms, latency_ms - 50)
+
+    def test_gemini_stream(self):
+        backend = GeminiBackend(api_key='test-key')
+        response = StandInGeminiStream(['{"article"', ': "0"}'], delay=0.05)
+        sent = []
+
+        async def generate_content_async(content, stream=False):
+            sent.append(stream)
+            return response
+
+        backend.client_for = lambda instructions: SimpleNamespace(generate_content_async=generate_content_async)
+        results, rows = self.run_engine(backend)
+        self.assertEqual(sent, [True])
+        self.assertEqual(results, [{'article': '0'}])
+        (input_tokens, output_tokens, ttfb_ms, latency_ms, status), = rows
+        self.assertEqual((input_tokens, output_tokens, status), (900, 30, 'ok'))
+        self.assertIsNotNone(ttfb_ms)
+        self.assertLess(ttfb_ms, latency_ms - 25)
+
+if __name__ == "__main__":
+    unittest.main()
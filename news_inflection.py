@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import math
+import unittest
+import numpy as np
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from dotenv import load_dotenv
+from news_extraction_engine import BACKENDS, ExtractionEngine, article_id, parse_json_response
+from news_schema import parse_date
+from news_telemetry import METRICS_DB, TelemetryStore
+
+DEFAULT_WINDOW_DAYS = 90
+DEFAULT_TOP_K = 10
+ARTICLE_DATE_FIELDS = ('timestamp', 'publishedDate', 'published_at', 'time_published', 'date')
+
+def article_date(article):
+    """Publish date of a scraped article from whichever date field its source filled in, or None."""
+    for field in ARTICLE_DATE_FIELDS:
+        value = article.get(field)
+        if isinstance(value, str) and value.strip():
+            parsed = parse_date(value)
+            if parsed:
+                return date.fromisoformat(parsed[:10])
+    return None
+
+class InflectionIndex:
+    """
+    Inflection points sorted by date, for looking up the ones near a range of dates.
+
+    The points are sorted once. window() then finds each range with two bisections
+    over the ordinal dates, so a lookup costs O(log n) plus the points returned.
+    Only date and price are kept; they are the only fields the prompt needs.
+    """
+
+    def __init__(self, points, window_days=DEFAULT_WINDOW_DAYS):
+        self.window_days = window_days
+        dated = sorted(((date.fromisoformat(str(p['date'])[:10]), p) for p in points), key=lambda item: item[0])
+        self.ordinals = [d.toordinal() for d, _ in dated]
+        self.points = [{'date': d.isoformat(), 'price': p.get('price')} for d, p in dated]
+
+    @classmethod
+    def load(cls, path, window_days=DEFAULT_WINDOW_DAYS):
+        with open(path, 'r') as f:
+            return cls(json.load(f), window_days)
+
+    def __len__(self):
+        return len(self.points)
+
+    def window(self, start, end):
+        """
+        Points dated within window_days of [start, end].
+
+        When none fall inside, the nearest point on either side is returned instead,
+        so the model always has something to rank against.
+        """
+        low = bisect_left(self.ordinals, (start - timedelta(days=self.window_days)).toordinal())
+        high = bisect_right(self.ordinals, (end + timedelta(days=self.window_days)).toordinal())
+        if low == high:
+            low, high = max(low - 1, 0), min(high + 1, len(self.points))
+        return self.points[low:high]
+
+    def for_articles(self, articles):
+        """Points relevant to a group of articles; every point when none of them has a usable date."""
+        dates = [d for d in (article_date(a) for a in articles) if d is not None]
+        if not dates:
+            return list(self.points)
+        return self.window(min(dates), max(dates))
+
+def sort_by_date(indexed_articles):
+    """Orders (index, article) pairs by publish date, undated articles last, so packed batches span little time."""
+    def key(item):
+        published = article_date(item[1])
+        return (published is None, published or date.min, item[0])
+    return sorted(indexed_articles, key=key)
+
+SENTIMENT_SIGNS = {'positive': 1, 'negative': -1, 'neutral': 0}
+# Weight by how an article's sentiment lines up with the price move: contrary, neutral or unknown, agreeing
+DIRECTION_WEIGHTS = np.array([0.2, 0.5, 1.0], dtype=np.float32)
+# Weight by the extracted company: another company, not extracted, the ticker being ranked
+TICKER_WEIGHTS = np.array([0.3, 0.6, 1.0], dtype=np.float32)
+
+RANKING_INSTRUCTIONS = """You are a financial news analyst. You are given one inflection point of a stock's price, with the price move into and out of it, and candidate news articles that a local pre-ranking placed near it.
+
+For each candidate that plausibly helps explain the price move at this inflection point, based on its event classification, specific impact on financials and market sentiment, rank its relevance (1 being most relevant) and give a concise chain of thought (140 characters) explaining the relevance. Leave out candidates that do not relate to the move.
+
+Output only a JSON array of objects {"article_index": number, "relevance_ranking": number, "reasoning": string}, with no additional explanation or commentary."""
+
+def load_extractions(articles, ledger_paths):
+    """Latest successful extraction per article position from the given ledgers; articles without one are absent."""
+    position_by_id = {article_id(a): i for i, a in enumerate(articles)}
+    latest = {}
+    for path in ledger_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('status') != 'success' or entry.get('article_id') not in position_by_id:
+                    continue
+                current = latest.get(entry['article_id'])
+                if current is None or entry.get('recorded_at', 0) >= current.get('recorded_at', 0):
+                    latest[entry['article_id']] = entry
+    return {position_by_id[entry_id]: entry['result'] for entry_id, entry in latest.items()
+            if isinstance(entry.get('result'), dict)}
+
+def as_number(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class InflectionJoin:
+    """
+    Deterministic pre-ranking of articles against inflection points, over the whole corpus at once.
+
+    Articles are reduced to arrays (publish ordinal, sentiment sign, ticker match,
+    impact) and scored against every point in one articles x points matrix:
+
+        score = proximity * direction weight * ticker weight * impact
+
+    Proximity decays exponentially with the distance in days and is zero outside
+    the index's window. The direction weight compares the article's sentiment
+    with the price move into the point for articles published up to its date, and
+    with the move out of it for later ones. Impact is severity / 5 * confidence
+    from the extraction. Articles that were not extracted still rank on timing alone.
+    """
+
+    def __init__(self, index, ticker, top_k=DEFAULT_TOP_K):
+        self.index = index
+        self.ticker = ticker.upper()
+        self.top_k = top_k
+        self.ordinals = np.array(index.ordinals, dtype=np.int64)
+        self.prices = np.array([as_number(p['price'], np.nan) for p in index.points], dtype=np.float64)
+        moves = np.sign(np.nan_to_num(np.diff(self.prices)))
+        self.move_in = np.concatenate([[0.0], moves]).astype(np.int8)
+        self.move_out = np.concatenate([moves, [0.0]]).astype(np.int8)
+
+    def features(self, articles, extractions):
+        """Per-article arrays: publish ordinal (-1 when unknown), sentiment sign, ticker class and impact."""
+        count = len(articles)
+        ordinals = np.full(count, -1, dtype=np.int64)
+        sentiment = np.zeros(count, dtype=np.int8)
+        ticker_class = np.ones(count, dtype=np.int8)
+        impact = np.full(count, 0.3, dtype=np.float32)
+        for i, article in enumerate(articles):
+            result = extractions.get(i) or {}
+            published = (result.get('news_article') or {}).get('publishedDate')
+            parsed = parse_date(published) if isinstance(published, str) and published.strip() else None
+            published = date.fromisoformat(parsed[:10]) if parsed else article_date(article)
+            if published is not None:
+                ordinals[i] = published.toordinal()
+            if not result:
+                continue
+            sentiment[i] = SENTIMENT_SIGNS.get(str((result.get('analysis') or {}).get('sentiment')).lower(), 0)
+            ticker = (result.get('company') or {}).get('ticker')
+            if ticker:
+                ticker_class[i] = 2 if str(ticker).upper() == self.ticker else 0
+            classification = result.get('event_classification') or {}
+            impact[i] = (min(max(as_number(classification.get('severity'), 3.0), 1.0), 5.0) / 5
+                         * min(max(as_number(classification.get('confidence'), 0.5), 0.0), 1.0))
+        return ordinals, sentiment, ticker_class, impact
+
+    def scores(self, ordinals, sentiment, ticker_class, impact):
+        """articles x points float32 score matrix; zero where an article is undated or outside the window."""
+        distance = ordinals[:, None] - self.ordinals[None, :]
+        proximity = np.exp(-np.abs(distance) / (self.index.window_days / 2)).astype(np.float32)
+        proximity[(np.abs(distance) > self.index.window_days) | (ordinals[:, None] < 0)] = 0
+        move = np.where(distance <= 0, self.move_in[None, :], self.move_out[None, :])
+        direction = DIRECTION_WEIGHTS[sentiment[:, None] * move + 1]
+        return proximity * direction * TICKER_WEIGHTS[ticker_class][:, None] * impact[:, None]
+
+    def rank(self, articles, extractions):
+        """One entry per inflection point with its top_k candidate articles, best first."""
+        matrix = self.scores(*self.features(articles, extractions))
+        k = min(self.top_k, len(articles))
+        if k:
+            top = np.argpartition(-matrix, k - 1, axis=0)[:k]
+        ranked = []
+        for j, point in enumerate(self.index.points):
+            candidates = []
+            if k:
+                for i in sorted(top[:, j], key=lambda i: -matrix[i, j]):
+                    if matrix[i, j] <= 0:
+                        continue
+                    result = extractions.get(int(i)) or {}
+                    candidates.append({
+                        'article_index': int(i),
+                        'url': articles[i].get('url'),
+                        'title': (result.get('news_article') or {}).get('title'),
+                        'sentiment': (result.get('analysis') or {}).get('sentiment'),
+                        'score': round(float(matrix[i, j]), 4),
+                    })
+            ranked.append(dict(point, move_in=int(self.move_in[j]), move_out=int(self.move_out[j]),
+                               candidates=candidates))
+        logging.info(f"Pre-ranked {len(articles)} articles against {len(ranked)} inflection points; "
+                     f"{sum(len(r['candidates']) for r in ranked)} candidates kept")
+        return ranked
+
+def ranking_request(point, extractions, ticker):
+    """User content asking the model to confirm one point's candidates."""
+    moves = {1: 'a rise', -1: 'a fall', 0: 'no change'}
+    lines = [f"Inflection point for {ticker}: {point['date']} at {point['price']}, after {moves[point['move_in']]} "
+             f"and before {moves[point['move_out']]}.", "", "Candidate articles:"]
+    for candidate in point['candidates']:
+        result = extractions.get(candidate['article_index']) or {}
+        news_article = result.get('news_article') or {}
+        findings = '; '.join((result.get('analysis') or {}).get('key_findings') or [])
+        event = result.get('event_classification') or {}
+        lines.append(f"[ARTICLE {candidate['article_index']}] {news_article.get('publishedDate')} | "
+                     f"{(result.get('company') or {}).get('ticker')} | {candidate['sentiment']} | "
+                     f"{event.get('primary_type')}/{event.get('sub_type')} | {candidate['title'] or candidate['url']}")
+        if findings:
+            lines.append(f"  Key findings: {findings}")
+    return '\n'.join(lines)
+
+async def confirm_candidates(engine, ranked, extractions, ticker):
+    """
+    Has the model confirm and explain each point's top candidates, one small request per point.
+
+    Confirmed candidates get relevance_ranking and reasoning and are listed first;
+    the others are kept with confirmed False. A point whose request fails keeps
+    its local ranking unchanged.
+    """
+    async def confirm(point):
+        if not point['candidates']:
+            return
+        response = await engine.call(RANKING_INSTRUCTIONS, ranking_request(point, extractions, ticker),
+                                     expected_output_tokens=60 * len(point['candidates']), purpose='rank')
+        if 'error' in response:
+            logging.warning(f"Keeping the local ranking for {point['date']}: {response['error']}")
+            return
+        confirmed = parse_json_response(response['text'], engine.backend.label)
+        if not isinstance(confirmed, list):
+            return
+        by_index = {c.get('article_index'): c for c in confirmed if isinstance(c, dict)}
+        for candidate in point['candidates']:
+            match = by_index.get(candidate['article_index'])
+            candidate['confirmed'] = match is not None
+            if match is not None:
+                candidate['relevance_ranking'] = match.get('relevance_ranking')
+                candidate['reasoning'] = match.get('reasoning')
+        point['candidates'].sort(key=lambda c: (not c['confirmed'], as_number(c.get('relevance_ranking'), 0)))
+
+    await asyncio.gather(*(confirm(point) for point in ranked))
+    return ranked
+
+def add_inflection_arguments(parser):
+    parser.add_argument('--inflection-window-days', type=int, default=DEFAULT_WINDOW_DAYS,
+                        help='Only relate articles and inflection points at most this many days apart')
+    return parser
+
+class TestInflectionIndex(unittest.TestCase):
+    def setUp(self):
+        points = [{'date': d, 'price': p, 'note': 'dropped'} for d, p in
+                  [('2024-06-01', 80.0), ('2024-01-15', 60.0), ('2024-03-01T00:00:00', 70.0), ('2023-06-01', 50.0)]]
+        self.index = InflectionIndex(points, window_days=30)
+
+    def test_points_are_sorted_and_trimmed(self):
+        self.assertEqual(self.index.points[0], {'date': '2023-06-01', 'price': 50.0})
+        self.assertEqual([p['date'] for p in self.index.points], ['2023-06-01', '2024-01-15', '2024-03-01', '2024-06-01'])
+
+    def test_window_and_nearest_fallback(self):
+        self.assertEqual([p['date'] for p in self.index.window(date(2024, 2, 1), date(2024, 2, 10))],
+                         ['2024-01-15', '2024-03-01'])
+        self.assertEqual([p['date'] for p in self.index.window(date(2024, 4, 15), date(2024, 4, 15))],
+                         ['2024-03-01', '2024-06-01'])
+        self.assertEqual([p['date'] for p in self.index.window(date(2030, 1, 1), date(2030, 1, 2))], ['2024-06-01'])
+
+    def test_for_articles(self):
+        articles = [{'timestamp': '2024-05-20 10:00:00'}, {'publishedDate': 'not a date'}]
+        self.assertEqual([p['date'] for p in self.index.for_articles(articles)], ['2024-06-01'])
+        self.assertEqual(len(self.index.for_articles(articles[1:])), 4)
+
+    def test_sort_by_date_puts_undated_last(self):
+        indexed = [(0, {'date': '2024-03-02'}), (1, {}), (2, {'published_at': '2024-03-01T09:00:00Z'}),
+                   (3, {'date': '2024-03-02'})]
+        self.assertEqual([i for i, _ in sort_by_date(indexed)], [2, 0, 3, 1])
+
+class TestInflectionJoin(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        start = date(2023, 1, 1).toordinal()
+        self.index = InflectionIndex([{'date': date.fromordinal(start + int(d)).isoformat(), 'price': float(p)}
+                                      for d, p in zip(rng.choice(700, 12, replace=False), rng.uniform(40, 90, 12))],
+                                     window_days=45)
+        self.articles, self.extractions = [], {}
+        for i in range(80):
+            published = date.fromordinal(start + int(rng.integers(-30, 730))).isoformat()
+            self.articles.append({'url': f'https://example.com/{i}', 'date': published if i % 7 else None})
+            if i % 3:
+                self.extractions[i] = {
+                    'news_article': {'title': f'Story {i}', 'publishedDate': published if i % 5 else None},
+                    'company': {'ticker': ['OXY', 'oxy', 'CVX', None][i % 4]},
+                    'analysis': {'sentiment': ['positive', 'negative', 'neutral', 'Positive'][i % 4]},
+                    'event_classification': {'severity': int(rng.integers(1, 6)), 'confidence': float(rng.random())},
+                }
+
+    def loop_score(self, join, article, result, point_index):
+        """One article against one point, written out as the class docstring states it."""
+        published = ((result.get('news_article') or {}).get('publishedDate')
+                     or article.get('date'))
+        if not published:
+            return 0.0
+        distance = date.fromisoformat(published).toordinal() - self.index.ordinals[point_index]
+        if abs(distance) > self.index.window_days:
+            return 0.0
+        proximity = math.exp(-abs(distance) / (self.index.window_days / 2))
+        move = join.move_in[point_index] if distance <= 0 else join.move_out[point_index]
+        sentiment = SENTIMENT_SIGNS.get(str((result.get('analysis') or {}).get('sentiment')).lower(), 0)
+        direction = [0.2, 0.5, 1.0][sentiment * move + 1]
+        ticker = (result.get('company') or {}).get('ticker')
+        ticker_weight = 0.6 if not result or not ticker else (1.0 if ticker.upper() == 'OXY' else 0.3)
+        classification = result.get('event_classification') or {}
+        impact = (classification['severity'] / 5 * classification['confidence']) if result else 0.3
+        return proximity * direction * ticker_weight * impact
+
+    def test_matrix_matches_per_pair_scores(self):
+        join = InflectionJoin(self.index, 'oxy')
+        matrix = join.scores(*join.features(self.articles, self.extractions))
+        self.assertEqual(matrix.shape, (len(self.articles), len(self.index)))
+        for i, article in enumerate(self.articles):
+            for j in range(len(self.index)):
+                expected = self.loop_score(join, article, self.extractions.get(i) or {}, j)
+                self.assertAlmostEqual(float(matrix[i, j]), expected, places=5, msg=(i, j))
+
+    def test_rank_keeps_the_best_top_k(self):
+        join = InflectionJoin(self.index, 'OXY', top_k=3)
+        matrix = join.scores(*join.features(self.articles, self.extractions))
+        ranked = join.rank(self.articles, self.extractions)
+        self.assertEqual(len(ranked), len(self.index))
+        for j, point in enumerate(ranked):
+            scores = [c['score'] for c in point['candidates']]
+            expected = sorted((float(v) for v in matrix[:, j] if v > 0), reverse=True)[:3]
+            self.assertEqual(scores, [round(v, 4) for v in expected])
+            for candidate in point['candidates']:
+                self.assertEqual(candidate['url'], self.articles[candidate['article_index']]['url'])
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Pre-rank articles against inflection points and confirm the top candidates")
+    parser.add_argument('--ticker', default='OXY', help='Ticker the inflection points belong to')
+    parser.add_argument('--articles', default='scraped_articles_results.json', help='Scraped articles file')
+    parser.add_argument('--ledgers', nargs='*', default=None,
+                        help='Extraction ledgers to read results from (default: every extraction_ledger_*.jsonl)')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='Candidates kept per inflection point')
+    parser.add_argument('--backend', default=None, choices=sorted(BACKENDS),
+                        help='Backend that confirms the top candidates (default: local ranking only)')
+    add_inflection_arguments(parser)
+    args = parser.parse_args()
+
+    with open(args.articles, 'r', encoding='utf-8') as f:
+        scraped_articles = json.load(f)['successful_articles']
+    ledger_paths = args.ledgers if args.ledgers is not None else sorted(glob.glob('extraction_ledger_*.jsonl'))
+    extractions = load_extractions(scraped_articles, ledger_paths)
+    logging.info(f"Loaded {len(extractions)} extractions for {len(scraped_articles)} articles "
+                 f"from {len(ledger_paths)} ledgers")
+    join = InflectionJoin(InflectionIndex.load(f'inflection_points_{args.ticker}.json', args.inflection_window_days),
+                          args.ticker, args.top_k)
+    ranked = join.rank(scraped_articles, extractions)
+
+    if args.backend:
+        async def run():
+            backend = BACKENDS[args.backend]()
+            telemetry = TelemetryStore(METRICS_DB)
+            try:
+                return await confirm_candidates(ExtractionEngine(backend, telemetry=telemetry), ranked,
+                                                extractions, args.ticker)
+            finally:
+                await backend.close()
+                telemetry.close()
+        ranked = asyncio.run(run())
+
+    output_file = f'inflection_candidates_{args.ticker}.json'
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(ranked, f, indent=2, ensure_ascii=False)
+    logging.info(f"Ranked candidates saved to {output_file}")
@@ -0,0 +1,172 @@
+import json
+import re
+import unittest
+
+# "x" is article_index in the compact output form (news_compact)
+ARTICLE_INDEX_PATTERN = re.compile(r'"(?:article_index|x)"\s*:\s*(\d+)')
+
+class IncrementalArrayParser:
+    """
+    Incrementally splits a streamed JSON array into its top-level elements.
+
+    feed() accepts response chunks as they arrive and returns every element that
+    completed within them, as soon as its closing brace is seen. Elements are
+    decoded one at a time, so a malformed character only costs the element that
+    contains it. Text before the array (such as a ```json fence) and after it is
+    ignored. A response that is a bare object, or several, is handled the same way,
+    and is complete once its last object closes.
+
+    An element that loses its closing brace is cut off where the next element's
+    "{" appears in place of a key, or at a bracket that does not match, so the
+    elements after it still decode.
+
+    Each returned item is either ('object', value, raw) or ('malformed', error, raw).
+    """
+
+    def __init__(self):
+        self.started = False
+        self.finished = False
+        self.bare = False
+        self.stack = []
+        self.last = None
+        self.in_string = False
+        self.escaped = False
+        self.element = []
+        self.objects = 0
+        self.malformed = 0
+
+    def feed(self, chunk):
+        completed = []
+        for char in chunk:
+            if self.finished:
+                break
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                    continue
+                if char != '{':
+                    continue
+                # No enclosing array: treat the response as a sequence of bare objects
+                self.started = True
+                self.bare = True
+
+            if not self.stack:
+                if char == ']' and not self.bare:
+                    self.finished = True
+                    continue
+                if char != '{':
+                    # Separators between elements, and any trailing text after bare objects
+                    continue
+
+            if self.in_string:
+                self.element.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == '{' and self.stack and self.stack[-1] == '{' and self.last in ('{', ','):
+                # A "{" where a key belongs: the element before it never closed
+                completed.append(self._flush())
+            elif char in '}]':
+                if self.stack[-1] != ('{' if char == '}' else '['):
+                    completed.append(self._flush())
+                    if char == ']' and not self.bare:
+                        self.finished = True
+                    continue
+
+            self.element.append(char)
+            if not char.isspace():
+                self.last = char
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.stack.append(char)
+            elif char in '}]':
+                self.stack.pop()
+                if not self.stack:
+                    completed.append(self._flush())
+        return completed
+
+    def _flush(self):
+        raw = ''.join(self.element)
+        self.element = []
+        self.stack = []
+        self.last = None
+        return self._decode(raw)
+
+    def _decode(self, raw):
+        # Same trailing-comma cleanup the whole-response parser used to apply
+        cleaned = re.sub(r',(\s*[}\]])', r'\1', raw)
+        try:
+            value = json.loads(cleaned)
+        except json.JSONDecodeError as e:
+            self.malformed += 1
+            return ('malformed', str(e), raw)
+        self.objects += 1
+        return ('object', value, raw)
+
+    @property
+    def truncated(self):
+        """True when the stream ended inside the array, or inside a bare object."""
+        if self.bare:
+            return bool(self.element)
+        return not self.finished
+
+    def pending_text(self):
+        """The incomplete element at the end of a truncated stream, if any."""
+        return ''.join(self.element)
+
+def article_index_of(raw):
+    """Recovers the article_index from an element that failed to decode, when it is legible."""
+    match = ARTICLE_INDEX_PATTERN.search(raw)
+    return int(match.group(1)) if match else None
+
+class TestIncrementalArrayParser(unittest.TestCase):
+    def parse(self, text, chunk_size=7):
+        parser = IncrementalArrayParser()
+        items = []
+        for i in range(0, len(text), chunk_size):
+            items.extend(parser.feed(text[i:i+chunk_size]))
+        return parser, items
+
+    def test_array_split_across_chunks(self):
+        text = '```json\n[{"article_index": 0, "note": "a } in [a] string"},\n {"article_index": 1, "n": [1, 2],}]\n```'
+        parser, items = self.parse(text)
+        self.assertEqual([value for _, value, _ in items],
+                         [{"article_index": 0, "note": "a } in [a] string"}, {"article_index": 1, "n": [1, 2]}])
+        self.assertFalse(parser.truncated)
+
+    def test_bare_object_is_complete(self):
+        parser, items = self.parse('```json\n{"article_index": 3, "company": {"ticker": "OXY"}}\n```')
+        self.assertEqual([kind for kind, _, _ in items], ['object'])
+        self.assertFalse(parser.truncated)
+        parser, _ = self.parse('{"article_index": 3, "company": {"ticker": "OX')
+        self.assertTrue(parser.truncated)
+
+    def test_missing_brace_costs_only_its_element(self):
+        text = ('[{"article_index": 0, "company": {"ticker": "OXY"},\n'
+                ' {"article_index": 1, "company": {"ticker": "CVX"}},\n'
+                ' {"article_index": 2, "company": {"ticker": "XOM"}}]')
+        parser, items = self.parse(text)
+        self.assertEqual([kind for kind, _, _ in items], ['malformed', 'object', 'object'])
+        self.assertEqual(article_index_of(items[0][2]), 0)
+        self.assertEqual([value['article_index'] for kind, value, _ in items if kind == 'object'], [1, 2])
+        self.assertFalse(parser.truncated)
+
+    def test_missing_brace_before_the_closing_bracket(self):
+        parser, items = self.parse('[{"article_index": 0}, {"article_index": 1, "x": {"a": 1}]')
+        self.assertEqual([kind for kind, _, _ in items], ['object', 'malformed'])
+        self.assertFalse(parser.truncated)
+
+    def test_truncated_array(self):
+        parser, items = self.parse('[{"article_index": 0}, {"article_index": 1, "summary": "cut of')
+        self.assertEqual(len(items), 1)
+        self.assertTrue(parser.truncated)
+        self.assertEqual(article_index_of(parser.pending_text()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import re
+import unittest
+import zlib
+from collections import Counter
+import numpy as np
+from news_extraction_engine import article_id
+
+RELEVANCE_MODEL_FILE = 'relevance_model.npz'
+DEFAULT_RELEVANCE_THRESHOLD = 0.2
+N_FEATURES = 2 ** 18
+MIN_RELEVANT_CONFIDENCE = 0.6
+
+TOKEN_PATTERN = re.compile(r"[$€£]?\d[\d,.]*%?|[a-z][a-z'&-]*")
+
+def tokenize(text):
+    """Lowercased words plus coarse shapes for figures, so '$7.2' and '$9.1' share a feature."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token[0] in '$€£':
+            tokens.append('<money>')
+        elif token.endswith('%'):
+            tokens.append('<pct>')
+        elif token[0].isdigit():
+            tokens.append('<num>')
+        elif len(token) > 1:
+            tokens.append(token)
+    return tokens
+
+def hashed_counts(text, n_features=N_FEATURES):
+    """Unigram and bigram counts hashed into n_features buckets (crc32, stable across runs)."""
+    tokens = tokenize(text)
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return Counter(zlib.crc32(gram.encode('utf-8')) % n_features for gram in grams)
+
+def is_relevant(result, min_confidence=MIN_RELEVANT_CONFIDENCE):
+    """Label derived from a past extraction: a confident, classified event about an identified company."""
+    classification = result.get('event_classification') or {}
+    company = result.get('company') or {}
+    try:
+        confidence = float(classification.get('confidence') or 0)
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return bool(confidence >= min_confidence and classification.get('primary_type') and company.get('ticker'))
+
+def load_training_examples(articles, ledger_paths):
+    """
+    Pairs article content with the extraction each ledger recorded for it.
+
+    Returns (text, relevant, primary_type) tuples. Failed extractions carry no
+    label and are left out; when several ledgers hold the same article the most
+    recent entry wins.
+    """
+    content_by_id = {article_id(a): a['content'] for a in articles if a.get('content')}
+    latest = {}
+    for path in ledger_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('status') != 'success' or entry.get('article_id') not in content_by_id:
+                    continue
+                current = latest.get(entry['article_id'])
+                if current is None or entry.get('recorded_at', 0) >= current.get('recorded_at', 0):
+                    latest[entry['article_id']] = entry
+
+    examples = []
+    for current_id, entry in latest.items():
+        result = entry['result']
+        if not isinstance(result, dict):
+            continue
+        primary_type = (result.get('event_classification') or {}).get('primary_type')
+        examples.append((content_by_id[current_id], is_relevant(result), primary_type))
+    return examples
+
+def train_softmax(rows, labels, n_classes, n_features, epochs=8, learning_rate=0.5, l2=1e-6, seed=0):
+    """
+    Multinomial logistic regression fitted by SGD over sparse (indices, values) rows.
+
+    Classes are weighted inversely to their frequency so a corpus dominated by
+    market wraps still learns what a relevant article looks like.
+    """
+    weights = np.zeros((n_features, n_classes), dtype=np.float32)
+    bias = np.zeros(n_classes, dtype=np.float32)
+    labels = np.asarray(labels)
+    class_counts = np.bincount(labels, minlength=n_classes).astype(np.float32)
+    class_weights = len(labels) / (n_classes * np.maximum(class_counts, 1))
+    rng = np.random.default_rng(seed)
+
+    for epoch in range(epochs):
+        rate = learning_rate / (1 + epoch)
+        for i in rng.permutation(len(rows)):
+            indices, values = rows[i]
+            logits = values @ weights[indices] + bias
+            probabilities = np.exp(logits - logits.max())
+            probabilities /= probabilities.sum()
+            gradient = probabilities
+            gradient[labels[i]] -= 1
+            gradient *= class_weights[labels[i]]
+            weights[indices] -= rate * (np.outer(values, gradient) + l2 * weights[indices])
+            bias -= rate * gradient
+    return weights, bias
+
+class RelevanceClassifier:
+    """
+    Cheap local scorer for whether an article is worth a paid extraction.
+
+    Articles become TF-IDF vectors over hashed unigrams and bigrams. Two linear
+    models are trained on past extraction outputs. One predicts relevance: a
+    confident event classification about an identified company. The other predicts
+    the event's primary_type. Scoring needs only NumPy and takes well under a
+    millisecond per article.
+    """
+
+    def __init__(self, idf, relevance_weights, relevance_bias, type_weights=None, type_bias=None, type_classes=()):
+        self.idf = idf
+        self.n_features = len(idf)
+        self.relevance_weights = relevance_weights
+        self.relevance_bias = relevance_bias
+        self.type_weights = type_weights
+        self.type_bias = type_bias
+        self.type_classes = list(type_classes)
+
+    @staticmethod
+    def vectorize(text, idf):
+        counts = hashed_counts(text, len(idf))
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter((1 + math.log(c) for c in counts.values()), dtype=np.float32, count=len(counts))
+        values *= idf[indices]
+        norm = np.linalg.norm(values)
+        return indices, values / norm if norm else values
+
+    @classmethod
+    def train(cls, examples, n_features=N_FEATURES, **train_options):
+        if len(examples) < 20:
+            raise ValueError(f"Need at least 20 labelled articles to train, found {len(examples)}")
+        if len({relevant for _, relevant, _ in examples}) < 2:
+            raise ValueError("Training data has only one relevance class")
+
+        document_frequency = np.zeros(n_features, dtype=np.float32)
+        for text, _, _ in examples:
+            document_frequency[list(hashed_counts(text, n_features))] += 1
+        idf = np.log((1 + len(examples)) / (1 + document_frequency)).astype(np.float32) + 1
+
+        rows = [cls.vectorize(text, idf) for text, _, _ in examples]
+        relevance_weights, relevance_bias = train_softmax(
+            rows, [int(relevant) for _, relevant, _ in examples], 2, n_features, **train_options)
+
+        typed = [(row, primary_type) for row, (_, relevant, primary_type) in zip(rows, examples)
+                 if relevant and primary_type]
+        type_classes = sorted({primary_type for _, primary_type in typed})
+        type_weights = type_bias = None
+        if len(type_classes) >= 2:
+            type_weights, type_bias = train_softmax(
+                [row for row, _ in typed], [type_classes.index(t) for _, t in typed],
+                len(type_classes), n_features, **train_options)
+        else:
+            type_classes = []
+        return cls(idf, relevance_weights, relevance_bias, type_weights, type_bias, type_classes)
+
+    def save(self, path=RELEVANCE_MODEL_FILE):
+        arrays = {'idf': self.idf, 'relevance_weights': self.relevance_weights,
+                  'relevance_bias': self.relevance_bias, 'type_classes': np.array(self.type_classes, dtype=str)}
+        if self.type_weights is not None:
+            arrays.update(type_weights=self.type_weights, type_bias=self.type_bias)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path=RELEVANCE_MODEL_FILE):
+        with np.load(path) as data:
+            return cls(data['idf'], data['relevance_weights'], data['relevance_bias'],
+                       data['type_weights'] if 'type_weights' in data else None,
+                       data['type_bias'] if 'type_bias' in data else None,
+                       data['type_classes'].tolist())
+
+    def score(self, text):
+        """Returns (probability the article is relevant, most likely event type or None)."""
+        indices, values = self.vectorize(text, self.idf)
+        logits = values @ self.relevance_weights[indices] + self.relevance_bias
+        relevance = float(1 / (1 + np.exp(logits[0] - logits[1])))
+        event_type = None
+        if self.type_weights is not None:
+            type_logits = values @ self.type_weights[indices] + self.type_bias
+            event_type = self.type_classes[int(np.argmax(type_logits))]
+        return relevance, event_type
+
+class RelevanceFilter:
+    """Routes articles scoring below threshold away from the LLM backends."""
+
+    def __init__(self, classifier, threshold=DEFAULT_RELEVANCE_THRESHOLD):
+        self.classifier = classifier
+        self.threshold = threshold
+
+    def check(self, article):
+        """
+        Returns None for articles worth extracting, otherwise the skip record to use as their result.
+
+        The record has no "error" key: a skip is a final outcome, checkpointed as such,
+        not a failure to retry on the next run.
+        """
+        relevance, event_type = self.classifier.score(article['content'])
+        if relevance >= self.threshold:
+            return None
+        logging.info(f"Skipping {article.get('url') or 'article'}: relevance {relevance:.2f} "
+                     f"below {self.threshold} (likely {event_type or 'unclassified'})")
+        return {"status": "skipped", "reason": "Skipped as irrelevant", "relevance": round(relevance, 4),
+                "predicted_event_type": event_type}
+
+def add_relevance_arguments(parser):
+    parser.add_argument('--relevance-model', default=RELEVANCE_MODEL_FILE,
+                        help='Trained relevance model; articles are not filtered when it does not exist')
+    parser.add_argument('--relevance-threshold', type=float, default=DEFAULT_RELEVANCE_THRESHOLD,
+                        help='Minimum relevance probability for an article to be sent to the LLM')
+    return parser
+
+def relevance_filter_from_args(args):
+    if not os.path.exists(args.relevance_model):
+        logging.info(f"No relevance model at {args.relevance_model}; sending every article to the LLM")
+        return None
+    return RelevanceFilter(RelevanceClassifier.load(args.relevance_model), args.relevance_threshold)
+
+class TestRelevanceFilter(unittest.TestCase):
+    def classifier(self, relevant_bias):
+        n_features = 64
+        return RelevanceClassifier(np.ones(n_features, dtype=np.float32), np.zeros((n_features, 2), dtype=np.float32),
+                                   np.array([0.0, relevant_bias], dtype=np.float32))
+
+    def test_low_scoring_article_gets_a_skip_record(self):
+        skip = RelevanceFilter(self.classifier(-2.0)).check({'content': 'Local team wins the weekend match'})
+        self.assertEqual(skip['status'], 'skipped')
+        self.assertNotIn('error', skip)
+        self.assertAlmostEqual(skip['relevance'], 1 / (1 + math.exp(2.0)), places=4)
+
+    def test_relevant_article_passes(self):
+        self.assertIsNone(RelevanceFilter(self.classifier(2.0)).check({'content': 'Acme revenue rose 8%'}))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Train the local relevance pre-classifier on past extractions")
+    parser.add_argument('--articles', default='scraped_articles_results.json', help='Scraped articles file')
+    parser.add_argument('--ledgers', nargs='*', default=None,
+                        help='Extraction ledgers to learn from (default: every extraction_ledger_*.jsonl*)')
+    parser.add_argument('--output', default=RELEVANCE_MODEL_FILE, help='Where to save the model')
+    args = parser.parse_args()
+
+    with open(args.articles, 'r', encoding='utf-8') as f:
+        scraped_articles = json.load(f)['successful_articles']
+    ledger_paths = args.ledgers if args.ledgers is not None else sorted(glob.glob('extraction_ledger_*.jsonl*'))
+    training_examples = load_training_examples(scraped_articles, ledger_paths)
+    relevant_count = sum(relevant for _, relevant, _ in training_examples)
+    logging.info(f"Training on {len(training_examples)} articles ({relevant_count} relevant) "
+                 f"from {len(ledger_paths)} ledgers")
+    model = RelevanceClassifier.train(training_examples)
+    model.save(args.output)
+    logging.info(f"Saved relevance model to {args.output} (event types: {', '.join(model.type_classes) or 'none'})")
@@ -0,0 +1,373 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from collections import deque
+from news_extraction_engine import (BACKENDS, ExtractionEngine, RateLimitError, RateLimiter, TransientBackendError,
+                                    estimate_tokens)
+from news_telemetry import TelemetryStore
+
+DEFAULT_PROVIDERS = ('claude', 'xai', 'gemini')
+
+class ProviderHealth:
+    """
+    Live view of one provider: recent latencies, recent outcomes, quota and circuit state.
+
+    Each provider keeps its own RateLimiter, so its remaining quota is known before
+    a request is sent. After failure_threshold consecutive failures the circuit
+    opens for open_seconds and the provider is skipped until it closes again.
+    """
+
+    def __init__(self, backend, requests_per_minute=None, tokens_per_minute=None, failure_threshold=3,
+                 open_seconds=60.0, initial_deadline=30.0):
+        self.backend = backend
+        self.limiter = RateLimiter(requests_per_minute or backend.default_requests_per_minute,
+                                   tokens_per_minute or backend.default_tokens_per_minute)
+        self.latencies = deque(maxlen=200)
+        self.outcomes = deque(maxlen=50)
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.initial_deadline = initial_deadline
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.hedges_won = 0
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def deadline(self, min_delay):
+        """How long to wait before hedging: this provider's p95 once it has enough samples."""
+        p95 = self.percentile(0.95) if len(self.latencies) >= 10 else None
+        return max(min_delay, p95 if p95 is not None else self.initial_deadline)
+
+    def error_rate(self):
+        return 1 - sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def available_at(self):
+        return max(self.open_until, self.limiter.paused_until)
+
+    def expected_cost(self, tokens):
+        """Lower is better: typical latency inflated by error rate, load and a nearly spent quota."""
+        median = self.percentile(0.5) or self.initial_deadline / 3
+        return (median * (1 + 2 * self.error_rate()) * (1 + 0.25 * self.in_flight)
+                / max(self.limiter.headroom(tokens), 0.05))
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.open_seconds
+            logging.warning(f"{self.backend.label} failed {self.consecutive_failures} times in a row; "
+                            f"routing around it for {self.open_seconds:.0f}s")
+
+class RouterBackend:
+    """
+    Backend that spreads requests over several providers with hedging and failover.
+
+    Each request goes to the available provider with the lowest expected cost,
+    judged from its live latency, error rate, in-flight load and remaining quota.
+    If no answer arrives by that provider's p95 latency, the same request is also
+    sent to the next best provider and whichever answers first wins. A provider
+    that is rate-limited, failing or unreachable is skipped and the request fails
+    over. Only when every provider has failed does the error reach the engine's
+    own retry loop.
+    """
+    name = 'router'
+    label = 'Router'
+
+    def __init__(self, providers=DEFAULT_PROVIDERS, provider_options=None, hedge=True, min_hedge_delay=2.0,
+                 failure_threshold=3, open_seconds=60.0):
+        self.providers = []
+        for provider in providers:
+            try:
+                backend = BACKENDS[provider](**(provider_options or {}).get(provider, {}))
+            except Exception as e:
+                logging.warning(f"Provider {provider} unavailable, routing without it: {e}")
+                continue
+            self.providers.append(ProviderHealth(backend, failure_threshold=failure_threshold,
+                                                 open_seconds=open_seconds))
+        if not self.providers:
+            raise ValueError(f"None of the providers {', '.join(providers)} could be configured")
+        self.hedge = hedge and len(self.providers) > 1
+        self.min_hedge_delay = min_hedge_delay
+        self.model = '+'.join(f"{p.backend.name}:{p.backend.model}" for p in self.providers)
+        self.default_requests_per_minute = sum(p.limiter.max_rpm for p in self.providers)
+        self.default_tokens_per_minute = sum(p.limiter.max_tpm for p in self.providers)
+        self.expected_output_tokens = max(p.backend.expected_output_tokens for p in self.providers)
+
+    def choose(self, tokens, exclude):
+        now = time.monotonic()
+        candidates = [p for p in self.providers if p not in exclude and p.available_at() <= now]
+        return min(candidates, key=lambda p: p.expected_cost(tokens), default=None)
+
+    async def attempt(self, provider, instructions, user_content, tokens, record):
+        """One provider call; record is filled in with what telemetry needs to know about it."""
+        await provider.limiter.acquire(tokens)
+        provider.in_flight += 1
+        provider.calls += 1
+        started = record['sent'] = time.monotonic()
+        try:
+            response = await provider.backend.complete(instructions, user_content)
+        except asyncio.CancelledError:
+            # Lost a hedge race; says nothing about the provider's health
+            raise
+        except RateLimitError as e:
+            record.update(latency=time.monotonic() - started, error=f"Rate limited: {e}")
+            provider.limiter.on_rate_limited(e.retry_after)
+            provider.record_failure()
+            raise
+        except Exception as e:
+            record.update(latency=time.monotonic() - started, error=str(e) or type(e).__name__)
+            provider.record_failure()
+            raise
+        finally:
+            provider.in_flight -= 1
+        latency = time.monotonic() - started
+        record.update(latency=latency, input_tokens=response['input_tokens'],
+                      cached_input_tokens=response.get('cached_input_tokens'),
+                      cache_write_tokens=response.get('cache_write_tokens'), output_tokens=response['output_tokens'])
+        provider.record_success(latency)
+        logging.info(f"Served by {provider.backend.label} in {latency:.1f}s")
+        provider.limiter.on_success()
+        provider.limiter.record_usage(tokens, response['input_tokens'] + response['output_tokens'])
+        response['provider'] = provider.backend.name
+        response['model'] = provider.backend.model
+        return response
+
+    async def complete(self, instructions, user_content):
+        """
+        The first successful provider response.
+
+        Every other provider call the request made, failed or cancelled after losing
+        a hedge race, is listed under response['attempts'], or under the exception's
+        attempts when every provider failed, so the engine can record it as well.
+        A cancelled call is recorded with its latency and its estimated input
+        tokens, since the provider may already have billed for them.
+        """
+        input_tokens = estimate_tokens(instructions) + estimate_tokens(user_content)
+        tokens = input_tokens + self.expected_output_tokens
+        tried = set()
+        running = {}
+        records = {}
+        last_error = None
+
+        def start(provider):
+            tried.add(provider)
+            record = {'provider': provider.backend.name, 'model': provider.backend.model}
+            task = asyncio.create_task(self.attempt(provider, instructions, user_content, tokens, record))
+            running[task] = provider
+            records[task] = record
+
+        def other_attempts(winner=None):
+            return [{key: value for key, value in record.items() if key != 'sent'}
+                    for task, record in records.items() if task is not winner and 'sent' in record]
+
+        try:
+            while True:
+                if not running:
+                    provider = self.choose(tokens, tried)
+                    if provider is None:
+                        untried = [p for p in self.providers if p not in tried]
+                        if not untried:
+                            break
+                        # Everything left is paused or circuit-open; wait for the first to come back
+                        wait = min(p.available_at() for p in untried) - time.monotonic()
+                        await asyncio.sleep(min(max(wait, 0.01), 60.0))
+                        continue
+                    start(provider)
+
+                timeout = None
+                if self.hedge and len(running) == 1:
+                    timeout = next(iter(running.values())).deadline(self.min_hedge_delay)
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    backup = self.choose(tokens, tried)
+                    if backup is None:
+                        # No second provider to hedge with; keep waiting on the first
+                        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        primary = next(iter(running.values()))
+                        logging.info(f"{primary.backend.label} slower than {timeout:.1f}s; "
+                                     f"hedging with {backup.backend.label}")
+                        start(backup)
+                        continue
+
+                for task in done:
+                    provider = running.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        logging.warning(f"{provider.backend.label} failed, failing over: {e}")
+                        last_error = e
+                        continue
+                    if running:
+                        provider.hedges_won += 1
+                    self.cancel(running, records, input_tokens)
+                    response['attempts'] = other_attempts(task)
+                    return response
+        finally:
+            self.cancel(running, records, input_tokens)
+
+        error = (last_error if isinstance(last_error, (RateLimitError, TransientBackendError))
+                 else TransientBackendError(f"All providers failed; last error: {last_error}"))
+        error.attempts = other_attempts()
+        raise error
+
+    @staticmethod
+    def cancel(running, records, input_tokens):
+        """Cancels the calls still running and marks the ones already sent as cancelled."""
+        now = time.monotonic()
+        for task in running:
+            task.cancel()
+            record = records[task]
+            if 'sent' in record and 'latency' not in record:
+                record.update(latency=now - record['sent'], input_tokens=input_tokens, status='cancelled',
+                              error='Lost hedge race')
+        running.clear()
+
+    def summary(self):
+        lines = []
+        for p in self.providers:
+            p95 = p.percentile(0.95)
+            lines.append(f"{p.backend.label}: {p.calls} calls, {p.failures} failures, "
+                         f"p95 {p95:.1f}s, {p.hedges_won} hedges won" if p95 is not None else
+                         f"{p.backend.label}: {p.calls} calls, {p.failures} failures, {p.hedges_won} hedges won")
+        return '; '.join(lines)
+
+    async def close(self):
+        logging.info(f"Router: {self.summary()}")
+        for p in self.providers:
+            await p.backend.close()
+
+BACKENDS['router'] = RouterBackend
+
+def add_router_arguments(parser):
+    parser.add_argument('--providers', nargs='+', default=list(DEFAULT_PROVIDERS), choices=list(DEFAULT_PROVIDERS),
+                        help='Providers to route between, in no particular order')
+    parser.add_argument('--no-hedge', action='store_true', help='Do not send slow requests to a second provider')
+    parser.add_argument('--min-hedge-delay', type=float, default=2.0,
+                        help='Never hedge a request sooner than this many seconds')
+    return parser
+
+def router_options_from_args(args):
+    return {
+        'providers': args.providers,
+        'hedge': not args.no_hedge,
+        'min_hedge_delay': args.min_hedge_delay,
+    }
+
+class StandInBackend:
+    """Provider stand-in that answers after `delay` seconds, or raises `error`."""
+    default_requests_per_minute = 600
+    default_tokens_per_minute = 10000000
+    expected_output_tokens = 100
+
+    def __init__(self, name, delay=0.0, error=None):
+        self.name = self.label = self.model = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def complete(self, instructions, user_content):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {'text': f'{{"served_by": "{self.name}"}}', 'input_tokens': 120, 'cached_input_tokens': 0,
+                'output_tokens': 30, 'finish_reason': 'stop'}
+
+    async def close(self):
+        pass
+
+class TestRouterBackend(unittest.TestCase):
+    """Hedging, failover and circuit breaking across stand-in providers, and what telemetry sees of them."""
+
+    def router(self, *backends, **options):
+        with mock.patch.dict(BACKENDS, {b.name: (lambda b=b: b) for b in backends}):
+            router = RouterBackend([b.name for b in backends], **options)
+        for provider in router.providers:
+            provider.initial_deadline = 0.05
+        return router
+
+    def test_hedge_goes_to_second_provider_and_loser_is_recorded(self):
+        slow, fast = StandInBackend('slow', delay=1.0), StandInBackend('fast', delay=0.01)
+        router = self.router(slow, fast, min_hedge_delay=0.05)
+        with tempfile.TemporaryDirectory() as workdir:
+            telemetry = TelemetryStore(os.path.join(workdir, 'metrics.db'))
+
+            async def run():
+                engine = ExtractionEngine(router, telemetry=telemetry, max_retries=1)
+                return await engine.call('instructions', 'article')
+
+            response = asyncio.run(run())
+            rows = telemetry.conn.execute('SELECT provider, status, error, input_tokens, latency_ms '
+                                          'FROM llm_calls ORDER BY id').fetchall()
+            telemetry.close()
+        self.assertEqual(response['provider'], 'fast')
+        self.assertEqual(router.providers[1].hedges_won, 1)
+        self.assertEqual([row[:3] for row in rows], [('slow', 'cancelled', 'Lost hedge race'), ('fast', 'ok', None)])
+        self.assertEqual(rows[0][3], estimate_tokens('instructions') + estimate_tokens('article'))
+        self.assertGreater(rows[0][4], 40)
+        self.assertEqual(router.providers[0].failures, 0)
+
+    def test_no_hedge_waits_for_first_provider(self):
+        slow, fast = StandInBackend('slow', delay=0.2), StandInBackend('fast')
+        router = self.router(slow, fast, hedge=False)
+        response = asyncio.run(router.complete('instructions', 'article'))
+        self.assertEqual((response['provider'], response['attempts'], fast.calls), ('slow', [], 0))
+
+    def test_failover_and_circuit_breaker(self):
+        broken = StandInBackend('broken', error=TransientBackendError('HTTP 503'))
+        healthy = StandInBackend('healthy', delay=0.01)
+        router = self.router(broken, healthy, failure_threshold=1, open_seconds=60)
+
+        async def run(times):
+            return [await router.complete('instructions', 'article') for _ in range(times)]
+
+        first, second = asyncio.run(run(2))
+        self.assertEqual([r['provider'] for r in (first, second)], ['healthy'] * 2)
+        self.assertEqual(first['attempts'], [{'provider': 'broken', 'model': 'broken', 'latency': mock.ANY,
+                                              'error': 'HTTP 503'}])
+        # The failure opened the circuit, so the second request never tried the broken provider
+        self.assertGreater(router.providers[0].available_at(), time.monotonic() + 50)
+        self.assertEqual((broken.calls, second['attempts']), (1, []))
+
+    def test_all_providers_failing_reaches_engine_retries(self):
+        router = self.router(StandInBackend('a', error=TransientBackendError('down')),
+                             StandInBackend('b', error=ValueError('bad request')))
+        with self.assertRaises(TransientBackendError) as raised:
+            asyncio.run(router.complete('instructions', 'article'))
+        self.assertEqual(sorted(a['provider'] for a in raised.exception.attempts), ['a', 'b'])
+
+        with tempfile.TemporaryDirectory() as workdir:
+            telemetry = TelemetryStore(os.path.join(workdir, 'metrics.db'))
+            router = self.router(StandInBackend('a', error=TransientBackendError('down')),
+                                 StandInBackend('b', error=ValueError('bad request')))
+            response = asyncio.run(ExtractionEngine(router, telemetry=telemetry, max_retries=1).call('i', 'a'))
+            statuses = telemetry.conn.execute('SELECT provider, status FROM llm_calls ORDER BY id').fetchall()
+            telemetry.close()
+        self.assertIn('error', response)
+        self.assertEqual(sorted(statuses), [('a', 'error'), ('b', 'error'), ('router', 'error')])
+
+    def test_provider_without_key_is_left_out(self):
+        with mock.patch.dict(os.environ, {'XAI_API_KEY': ''}):
+            with mock.patch.dict(BACKENDS, {'claude': lambda: StandInBackend('claude')}):
+                router = RouterBackend(['claude', 'xai'])
+        self.assertEqual([p.backend.name for p in router.providers], ['claude'])
+        self.assertFalse(router.hedge)
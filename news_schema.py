@@ -0,0 +1,331 @@
+import json
+import math
+import re
+import unittest
+from datetime import date, datetime
+from email.utils import parsedate_to_datetime
+
+REPAIR_CONTEXT_CHARS = 4000
+
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y/%m/%d', '%m/%d/%Y', '%B %d, %Y', '%b %d, %Y', '%d %B %Y', '%d %b %Y',
+                '%Y%m%dT%H%M%S', '%Y%m%d%H%M%S']
+
+class Field:
+    """One leaf of the extraction schema and the constraints its value must meet."""
+
+    def __init__(self, kind, required=True, choices=None, minimum=None, maximum=None, integer=False, items=None):
+        self.kind = kind
+        self.required = required
+        self.choices = choices
+        self.minimum = minimum
+        self.maximum = maximum
+        self.integer = integer
+        self.items = items
+
+    def describe(self):
+        if self.choices:
+            return f"one of {', '.join(self.choices)}"
+        if self.kind == 'number':
+            kind = 'an integer' if self.integer else 'a number'
+            return f"{kind} from {self.minimum} to {self.maximum}" if self.minimum is not None else kind
+        return {'string': 'a string', 'date': 'an ISO 8601 date string', 'object': 'an object',
+                'string_list': 'a list of strings', 'object_list': 'a list of objects'}[self.kind]
+
+EXTRACTION_SCHEMA = {
+    'news_article': {
+        'id': Field('string'),
+        'title': Field('string'),
+        'publishedDate': Field('date'),
+        'source': Field('string'),
+        'url': Field('string'),
+        'type': Field('string'),
+    },
+    'company': {
+        'ticker': Field('string'),
+        'name': Field('string'),
+        'exchange': Field('string'),
+    },
+    'market_event': {
+        'type': Field('string'),
+        'key_points': Field('object'),
+        'major_shareholders': Field('object_list', required=False, items={
+            'name': Field('string'),
+            'ownership_percentage': Field('number', minimum=0, maximum=100),
+            'type': Field('string', required=False),
+        }),
+    },
+    'analysis': {
+        'key_findings': Field('string_list'),
+        'sentiment': Field('string', choices=['positive', 'negative', 'neutral']),
+        'risk_factors': Field('string_list'),
+    },
+    'event_classification': {
+        'primary_type': Field('string', choices=['Corporate Governance', 'Financial', 'Product', 'Market']),
+        'sub_type': Field('string'),
+        'severity': Field('number', minimum=1, maximum=5, integer=True),
+        'confidence': Field('number', minimum=0, maximum=1),
+        'impact_duration': Field('string', choices=['SHORT_TERM', 'MEDIUM_TERM', 'LONG_TERM']),
+    },
+}
+
+REPAIR_INSTRUCTIONS = """You correct individual fields of a JSON extraction made from a financial news article. You are given the fields that failed validation with the rule each one must satisfy, the current extraction, and an excerpt of the article.
+
+Return only a JSON object whose keys are exactly the listed field paths (for example "event_classification.severity") and whose values are the corrected values. Take facts from the article excerpt; when the article does not state a value, give your best estimate consistent with the extraction. Do not return any other fields, explanation or commentary."""
+
+def parse_date(value):
+    """
+    Normalizes common date spellings to ISO 8601, or returns None when the value is not a date.
+
+    Dates without a time stay date-only, e.g. "March 4, 2024" becomes "2024-03-04".
+    """
+    text = value.strip()
+    try:
+        return date.fromisoformat(text).isoformat()
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text.replace('Z', '+00:00')).isoformat()
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        return parsed.isoformat() if '%H' in date_format else parsed.date().isoformat()
+    try:
+        return parsedate_to_datetime(text).isoformat()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def compile_schema(schema, prefix=''):
+    """Flattens a nested schema into (dotted path, Field) checks, evaluated in order by SchemaValidator."""
+    checks = []
+    for key, spec in schema.items():
+        path = f"{prefix}{key}"
+        if isinstance(spec, dict):
+            checks.append((path, Field('object')))
+            checks.extend(compile_schema(spec, path + '.'))
+        else:
+            checks.append((path, spec))
+    return checks
+
+class SchemaValidator:
+    """
+    Validates extraction results against EXTRACTION_SCHEMA and repairs what it can locally.
+
+    The schema is compiled once into a flat list of path checks. coerce() fixes
+    values whose meaning is unambiguous, such as numeric strings, a confidence
+    given as a percentage, choice casing and common date formats. Whatever is
+    still invalid is returned as errors keyed by field path. Those errors are what
+    repair_request() asks a model to correct, instead of re-extracting the article.
+    """
+
+    def __init__(self, schema=EXTRACTION_SCHEMA):
+        self.checks = compile_schema(schema)
+        self.item_checks = {path: compile_schema(field.items) for path, field in self.checks if field.items}
+
+    def _lookup(self, result, path):
+        value = result
+        for key in path.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                return False, None
+            value = value[key]
+        return True, value
+
+    def _check(self, field, value):
+        """Returns (possibly coerced value, error message or None)."""
+        if field.kind == 'object':
+            return value, None if isinstance(value, dict) else f"must be {field.describe()}"
+        if field.kind == 'string_list':
+            if isinstance(value, str):
+                value = [value]
+            if isinstance(value, list) and all(isinstance(v, str) for v in value):
+                return value, None
+            return value, f"must be {field.describe()}"
+        if field.kind == 'object_list':
+            return value, None if isinstance(value, list) else f"must be {field.describe()}"
+        if field.kind == 'date':
+            normalized = parse_date(value) if isinstance(value, str) and value.strip() else None
+            return (normalized, None) if normalized else (value, f"must be {field.describe()}")
+        if field.kind == 'number':
+            return self._check_number(field, value)
+
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and not field.choices:
+            value = str(value)
+        if not isinstance(value, str) or not value.strip():
+            return value, f"must be {field.describe()}"
+        if field.choices:
+            wanted = re.sub(r'[\s-]+', '_', value.strip()).lower()
+            for choice in field.choices:
+                if re.sub(r'[\s-]+', '_', choice).lower() == wanted:
+                    return choice, None
+            return value, f"must be {field.describe()}"
+        return value, None
+
+    def _check_number(self, field, value):
+        if isinstance(value, str):
+            text = value.strip().rstrip('%').replace(',', '')
+            try:
+                number = float(text)
+            except ValueError:
+                return value, f"must be {field.describe()}"
+            if value.strip().endswith('%') and field.maximum == 1:
+                number /= 100
+            value = number
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value, f"must be {field.describe()}"
+        if not math.isfinite(value):
+            # JSON NaN / Infinity, or "inf" in a string; int() would raise on them
+            return value, f"must be {field.describe()}"
+        if field.maximum == 1 and 1 < value <= 100 and value == int(value):
+            # A confidence of 85 is a percentage
+            value = value / 100
+        if field.integer:
+            if value != int(value):
+                return value, f"must be {field.describe()}"
+            value = int(value)
+        if field.minimum is not None and not field.minimum <= value <= field.maximum:
+            return value, f"must be {field.describe()}"
+        return value, None
+
+    def _assign(self, result, path, value):
+        keys = path.split('.')
+        target = result
+        for key in keys[:-1]:
+            target = target[key]
+        target[keys[-1]] = value
+
+    def coerce(self, result):
+        """Repairs what can be repaired in place; returns [{'path', 'error', 'value'}] for the rest."""
+        errors = []
+        failed_objects = set()
+        for path, field in self.checks:
+            if any(path.startswith(parent + '.') for parent in failed_objects):
+                continue
+            present, value = self._lookup(result, path)
+            if not present or value is None:
+                if field.required:
+                    errors.append({'path': path, 'error': f"is missing; must be {field.describe()}", 'value': None})
+                    if field.kind == 'object':
+                        failed_objects.add(path)
+                continue
+            coerced, error = self._check(field, value)
+            if error is None and path in self.item_checks:
+                error = self._check_items(path, coerced)
+            if error:
+                errors.append({'path': path, 'error': error, 'value': value})
+                if field.kind == 'object':
+                    failed_objects.add(path)
+            elif coerced is not value:
+                self._assign(result, path, coerced)
+        return errors
+
+    def annotate(self, result):
+        """Local-only validation for paths without a follow-up call: coerces, then lists what is still invalid."""
+        if isinstance(result, dict) and 'error' not in result:
+            errors = self.coerce(result)
+            if errors:
+                result['validation_errors'] = [{'path': e['path'], 'error': e['error']} for e in errors]
+        return result
+
+    def _check_items(self, path, items):
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                return f"item {position} must be an object"
+            for key, field in self.item_checks[path]:
+                if item.get(key) is None:
+                    if field.required:
+                        return f"item {position} is missing {key}"
+                    continue
+                coerced, error = self._check(field, item[key])
+                if error:
+                    return f"item {position} {key} {error}"
+                item[key] = coerced
+        return None
+
+    def apply_patch(self, result, patch, errors):
+        """Writes a repair response's values into result, for the paths that were reported invalid."""
+        for error in errors:
+            if error['path'] not in patch:
+                continue
+            keys = error['path'].split('.')
+            target = result
+            for key in keys[:-1]:
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                target = target[key]
+            target[keys[-1]] = patch[error['path']]
+
+    def repair_request(self, result, errors, article_text):
+        """User content for a follow-up call that asks only for the invalid fields."""
+        listed = '\n'.join(f"- {e['path']}: {e['error']} (got {json.dumps(e['value'], ensure_ascii=False)})"
+                           for e in errors)
+        return (f"Fields to correct:\n{listed}\n\n"
+                f"Current extraction:\n{json.dumps(result, ensure_ascii=False)}\n\n"
+                f"Article excerpt:\n{article_text[:REPAIR_CONTEXT_CHARS]}")
+
+class TestSchemaValidator(unittest.TestCase):
+    """Coercion repairs unambiguous values and reports the rest by path, without raising."""
+
+    def extraction(self, **event_classification):
+        return {
+            'news_article': {'id': 'OXY_2024-03-04_earnings', 'title': 'Occidental beats estimates',
+                             'publishedDate': '2024-03-04', 'source': 'Reuters', 'url': 'https://news.example/1',
+                             'type': 'earnings'},
+            'company': {'ticker': 'OXY', 'name': 'Occidental Petroleum', 'exchange': 'NYSE'},
+            'market_event': {'type': 'earnings', 'key_points': {'eps': 1.2},
+                             'major_shareholders': [{'name': 'Berkshire Hathaway', 'ownership_percentage': '28.2%'}]},
+            'analysis': {'key_findings': 'Earnings beat', 'sentiment': 'Positive', 'risk_factors': []},
+            'event_classification': dict({'primary_type': 'financial', 'sub_type': 'earnings', 'severity': '3',
+                                          'confidence': 85, 'impact_duration': 'short term'}, **event_classification),
+        }
+
+    def test_coerces_unambiguous_values(self):
+        result = self.extraction()
+        self.assertEqual(SchemaValidator().coerce(result), [])
+        self.assertEqual(result['analysis']['key_findings'], ['Earnings beat'])
+        self.assertEqual(result['analysis']['sentiment'], 'positive')
+        self.assertEqual(result['event_classification'], {
+            'primary_type': 'Financial', 'sub_type': 'earnings', 'severity': 3, 'confidence': 0.85,
+            'impact_duration': 'SHORT_TERM'})
+        self.assertEqual(result['market_event']['major_shareholders'][0]['ownership_percentage'], 28.2)
+
+    def test_reports_invalid_fields_by_path(self):
+        result = self.extraction(severity=7, confidence='high')
+        del result['company']
+        errors = SchemaValidator().coerce(result)
+        self.assertEqual([e['path'] for e in errors],
+                         ['company', 'event_classification.severity', 'event_classification.confidence'])
+        self.assertEqual(errors[1]['error'], 'must be an integer from 1 to 5')
+
+    def test_non_finite_numbers_are_errors(self):
+        for value in [float('nan'), float('inf'), '-inf', 'Infinity', json.loads('NaN')]:
+            with self.subTest(value=value):
+                result = self.extraction(severity=value, confidence=value)
+                errors = SchemaValidator().coerce(result)
+                self.assertEqual([e['path'] for e in errors],
+                                 ['event_classification.severity', 'event_classification.confidence'])
+        annotated = SchemaValidator().annotate(json.loads(json.dumps(self.extraction()).replace('"3"', 'Infinity')))
+        self.assertEqual(annotated['validation_errors'][0]['path'], 'event_classification.severity')
+
+    def test_dates(self):
+        self.assertEqual(parse_date('2024-03-04'), '2024-03-04')
+        self.assertEqual(parse_date('March 4, 2024'), '2024-03-04')
+        self.assertEqual(parse_date('2024-03-04T09:30:00Z'), '2024-03-04T09:30:00+00:00')
+        self.assertEqual(parse_date('20240304T093000'), '2024-03-04T09:30:00')
+        self.assertEqual(parse_date('Mon, 04 Mar 2024 09:30:00 GMT'), '2024-03-04T09:30:00+00:00')
+        self.assertIsNone(parse_date('last Tuesday'))
+        result = self.extraction()
+        SchemaValidator().coerce(result)
+        self.assertEqual(result['news_article']['publishedDate'], '2024-03-04')
+
+    def test_patch_and_repair_request(self):
+        validator = SchemaValidator()
+        result = self.extraction(severity=9)
+        errors = validator.coerce(result)
+        request = validator.repair_request(result, errors, 'Occidental beat estimates.')
+        self.assertIn('- event_classification.severity: must be an integer from 1 to 5 (got 9)', request)
+        validator.apply_patch(result, {'event_classification.severity': 2, 'company.name': 'ignored'}, errors)
+        self.assertEqual(result['event_classification']['severity'], 2)
+        self.assertEqual(validator.coerce(result), [])
@@ -0,0 +1,249 @@
+import argparse
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from news_content_store import column_names
+
+METRICS_DB = 'llm_metrics.db'
+
+# USD per million tokens: (input, cached input, output). Matched by model-name prefix;
+# list prices at the time of writing, update alongside model changes.
+MODEL_PRICING = {
+    'claude-3-opus': (15.00, 1.50, 75.00),
+    'claude-3-5-sonnet': (3.00, 0.30, 15.00),
+    'claude-3-5-haiku': (0.80, 0.08, 4.00),
+    'claude-3-haiku': (0.25, 0.03, 1.25),
+    'grok-beta': (5.00, 5.00, 15.00),
+    'gemini-1.5-flash': (0.075, 0.01875, 0.30),
+    'gemini-1.5-pro': (1.25, 0.3125, 5.00),
+}
+# Message Batches are billed at half the interactive price
+BATCH_DISCOUNT = 0.5
+# Anthropic bills tokens written to the prompt cache at 1.25x the input price
+CACHE_WRITE_PREMIUM = 1.25
+
+def call_cost(model, input_tokens, cached_input_tokens=0, output_tokens=0, batch=False, cache_write_tokens=0):
+    """Dollar cost of one call, or None for unknown models; input_tokens includes cache reads and writes."""
+    matches = [prefix for prefix in MODEL_PRICING if (model or '').startswith(prefix)]
+    if not matches:
+        return None
+    input_price, cached_price, output_price = MODEL_PRICING[max(matches, key=len)]
+    cached_input_tokens = cached_input_tokens or 0
+    cache_write_tokens = cache_write_tokens or 0
+    cost = (((input_tokens or 0) - cached_input_tokens - cache_write_tokens) * input_price
+            + cached_input_tokens * cached_price + cache_write_tokens * input_price * CACHE_WRITE_PREMIUM)
+    cost = (cost + (output_tokens or 0) * output_price) / 1_000_000
+    return cost * BATCH_DISCOUNT if batch else cost
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class TelemetryStore:
+    """
+    SQLite table of per-call LLM metrics: one row per logical request.
+
+    latency_ms is time spent inside provider calls across all attempts; wait_ms is
+    time spent queued on the rate limiter or sleeping between retries, so the two
+    together show work versus retry overhead. ttfb_ms is the time to the first
+    streamed chunk: Claude and Gemini calls are streamed, while xAI calls and
+    Message Batches results are not, so their ttfb_ms is NULL. A multi-article
+    request records how many articles it covered, so per-article figures stay honest.
+    status is ok, error, or cancelled for a routed call that lost a hedge race.
+    """
+
+    def __init__(self, db_path=METRICS_DB, run_id=None):
+        self.db_path = db_path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT,
+                recorded_at REAL,
+                provider TEXT,
+                model TEXT,
+                purpose TEXT,
+                articles INTEGER,
+                input_tokens INTEGER,
+                cached_input_tokens INTEGER,
+                cache_write_tokens INTEGER,
+                output_tokens INTEGER,
+                ttfb_ms REAL,
+                latency_ms REAL,
+                wait_ms REAL,
+                retries INTEGER,
+                status TEXT,
+                error TEXT,
+                cost_usd REAL
+            )
+        ''')
+        if 'cache_write_tokens' not in column_names(self.conn, 'llm_calls'):
+            self.conn.execute('ALTER TABLE llm_calls ADD COLUMN cache_write_tokens INTEGER')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_recorded_at ON llm_calls (recorded_at)')
+        self.conn.commit()
+
+    def record(self, provider, model, purpose='extract', articles=1, input_tokens=None, cached_input_tokens=None,
+               output_tokens=None, ttfb=None, latency=None, wait=None, retries=0, error=None, batch=False,
+               status=None, cache_write_tokens=None):
+        """Stores one call; durations are in seconds and stored as milliseconds."""
+        cost = (call_cost(model, input_tokens, cached_input_tokens, output_tokens, batch, cache_write_tokens)
+                if input_tokens is not None else None)
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO llm_calls (run_id, recorded_at, provider, model, purpose, articles, input_tokens, '
+                'cached_input_tokens, cache_write_tokens, output_tokens, ttfb_ms, latency_ms, wait_ms, retries, '
+                'status, error, cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.run_id, time.time(), provider, model, purpose, articles, input_tokens, cached_input_tokens,
+                 cache_write_tokens, output_tokens, None if ttfb is None else ttfb * 1000, None if latency is None else latency * 1000,
+                 None if wait is None else wait * 1000, retries, status or ('error' if error else 'ok'), error, cost)
+            )
+            self.conn.commit()
+
+    def report(self, since=None, run_id=None):
+        """Per provider/model summary rows, optionally limited to calls after `since` (epoch seconds) or one run."""
+        query = ('SELECT provider, model, articles, input_tokens, cached_input_tokens, output_tokens, ttfb_ms, '
+                 'latency_ms, wait_ms, retries, status, cost_usd FROM llm_calls WHERE 1 = 1')
+        params = []
+        if since is not None:
+            query += ' AND recorded_at >= ?'
+            params.append(since)
+        if run_id is not None:
+            query += ' AND run_id = ?'
+            params.append(run_id)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+
+        groups = {}
+        for row in rows:
+            groups.setdefault((row[0], row[1]), []).append(row)
+        summary = []
+        for (provider, model), calls in sorted(groups.items()):
+            ok = [c for c in calls if c[10] == 'ok']
+            articles = sum(c[2] or 0 for c in ok)
+            latency = sum(c[7] or 0 for c in calls)
+            wait = sum(c[8] or 0 for c in calls)
+            # Cancelled hedges are paid for too, so they count towards cost
+            costs = [c[11] for c in calls if c[11] is not None]
+            input_tokens = sum(c[3] or 0 for c in ok)
+            summary.append({
+                'provider': provider,
+                'model': model,
+                'calls': len(calls),
+                'errors': sum(1 for c in calls if c[10] == 'error'),
+                'cancelled': sum(1 for c in calls if c[10] == 'cancelled'),
+                'retries': sum(c[9] or 0 for c in calls),
+                'articles': articles,
+                'p50_latency_ms': percentile([c[7] for c in ok if c[7] is not None], 0.5),
+                'p95_latency_ms': percentile([c[7] for c in ok if c[7] is not None], 0.95),
+                'p50_ttfb_ms': percentile([c[6] for c in ok if c[6] is not None], 0.5),
+                'input_tokens_per_article': input_tokens / articles if articles else None,
+                'output_tokens_per_article': sum(c[5] or 0 for c in ok) / articles if articles else None,
+                'cached_input_share': sum(c[4] or 0 for c in ok) / input_tokens if input_tokens else None,
+                'cost_usd': sum(costs) if costs else None,
+                'cost_per_1k_articles': sum(costs) / articles * 1000 if costs and articles else None,
+                'wait_share': wait / (wait + latency) if wait + latency else None,
+            })
+        return summary
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+default_store = None
+default_store_lock = threading.Lock()
+
+def record_llm_call(**fields):
+    """Records a call in the shared default store, opening it on first use; never lets telemetry break a call."""
+    global default_store
+    try:
+        with default_store_lock:
+            if default_store is None:
+                default_store = TelemetryStore()
+        default_store.record(**fields)
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to record LLM call metrics: {e}")
+
+def format_report(summary):
+    def show(value, pattern):
+        return '-' if value is None else pattern.format(value)
+
+    lines = [f"{'provider':<10} {'model':<28} {'calls':>6} {'err':>4} {'cxl':>4} {'retry':>5} {'articles':>8} "
+             f"{'p50 ms':>8} {'p95 ms':>8} {'ttfb ms':>8} {'in/art':>7} {'out/art':>7} {'cached':>6} "
+             f"{'wait':>5} {'$':>8} {'$/1k art':>9}"]
+    for row in summary:
+        lines.append(
+            f"{row['provider']:<10} {row['model'][:28]:<28} {row['calls']:>6} {row['errors']:>4} "
+            f"{row['cancelled']:>4} {row['retries']:>5} {row['articles']:>8} {show(row['p50_latency_ms'], '{:.0f}'):>8} "
+            f"{show(row['p95_latency_ms'], '{:.0f}'):>8} {show(row['p50_ttfb_ms'], '{:.0f}'):>8} "
+            f"{show(row['input_tokens_per_article'], '{:.0f}'):>7} {show(row['output_tokens_per_article'], '{:.0f}'):>7} "
+            f"{show(row['cached_input_share'], '{:.0%}'):>6} {show(row['wait_share'], '{:.0%}'):>5} "
+            f"{show(row['cost_usd'], '{:.2f}'):>8} {show(row['cost_per_1k_articles'], '{:.2f}'):>9}"
+        )
+    return '\n'.join(lines)
+
+class TestTelemetryStore(unittest.TestCase):
+    """Costs follow the provider's billing, and the report separates errors from cancelled hedges."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.workdir.name, 'metrics.db')
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def test_call_cost(self):
+        # 1000 input tokens: 600 read from the cache, 300 written to it, 100 uncached; 200 output tokens
+        cost = call_cost('claude-3-5-sonnet-20241022', 1000, 600, 200, cache_write_tokens=300)
+        self.assertAlmostEqual(cost, (100 * 3.00 + 600 * 0.30 + 300 * 3.00 * 1.25 + 200 * 15.00) / 1_000_000)
+        self.assertAlmostEqual(call_cost('claude-3-5-sonnet', 1000, 600, 200, batch=True, cache_write_tokens=300),
+                               cost / 2)
+        self.assertIsNone(call_cost('unknown-model', 1000))
+
+    def test_report(self):
+        store = TelemetryStore(self.db_path, run_id='run')
+        store.record('claude', 'claude-3-5-haiku', input_tokens=1000, cached_input_tokens=800, cache_write_tokens=0,
+                     output_tokens=100, latency=1.0, wait=1.0)
+        store.record('claude', 'claude-3-5-haiku', input_tokens=1000, latency=2.0, status='cancelled',
+                     error='Lost hedge race')
+        store.record('claude', 'claude-3-5-haiku', latency=0.5, error='HTTP 529')
+        [row] = store.report(run_id='run')
+        store.close()
+        self.assertEqual((row['calls'], row['errors'], row['cancelled'], row['articles']), (3, 1, 1, 1))
+        self.assertEqual(row['cached_input_share'], 0.8)
+        self.assertAlmostEqual(row['cost_usd'], call_cost('claude-3-5-haiku', 1000, 800, 100) + call_cost(
+            'claude-3-5-haiku', 1000))
+        self.assertIn('claude-3-5-haiku', format_report([row]))
+
+    def test_adds_cache_write_column_to_old_databases(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE llm_calls (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, recorded_at REAL, '
+                     'provider TEXT, model TEXT, purpose TEXT, articles INTEGER, input_tokens INTEGER, '
+                     'cached_input_tokens INTEGER, output_tokens INTEGER, ttfb_ms REAL, latency_ms REAL, wait_ms REAL, '
+                     'retries INTEGER, status TEXT, error TEXT, cost_usd REAL)')
+        conn.close()
+        store = TelemetryStore(self.db_path)
+        store.record('claude', 'claude-3-5-haiku', input_tokens=100, cache_write_tokens=100, output_tokens=0)
+        self.assertEqual(store.conn.execute('SELECT cache_write_tokens FROM llm_calls').fetchall(), [(100,)])
+        store.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize recorded LLM call metrics")
+    parser.add_argument('--db', default=METRICS_DB, help='Metrics database')
+    parser.add_argument('--hours', type=float, default=None, help='Only include calls from the last N hours')
+    parser.add_argument('--run-id', default=None, help='Only include calls from one run')
+    args = parser.parse_args()
+
+    store = TelemetryStore(args.db)
+    since = time.time() - args.hours * 3600 if args.hours is not None else None
+    print(format_report(store.report(since=since, run_id=args.run_id)))
+    store.close()
@@ -41,16 +41,20 @@ def fetch_and_store_tickertick_news():
                 favicon_url TEXT,
                 tags TEXT,
                 description TEXT,
-                tickers TEXT
+                tickers TEXT,
+                similar_stories TEXT
             )
         ''')
+        # Databases created before similar_stories was stored need the column added
+        if 'similar_stories' not in [column[1] for column in cursor.execute('PRAGMA table_info(tickertick_news)')]:
+            cursor.execute('ALTER TABLE tickertick_news ADD COLUMN similar_stories TEXT')
         
         # Insert data
         for _, row in df.iterrows():
             cursor.execute('''
                 INSERT OR REPLACE INTO tickertick_news
-                (id, title, url, site, time, favicon_url, tags, description, tickers)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (id, title, url, site, time, favicon_url, tags, description, tickers, similar_stories)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 row.get('id'),
                 row.get('title'),
@@ -60,7 +64,9 @@ def fetch_and_store_tickertick_news():
                 row.get('favicon_url'),
                 str(row.get('tags', [])),
                 row.get('description'),
-                str(row.get('tickers', []))
+                str(row.get('tickers', [])),
+                # Stories without similar ones come back as NaN once in the DataFrame
+                str(row.get('similar_stories') if isinstance(row.get('similar_stories'), list) else [])
             ))
             
         conn.commit()
@@ -110,6 +116,7 @@ class TestTickerTickNewsFetcher(unittest.TestCase):
             self.assertEqual(result[6], str(self.test_entry.get('tags', [])))
             self.assertEqual(result[7], self.test_entry.get('description', None))
             self.assertEqual(result[8], str(self.test_entry.get('tickers', [])))
+            self.assertEqual(result[9], str(self.test_entry.get('similar_stories', [])))
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,19 @@ from datetime import datetime
 import logging
 from dotenv import load_dotenv
 import time
+import argparse
+import unittest
+from unittest.mock import patch
+from news_extraction_cache import ExtractionCache
+from news_extraction_engine import (ARTICLE_TEMPLATE, EXTRACTION_INSTRUCTIONS, add_engine_arguments, article_id,
+                                    cached_system_prompt, engine_options_from_args,
+                                    extraction_prompt_key, is_skipped, parse_json_response)
+from news_checkpoint import ExtractionLedger, add_checkpoint_arguments, extract_articles_with_ledger
+from news_condense import add_condense_arguments, condenser_from_args
+from news_relevance import add_relevance_arguments, relevance_filter_from_args
+from news_clustering import add_clustering_arguments, clusterer_from_args, propagate_results
+from news_schema import SchemaValidator
+from news_telemetry import record_llm_call
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,136 +25,422 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_article_with_claude(article_text, client):
-    logging.info("Starting to process article with Claude")
-
-    prompt = """You are a financial news analyzer. Your task is to extract structured information from financial news articles and output it in JSON format. Follow these specific guidelines:
-
-1. Output Structure Required:
-{{
-    "news_article": {{
-        "id": string,            // Create unique based on ticker_date_type
-        "title": string,
-        "publishedDate": string, // ISO format
-        "source": string,
-        "url": string,
-        "type": string          // Type of news article
-    }},
-    "company": {{
-        "ticker": string,
-        "name": string,
-        "exchange": string
-    }},
-    "market_event": {{
-        "type": string,         // Main event type
-        "key_points": object,   // Key numerical or factual points
-        "major_shareholders": [ // If ownership related
-            {{
-                "name": string,
-                "ownership_percentage": number,
-                "type": string
-            }}
-        ]
-    }},
-    "analysis": {{
-        "key_findings": string[],
-        "sentiment": string,    // positive, negative, neutral
-        "risk_factors": string[]
-    }},
-    "event_classification": {{
-        "primary_type": string, // Corporate Governance, Financial, Product, Market
-        "sub_type": string,     // More specific classification
-        "severity": number,     // 1-5 scale
-        "confidence": number,   // 0-1 scale
-        "impact_duration": string // SHORT_TERM, MEDIUM_TERM, LONG_TERM
-    }}
-}}
-
-Please process the following news article and output the JSON according to these specifications:
-
-{article_text}
-
-Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted."""
-
-    logging.info("Sending request to Claude")
-    max_retries = 5
-    retry_delay = 1
-
-    for attempt in range(max_retries):
-        try:
-            message = client.messages.create(
-                model="claude-3-opus-20240229",
-                max_tokens=4000,
-                temperature=0,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt.format(article_text=article_text)
-                    }
-                ]
-            )
-            logging.info("Received response from Claude")
-
-            try:
-                parsed_response = json.loads(message.content[0].text)
-                logging.info("Successfully parsed Claude's response as JSON")
-                return parsed_response
-            except json.JSONDecodeError:
-                logging.error("Failed to parse Claude's response as JSON")
-                return {"error": "Failed to parse Claude's response as JSON"}
-
-        except anthropic.RateLimitError as e:
-            if attempt < max_retries - 1:
-                logging.warning(f"Rate limit exceeded. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-            else:
-                logging.error("Max retries reached. Unable to process article.")
-                return {"error": "Rate limit exceeded"}
-
-        except Exception as e:
-            logging.error(f"An error occurred: {str(e)}")
-            return {"error": str(e)}
-
-def process_articles_batch(articles):
+LEDGER_FILE = 'extraction_ledger_claude.jsonl'
+
+CLAUDE_MODEL = "claude-3-opus-20240229"
+BATCH_STATE_FILE = 'message_batches_state.json'
+MAX_BATCH_REQUESTS = 10000
+
+def process_articles_batch(articles, ledger_path=LEDGER_FILE, resume=False, **engine_options):
     """
     Process a batch of articles and save results to JSON
     
     Args:
         articles: List of dicts containing article info including 'content' field
+        ledger_path: Append-only ledger every result is checkpointed to as it arrives
+        resume: Skip articles the ledger already has a successful result for
+        engine_options: Concurrency, rate limit, condenser, relevance filter and clustering settings
     """
     logging.info(f"Starting to process batch of {len(articles)} articles")
-    results = []
+
+    ledger = ExtractionLedger(ledger_path, resume=resume)
+    try:
+        processed = extract_articles_with_ledger('claude', articles, ledger, **engine_options)
+    finally:
+        ledger.close()
+    results = [
+        result for article, result in zip(articles, processed)
+        if article.get('content')
+    ]
+    # Relevance skips are left out of the output, as in the Gemini and xAI scripts
+    skipped = sum(map(is_skipped, results))
+    if skipped:
+        logging.info(f"Skipped {skipped} articles as irrelevant")
+        results = [result for result in results if not is_skipped(result)]
+            
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_file = f'processed_articles_{timestamp}.json'
     
+    logging.info(f"Saving results to {output_file}")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+        
+    logging.info("Batch processing completed")
+    return output_file
+
+def load_batch_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        logging.info(f"Resuming from {state_file}: {len(state['batches'])} batches, {len(state['results'])} results")
+        return state
+    return {'batches': {}, 'results': {}}
+
+def save_batch_state(state, state_file):
+    # Write-then-rename so a crash mid-write never leaves a truncated state file
+    tmp_file = f'{state_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_file, state_file)
+
+def submit_message_batches(client, articles_by_id, state, state_file, max_tokens=4000,
+                           max_batch_requests=MAX_BATCH_REQUESTS):
+    """Submits every article that has neither a result nor an in-flight batch."""
+    in_flight = {
+        custom_id
+        for info in state['batches'].values() if info['status'] != 'collected'
+        for custom_id in info['custom_ids']
+    }
+    pending = [custom_id for custom_id in articles_by_id
+               if custom_id not in state['results'] and custom_id not in in_flight]
+
+    for i in range(0, len(pending), max_batch_requests):
+        chunk = pending[i:i+max_batch_requests]
+        batch = client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": {
+                    "model": CLAUDE_MODEL,
+                    "max_tokens": max_tokens,
+                    "temperature": 0,
+                    "system": cached_system_prompt(EXTRACTION_INSTRUCTIONS),
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": ARTICLE_TEMPLATE.format(article_text=articles_by_id[custom_id]['content'])
+                        }
+                    ]
+                }
+            } for custom_id in chunk
+        ])
+        state['batches'][batch.id] = {'custom_ids': chunk, 'status': batch.processing_status}
+        save_batch_state(state, state_file)
+        logging.info(f"Submitted message batch {batch.id} with {len(chunk)} articles")
+
+def collect_message_batch_results(client, state, state_file, poll_interval=60):
+    """
+    Polls submitted batches until all have ended and records their results by custom_id.
+
+    Results get local schema coercion; fields that are still invalid are listed under
+    "validation_errors", since a follow-up call would mean another batch round.
+    """
+    validator = SchemaValidator()
+    while True:
+        waiting = 0
+        for batch_id, info in state['batches'].items():
+            if info['status'] == 'collected':
+                continue
+            batch = client.messages.batches.retrieve(batch_id)
+            if batch.processing_status != 'ended':
+                info['status'] = batch.processing_status
+                waiting += 1
+                continue
+
+            for entry in client.messages.batches.results(batch_id):
+                result = entry.result
+                if result.type == 'succeeded':
+                    state['results'][entry.custom_id] = validator.annotate(
+                        parse_json_response(result.message.content[0].text, 'Claude'))
+                    usage = result.message.usage
+                    cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+                    cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+                    record_llm_call(provider='claude', model=CLAUDE_MODEL, purpose='batch',
+                                    input_tokens=usage.input_tokens + cache_read + cache_write,
+                                    cached_input_tokens=cache_read, cache_write_tokens=cache_write,
+                                    output_tokens=usage.output_tokens, batch=True)
+                elif result.type == 'errored' and result.error.error.type == 'invalid_request_error':
+                    state['results'][entry.custom_id] = {"error": result.error.error.message}
+                else:
+                    # Expired, canceled and transient errors are resubmitted on the next round
+                    logging.warning(f"Batch request {entry.custom_id} {result.type}; it will be resubmitted")
+            info['status'] = 'collected'
+            save_batch_state(state, state_file)
+            logging.info(f"Collected results for message batch {batch_id}")
+
+        if not waiting:
+            return
+        logging.info(f"{waiting} message batches still processing; polling again in {poll_interval} seconds")
+        time.sleep(poll_interval)
+
+def process_articles_with_message_batches(articles, state_file=BATCH_STATE_FILE, poll_interval=60,
+                                          base_url=None, max_rounds=3, use_cache=True, condenser=None,
+                                          relevance_filter=None, clusterer=None):
+    """
+    Process articles through the Message Batches API and save results to JSON
+
+    Submitted batch ids and collected results are checkpointed in state_file, so
+    rerunning after a crash resumes polling instead of resubmitting. base_url (or
+    ANTHROPIC_BASE_URL) points the client at a stand-in batches endpoint for testing.
+    A relevance_filter keeps low-scoring articles out of the batches entirely, a
+    clusterer submits one representative per near-duplicate story, and a condenser
+    trims what is left to its relevant sentences before submission.
+    """
     api_key = os.getenv('ANTHROPIC_API_KEY')
     if not api_key:
         raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-        
-    client = anthropic.Anthropic(api_key=api_key)
-    logging.info("Anthropic client initialized")
-    
-    for i, article in enumerate(articles):
-        logging.info(f"Processing article {i+1}/{len(articles)}")
+    client = anthropic.Anthropic(api_key=api_key, base_url=base_url)
+
+    # Score the full text, as the classifier was trained on, before condensing
+    skipped = {}
+    if relevance_filter is not None:
+        for article in articles:
+            skip = relevance_filter.check(article) if article.get('content') else None
+            if skip is not None:
+                skipped[article_id(article)] = skip
+    clusters = None
+    if clusterer is not None:
+        clustered_articles = [article for article in articles if article.get('content')]
+        articles, clusters = clusterer.representatives(clustered_articles)
+    # Ids come from the articles as scraped: condensing changes the content a URL-less id is derived from
+    ids = [article_id(article) for article in articles]
+    if condenser is not None:
+        articles = condenser.condense_articles(articles)
+
+    articles_by_id = {}
+    for custom_id, article in zip(ids, articles):
         if article.get('content'):
-            processed = process_article_with_claude(article['content'], client)
-            results.append(processed)
+            articles_by_id.setdefault(custom_id, article)
         else:
-            logging.warning(f"Article {i+1} has no content, skipping")
-        
-        # Add a delay between requests to avoid rate limiting
-        time.sleep(3)  # Adjust this value as needed
-            
+            logging.warning(f"Article {article.get('url')} has no content, skipping")
+
+    state = load_batch_state(state_file)
+    for custom_id, skip in skipped.items():
+        state['results'].setdefault(custom_id, skip)
+
+    cache = ExtractionCache() if use_cache else None
+    prompt_key = extraction_prompt_key()
+    try:
+        if cache is not None:
+            for custom_id, article in articles_by_id.items():
+                if custom_id not in state['results']:
+                    cached = cache.get('claude', CLAUDE_MODEL, prompt_key, article['content'])
+                    if cached is not None:
+                        state['results'][custom_id] = cached
+
+        for round_number in range(max_rounds):
+            submit_message_batches(client, articles_by_id, state, state_file)
+            collect_message_batch_results(client, state, state_file, poll_interval)
+            if all(custom_id in state['results'] for custom_id in articles_by_id):
+                break
+            logging.info(f"Round {round_number+1} left articles unresolved; resubmitting")
+
+        if cache is not None:
+            for custom_id, result in state['results'].items():
+                if (custom_id in articles_by_id and not is_skipped(result)
+                        and 'error' not in result and 'validation_errors' not in result):
+                    cache.put('claude', CLAUDE_MODEL, prompt_key, articles_by_id[custom_id]['content'], result)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    results = [
+        state['results'].get(custom_id, {"error": "No batch result after resubmission"})
+        for custom_id in articles_by_id
+    ]
+    if clusters is not None:
+        results = propagate_results(clustered_articles, clusters, [
+            state['results'].get(custom_id, {"error": "No batch result after resubmission"})
+            for custom_id in ids
+        ])
+    skipped = sum(map(is_skipped, results))
+    if skipped:
+        logging.info(f"Skipped {skipped} articles as irrelevant")
+        results = [result for result in results if not is_skipped(result)]
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_file = f'processed_articles_{timestamp}.json'
-    
+
     logging.info(f"Saving results to {output_file}")
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(results, f, indent=2, ensure_ascii=False)
-        
-    logging.info("Batch processing completed")
+
+    # The run is complete; the next run should start a fresh set of batches. Nothing
+    # is written when every article was cached or skipped, so there may be no file.
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    logging.info("Message batch processing completed")
     return output_file
 
+class TestMessageBatchesMode(unittest.TestCase):
+    """Runs batch mode end to end against a local stand-in of the batches endpoint."""
+
+    def setUp(self):
+        import tempfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server_state = self.server_state = {'batches': {}, 'creates': 0, 'polls_before_end': 1}
+
+        class StandInBatches(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body, content_type='application/json'):
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def batch_body(self, batch_id):
+                batch = server_state['batches'][batch_id]
+                ended = batch['polls'] > server_state['polls_before_end']
+                host = f"http://127.0.0.1:{self.server.server_address[1]}"
+                return json.dumps({
+                    'id': batch_id,
+                    'type': 'message_batch',
+                    'processing_status': 'ended' if ended else 'in_progress',
+                    'request_counts': {'processing': 0, 'succeeded': len(batch['requests']),
+                                       'errored': 0, 'canceled': 0, 'expired': 0},
+                    'created_at': '2024-01-01T00:00:00Z',
+                    'expires_at': '2024-01-02T00:00:00Z',
+                    'results_url': f"{host}/v1/messages/batches/{batch_id}/results" if ended else None,
+                })
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server_state['creates'] += 1
+                batch_id = f"msgbatch_{server_state['creates']}"
+                server_state['batches'][batch_id] = {'requests': body['requests'], 'polls': 0}
+                self.send_json(self.batch_body(batch_id))
+
+            def do_GET(self):
+                parts = self.path.split('?')[0].strip('/').split('/')
+                batch_id = parts[3]
+                if parts[-1] == 'results':
+                    lines = [json.dumps({
+                        'custom_id': request['custom_id'],
+                        'result': {'type': 'succeeded', 'message': {
+                            'id': 'msg_1', 'type': 'message', 'role': 'assistant', 'model': CLAUDE_MODEL,
+                            'content': [{'type': 'text', 'text': json.dumps({'id': request['custom_id']})}],
+                            'stop_reason': 'end_turn', 'stop_sequence': None,
+                            'usage': {'input_tokens': 10, 'output_tokens': 5, 'cache_read_input_tokens': 300,
+                                      'cache_creation_input_tokens': 40}}}
+                    }) for request in server_state['batches'][batch_id]['requests']]
+                    self.send_json('\n'.join(lines), 'application/binary')
+                else:
+                    server_state['batches'][batch_id]['polls'] += 1
+                    self.send_json(self.batch_body(batch_id))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInBatches)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.workdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        os.environ.setdefault('ANTHROPIC_API_KEY', 'test-key')
+        self.articles = [{'url': f'https://example.com/{i}', 'content': f'Article {i}'} for i in range(5)]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.server.shutdown()
+        self.workdir.cleanup()
+
+    def test_results_map_back_to_articles(self):
+        import news_telemetry
+        store = news_telemetry.TelemetryStore('metrics.db')
+        with patch.object(news_telemetry, 'default_store', store):
+            output_file = process_articles_with_message_batches(self.articles, poll_interval=0,
+                                                                base_url=self.base_url, use_cache=False)
+        with open(output_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        self.assertEqual([result['id'] for result in results], [article_id(a) for a in self.articles])
+        self.assertFalse(os.path.exists(BATCH_STATE_FILE))
+        # Cache reads and writes are both part of the input, and writes are billed at their premium
+        rows = store.conn.execute('SELECT input_tokens, cached_input_tokens, cache_write_tokens FROM llm_calls').fetchall()
+        store.close()
+        self.assertEqual(rows, [(350, 300, 40)] * len(self.articles))
+
+    def test_resume_polls_instead_of_resubmitting(self):
+        client = anthropic.Anthropic(api_key='test-key', base_url=self.base_url)
+        state = load_batch_state(BATCH_STATE_FILE)
+        submit_message_batches(client, {article_id(a): a for a in self.articles}, state, BATCH_STATE_FILE)
+        self.assertEqual(self.server_state['creates'], 1)
+
+        # Simulate a crash after submission: a fresh call picks the batch up from the state file
+        output_file = process_articles_with_message_batches(self.articles, poll_interval=0,
+                                                            base_url=self.base_url, use_cache=False)
+        self.assertEqual(self.server_state['creates'], 1)
+        with open(output_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(len(json.load(f)), len(self.articles))
+
+    def test_fully_cached_run_submits_nothing(self):
+        cache = ExtractionCache()
+        try:
+            for article in self.articles:
+                cache.put('claude', CLAUDE_MODEL, extraction_prompt_key(), article['content'],
+                          {'id': f"cached {article_id(article)}"})
+        finally:
+            cache.close()
+        output_file = process_articles_with_message_batches(self.articles, poll_interval=0, base_url=self.base_url)
+        with open(output_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        self.assertEqual(self.server_state['creates'], 0)
+        self.assertEqual([result['id'] for result in results], [f"cached {article_id(a)}" for a in self.articles])
+        self.assertFalse(os.path.exists(BATCH_STATE_FILE))
+
+    def test_skipped_articles_are_not_submitted(self):
+        class StandInFilter:
+            def check(self, article):
+                if 'irrelevant' in article['content']:
+                    return {"status": "skipped", "reason": "Skipped as irrelevant"}
+
+        class StandInCondenser:
+            def condense_articles(self, articles):
+                return [dict(article, content=article['content'][:12]) for article in articles]
+
+        # Without URLs the ids come from the content, which condensing changes
+        articles = [{'content': f'Article {i} is irrelevant filler'} for i in range(2)]
+        articles += [{'content': f'Article {i} about earnings'} for i in range(2, 4)]
+        output_file = process_articles_with_message_batches(articles, poll_interval=0, base_url=self.base_url,
+                                                            use_cache=True, condenser=StandInCondenser(),
+                                                            relevance_filter=StandInFilter())
+        with open(output_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        submitted = [request['custom_id'] for batch in self.server_state['batches'].values()
+                     for request in batch['requests']]
+        self.assertEqual(submitted, [article_id(a) for a in articles[2:]])
+        self.assertEqual([result['id'] for result in results], submitted)
+        cache = ExtractionCache()
+        try:
+            self.assertIsNone(cache.get('claude', CLAUDE_MODEL, extraction_prompt_key(), 'Article 0 is '))
+        finally:
+            cache.close()
+
+class TestProcessArticlesBatch(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.workdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def test_skipped_articles_are_left_out(self):
+        articles = [{'url': 'https://example.com/0', 'content': 'Weather report'},
+                    {'url': 'https://example.com/1', 'content': ''},
+                    {'url': 'https://example.com/2', 'content': 'Earnings beat'},
+                    {'url': 'https://example.com/3', 'content': 'Guidance cut'}]
+        processed = [{"status": "skipped", "reason": "Skipped as irrelevant"}, {"error": "No content"},
+                     {"id": "2"}, {"error": "Max retries reached"}]
+        with patch(f'{__name__}.extract_articles_with_ledger', return_value=processed):
+            output_file = process_articles_batch(articles, ledger_path='ledger.jsonl')
+        with open(output_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f), [{"id": "2"}, {"error": "Max retries reached"}])
+
 if __name__ == "__main__":
+    parser = add_engine_arguments(argparse.ArgumentParser(description="Extract structured data from articles with Claude"))
+    add_checkpoint_arguments(parser, LEDGER_FILE)
+    add_condense_arguments(parser)
+    add_relevance_arguments(parser)
+    add_clustering_arguments(parser)
+    parser.add_argument('--batch', action='store_true', help='Submit through the Message Batches API (resumable)')
+    parser.add_argument('--poll-interval', type=int, default=60, help='Seconds between batch status polls')
+    parser.add_argument('--base-url', default=None, help='Override the Anthropic API base URL')
+    args = parser.parse_args()
+
     logging.info("Script started")
     try:
         with open('scraped_articles_results.json', 'r', encoding='utf-8') as f:
@@ -151,7 +450,18 @@ if __name__ == "__main__":
         # Process only successfully scraped articles
         successful_articles = scraped_data['successful_articles']
         logging.info(f"Found {len(successful_articles)} successful articles to process")
-        output_file = process_articles_batch(successful_articles)
+        if args.batch:
+            output_file = process_articles_with_message_batches(successful_articles, poll_interval=args.poll_interval,
+                                                                base_url=args.base_url, use_cache=not args.no_cache,
+                                                                condenser=condenser_from_args(args),
+                                                                relevance_filter=relevance_filter_from_args(args),
+                                                                clusterer=clusterer_from_args(args))
+        else:
+            output_file = process_articles_batch(successful_articles, ledger_path=args.ledger,
+                                                 resume=args.resume, condenser=condenser_from_args(args),
+                                                 relevance_filter=relevance_filter_from_args(args),
+                                                 clusterer=clusterer_from_args(args),
+                                                 **engine_options_from_args(args))
         logging.info(f"Processing completed. Results saved to {output_file}")
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
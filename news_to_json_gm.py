@@ -1,11 +1,13 @@
 import json
-import os
 from datetime import datetime
 import logging
 from dotenv import load_dotenv
-import time
-import google.generativeai as genai
-import re
+import argparse
+from news_extraction_engine import add_engine_arguments, engine_options_from_args, is_skipped
+from news_checkpoint import ExtractionLedger, add_checkpoint_arguments, extract_articles_with_ledger
+from news_condense import add_condense_arguments, condenser_from_args
+from news_relevance import add_relevance_arguments, relevance_filter_from_args
+from news_clustering import add_clustering_arguments, clusterer_from_args
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,142 +15,44 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_article_with_gemini(article_text):
-    logging.info("Starting to process article with Gemini")
+LEDGER_FILE = 'extraction_ledger_gemini.jsonl'
 
-    prompt = """You are a financial news analyzer. Your task is to extract structured information from financial news articles and output it in JSON format. Follow these specific guidelines:
-
-1. Output Structure Required:
-{{
-    "news_article": {{
-        "id": string,            // Create unique based on ticker_date_type
-        "title": string,
-        "publishedDate": string, // ISO format
-        "source": string,
-        "url": string,
-        "type": string          // Type of news article
-    }},
-    "company": {{
-        "ticker": string,
-        "name": string,
-        "exchange": string
-    }},
-    "market_event": {{
-        "type": string,         // Main event type
-        "key_points": object,   // Key numerical or factual points
-        "major_shareholders": [ // If ownership related
-            {{
-                "name": string,
-                "ownership_percentage": number,
-                "type": string
-            }}
-        ]
-    }},
-    "analysis": {{
-        "key_findings": string[],
-        "sentiment": string,    // positive, negative, neutral
-        "risk_factors": string[]
-    }},
-    "event_classification": {{
-        "primary_type": string, // Corporate Governance, Financial, Product, Market
-        "sub_type": string,     // More specific classification
-        "severity": number,     // 1-5 scale
-        "confidence": number,   // 0-1 scale
-        "impact_duration": string // SHORT_TERM, MEDIUM_TERM, LONG_TERM
-    }}
-}}
-
-Please process the following news article and output the JSON according to these specifications:
-
-{article_text}
-
-Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted."""
-
-    logging.info("Sending request to Gemini")
-    max_retries = 5
-    retry_delay = 1
-
-    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-
-    generation_config = {
-        "temperature": 0,
-        "top_p": 0.95,
-        "top_k": 40,
-        "max_output_tokens": 8192,
-        "response_mime_type": "text/plain",
-    }
-
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-flash",
-        generation_config=generation_config,
-    )
-
-    chat_session = model.start_chat(history=[])
-
-    for attempt in range(max_retries):
-        try:
-            response = chat_session.send_message(prompt.format(article_text=article_text))
-            logging.info("Received response from Gemini")
-
-            try:
-                # Remove ```json and ``` from the response
-                json_content = re.sub(r'^```json\s*|\s*```$', '', response.text.strip())
-                parsed_response = json.loads(json_content)
-                logging.info("Successfully parsed Gemini's response as JSON")
-                return parsed_response
-            except json.JSONDecodeError as e:
-                logging.error("Failed to parse Gemini's response as JSON")
-                logging.error(f"Raw response: {response.text}")
-                logging.error(f"JSON parse error: {str(e)}")
-                return {
-                    "error": "Failed to parse Gemini's response as JSON",
-                    "raw_response": response.text,
-                    "parse_error": str(e)
-                }
-
-        except Exception as e:
-            if attempt < max_retries - 1:
-                logging.warning(f"Request failed. Retrying in {retry_delay} seconds... Error: {str(e)}")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-            else:
-                logging.error(f"Max retries reached. Unable to process article. Error: {str(e)}")
-                return {"error": f"Max retries reached. Error: {str(e)}"}
-
-def process_articles_batch(articles):
+def process_articles_batch(articles, ledger_path=LEDGER_FILE, resume=False, **engine_options):
     """
     Process a batch of articles and save results to JSON
     
     Args:
         articles: List of dicts containing article info including 'content' field
+        ledger_path: Append-only ledger every result is checkpointed to as it arrives
+        resume: Skip articles the ledger already has a successful result for
+        engine_options: Concurrency, rate limit, condenser, relevance filter and clustering settings
     """
     logging.info(f"Starting to process batch of {len(articles)} articles")
     results = []
     failures = []
+    skipped = 0
+
+    ledger = ExtractionLedger(ledger_path, resume=resume)
+    try:
+        processed_articles = extract_articles_with_ledger('gemini', articles, ledger, **engine_options)
+    finally:
+        ledger.close()
     
-    for i, article in enumerate(articles):
-        logging.info(f"Processing article {i+1}/{len(articles)}")
-        if article.get('content'):
-            processed = process_article_with_gemini(article['content'])
-            if 'error' in processed:
-                failures.append({
-                    'article_index': i,
-                    'error': processed['error'],
-                    'raw_response': processed.get('raw_response'),
-                    'parse_error': processed.get('parse_error')
-                })
-                logging.error(f"Failed to process article {i+1}. Error: {processed['error']}")
-            else:
-                results.append(processed)
-        else:
+    for i, processed in enumerate(processed_articles):
+        if 'error' in processed:
             failures.append({
                 'article_index': i,
-                'error': 'Article has no content'
+                'error': processed['error'],
+                'raw_response': processed.get('raw_response'),
+                'parse_error': processed.get('parse_error')
             })
-            logging.warning(f"Article {i+1} has no content, skipping")
-        
-        # Add a delay between requests to avoid rate limiting
-        time.sleep(3)  # Adjust this value as needed
+            logging.error(f"Failed to process article {i+1}. Error: {processed['error']}")
+        elif is_skipped(processed):
+            skipped += 1
+        else:
+            results.append(processed)
+    if skipped:
+        logging.info(f"Skipped {skipped} articles as irrelevant")
             
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_file = f'processed_articles_{timestamp}.json'
@@ -166,6 +70,13 @@ def process_articles_batch(articles):
     return output_file, failures_file
 
 if __name__ == "__main__":
+    parser = add_engine_arguments(argparse.ArgumentParser(description="Extract structured data from articles with Gemini"))
+    add_checkpoint_arguments(parser, LEDGER_FILE)
+    add_condense_arguments(parser)
+    add_relevance_arguments(parser)
+    add_clustering_arguments(parser)
+    args = parser.parse_args()
+
     logging.info("Script started")
     try:
         with open('scraped_articles_results.json', 'r', encoding='utf-8') as f:
@@ -175,7 +86,11 @@ if __name__ == "__main__":
         # Process only successfully scraped articles
         successful_articles = scraped_data['successful_articles']
         logging.info(f"Found {len(successful_articles)} successful articles to process")
-        output_file, failures_file = process_articles_batch(successful_articles)
+        output_file, failures_file = process_articles_batch(successful_articles, ledger_path=args.ledger,
+                                                            resume=args.resume, condenser=condenser_from_args(args),
+                                                            relevance_filter=relevance_filter_from_args(args),
+                                                            clusterer=clusterer_from_args(args),
+                                                            **engine_options_from_args(args))
         logging.info(f"Processing completed. Results saved to {output_file}")
         logging.info(f"Failures logged to {failures_file}")
     except Exception as e:
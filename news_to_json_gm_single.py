@@ -1,13 +1,30 @@
 import json
 import os
+import argparse
+import time
+import tempfile
+import unittest
 from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
 import logging
 from dotenv import load_dotenv
 import google.generativeai as genai
-import re
 import atexit
 import google.api_core.grpc_helpers
+from google.api_core import exceptions as google_exceptions
 from google.cloud import aiplatform
+from news_extraction_engine import article_id, estimate_tokens
+from news_json_stream import IncrementalArrayParser, article_index_of
+from news_checkpoint import ExtractionLedger, add_checkpoint_arguments
+from news_condense import add_condense_arguments, condenser_from_args
+from news_relevance import add_relevance_arguments, relevance_filter_from_args
+from news_clustering import add_clustering_arguments, clusterer_from_args, propagate_results
+from news_compact import compact_schema, expand_compact
+from news_inflection import InflectionIndex, add_inflection_arguments, sort_by_date
+from news_schema import SchemaValidator
+import news_telemetry
+from news_telemetry import record_llm_call
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,160 +32,317 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_articles_with_gemini(articles):
-    logging.info("Starting to process articles with Gemini")
+ARTICLE_SEPARATOR = "\n\n---ARTICLE SEPARATOR---\n\n"
+# gemini-1.5-pro accepts 2M input tokens; stay well under it so the estimate's error can't overflow
+MAX_INPUT_TOKENS = 1000000
+MAX_OUTPUT_TOKENS = 8192
+# Estimated size of one article's JSON object in the response, with headroom
+OUTPUT_TOKENS_PER_ARTICLE = 600
+# The same for the compact form (news_compact), which is ~40% of the full object's size
+COMPACT_OUTPUT_TOKENS_PER_ARTICLE = 250
 
-    # Load inflection points
-    with open('inflection_points_OXY.json', 'r') as f:
-        inflection_points = json.load(f)
+def format_article(index, article):
+    return f"[ARTICLE {index}]\n{article['content']}"
 
-    prompt = """You are a financial news analyzer. Your task is to extract structured information from multiple financial news articles and output it in JSON format. Follow these specific guidelines:
+def pack_articles(indexed_articles, fixed_tokens, input_budget=MAX_INPUT_TOKENS,
+                  output_budget=MAX_OUTPUT_TOKENS, output_tokens_per_article=OUTPUT_TOKENS_PER_ARTICLE):
+    """
+    Groups (index, article) pairs into batches that fit both token budgets.
+
+    Each batch's prompt (fixed_tokens plus every article) stays under input_budget.
+    Its expected response (output_tokens_per_article per article) stays under
+    output_budget, so the JSON array is not cut off at max_output_tokens. An article
+    too long for the input budget on its own still gets a batch to itself.
+    """
+    batches = []
+    batch = []
+    batch_input = fixed_tokens
+    separator_tokens = estimate_tokens(ARTICLE_SEPARATOR)
+    for index, article in indexed_articles:
+        article_tokens = estimate_tokens(format_article(index, article)) + separator_tokens
+        fits_input = batch_input + article_tokens <= input_budget
+        fits_output = (len(batch) + 1) * output_tokens_per_article <= output_budget
+        if batch and not (fits_input and fits_output):
+            batches.append(batch)
+            batch = []
+            batch_input = fixed_tokens
+        batch.append((index, article))
+        batch_input += article_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+MULTI_ARTICLE_INSTRUCTIONS = """You are a financial news analyzer. Your task is to extract structured information from multiple financial news articles and output it in JSON format. Follow these specific guidelines:
 
 1. Output Structure Required:
 [
-  {{
-    "news_article": {{
+  {
+    "article_index": number,    // The n from the article's [ARTICLE n] label
+    "news_article": {
         "id": string,            // Create unique based on ticker_date_type
         "title": string,
         "publishedDate": string, // ISO format
         "source": string,
         "url": string,
         "type": string          // Type of news article
-    }},
-    "company": {{
+    },
+    "company": {
         "ticker": string,
         "name": string,
         "exchange": string
-    }},
-    "market_event": {{
+    },
+    "market_event": {
         "type": string,         // Main event type
         "key_points": object,   // Key numerical or factual points
         "major_shareholders": [ // If ownership related
-            {{
+            {
                 "name": string,
                 "ownership_percentage": number,
                 "type": string
-            }}
+            }
         ]
-    }},
-    "analysis": {{
+    },
+    "analysis": {
         "key_findings": string[],
         "sentiment": string,    // positive, negative, neutral
         "risk_factors": string[]
-    }},
-    "event_classification": {{
+    },
+    "event_classification": {
         "primary_type": string, // Corporate Governance, Financial, Product, Market
         "sub_type": string,     // More specific classification
         "severity": number,     // 1-5 scale
         "confidence": number,   // 0-1 scale
         "impact_duration": string // SHORT_TERM, MEDIUM_TERM, LONG_TERM
-    }},
-    "inflection_point": {{
+    },
+    "inflection_point": {
         "date": string,
         "price": number,
         "relevance_ranking": number,
         "reasoning": string     // Chain of thought in 140 characters
-    }}
-  }}
+    }
+  }
 ]
 
-Consider these inflection points for OXY stock:
+Consider the inflection points for OXY stock given before the articles; they cover the dates around the articles.
+
+For each article, identify the most relevant inflection point based on the event classification, specific impact on financials, and overall market sentiment. Rank the relevance of each article to its identified inflection point (1 being most relevant). Include a concise chain of thought (140 characters) explaining the relevance.
+
+Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted. The output should be an array of JSON objects, one for each article processed, in the order the articles were given."""
+
+# Compact variant: short keys and positional arrays, expanded locally by news_compact.expand_compact
+COMPACT_MULTI_ARTICLE_INSTRUCTIONS = """You are a financial news analyzer. Your task is to extract structured information from multiple financial news articles and output it in JSON format. Follow these specific guidelines:
+
+{compact_schema}
+
+Consider the inflection points for OXY stock given before the articles; they cover the dates around the articles.
+
+For each article, identify the most relevant inflection point based on the event classification, specific impact on financials, and overall market sentiment. Rank the relevance of each article to its identified inflection point (1 being most relevant). Include a concise chain of thought (140 characters) explaining the relevance.
+
+Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted. The output should be an array of JSON objects, one for each article processed, in the order the articles were given."""
+
+ARTICLES_TEMPLATE = """Inflection points for OXY stock around these articles' dates:
 {inflection_points}
 
 Please process the following news articles and output the JSON according to these specifications:
 
-{article_texts}
+{article_texts}"""
 
-For each article, identify the most relevant inflection point based on the event classification, specific impact on financials, and overall market sentiment. Rank the relevance of each article to its identified inflection point (1 being most relevant). Include a concise chain of thought (140 characters) explaining the relevance.
+GEMINI_MODEL = "gemini-1.5-pro"
+
+LEDGER_FILE = 'extraction_ledger_gemini_multi.jsonl'
+SCHEMA_VALIDATOR = SchemaValidator()
 
-Important: Only output the JSON structure with no additional explanation or commentary. Ensure the JSON is valid and properly formatted. The output should be an array of JSON objects, one for each article processed."""
+def format_inflection_points(inflection_points):
+    return json.dumps(inflection_points, indent=2)
 
-    logging.info("Sending request to Gemini")
+def build_instructions(compact=False):
+    if compact:
+        return COMPACT_MULTI_ARTICLE_INSTRUCTIONS.format(
+            compact_schema=compact_schema(multi_article=True, inflection_point=True))
+    return MULTI_ARTICLE_INSTRUCTIONS
 
+def create_gemini_model(compact=False):
+    """
+    Builds the model with the schema as a fixed prefix.
+
+    The prefix is identical for every batch in a run and goes in the system
+    instruction. At about 1.5k tokens it is far below the 32k Gemini needs for a
+    CachedContent, and the articles and inflection points after it change with
+    every batch, so no explicit context cache is made.
+    """
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 
     generation_config = {
         "temperature": 0,
         "top_p": 0.95,
         "top_k": 40,
-        "max_output_tokens": 8192,
+        "max_output_tokens": MAX_OUTPUT_TOKENS,
         "response_mime_type": "text/plain",
     }
-
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-pro",
+    return genai.GenerativeModel(
+        model_name=GEMINI_MODEL,
         generation_config=generation_config,
+        system_instruction=build_instructions(compact),
     )
 
-    article_texts = "\n\n---ARTICLE SEPARATOR---\n\n".join([article['content'] for article in articles if article.get('content')])
-    
-    try:
-        response = model.generate_content(prompt.format(
-            inflection_points=json.dumps(inflection_points, indent=2),
-            article_texts=article_texts
-        ))
-        logging.info("Received response from Gemini")
+def prompt_overhead_tokens(inflection_index, compact=False):
+    """Tokens used by the prompt before any article text is added, counting every inflection point as an upper bound."""
+    return (estimate_tokens(build_instructions(compact)) + estimate_tokens(ARTICLES_TEMPLATE)
+            + estimate_tokens(format_inflection_points(inflection_index.points)))
 
-        try:
-            # Clean up the response text
-            json_content = response.text.strip()
-            # Remove any markdown code block indicators
-            json_content = re.sub(r'^```json\s*|\s*```$', '', json_content)
-            # Remove any trailing commas before closing brackets/braces
-            json_content = re.sub(r',(\s*[}\]])', r'\1', json_content)
-            # Clean up any potential whitespace issues
-            json_content = json_content.strip()
-            
-            try:
-                parsed_response = json.loads(json_content)
-                logging.info("Successfully parsed Gemini's response as JSON")
-                return parsed_response
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON parse error: {str(e)}")
-                logging.error(f"Problematic JSON content: {json_content}")
-                logging.error(f"Error position: {e.pos}")
-                logging.error(f"Error line number: {e.lineno}")
-                logging.error(f"Error column number: {e.colno}")
-                logging.error(f"Error message: {e.msg}")
-                
-                # Log the surrounding context of the error
-                error_context = json_content[max(0, e.pos - 50):min(len(json_content), e.pos + 50)]
-                logging.error(f"Error context: {error_context}")
-                
-                # Attempt to identify specific JSON formatting issues
-                if "Expecting property name enclosed in double quotes" in str(e):
-                    logging.error("Possible missing quotes around a property name")
-                elif "Expecting ',' delimiter" in str(e):
-                    logging.error("Possible missing comma between elements")
-                elif "Expecting value" in str(e):
-                    logging.error("Possible missing value for a property")
-                
-                # Return error information instead of empty list
-                return [{
-                    "error": "JSON parse error",
-                    "error_details": str(e),
-                    "error_position": e.pos,
-                    "error_line": e.lineno,
-                    "error_column": e.colno,
-                    "error_context": error_context,
-                    "raw_response": json_content
-                }]
+# Batch failures where part of the response is still usable, so retrying only the rest is worthwhile
+RETRYABLE_ERRORS = ("JSON parse error", "Response truncated", "Stream interrupted")
+# API errors that are waited out and the same batch resent: quota exhausted (429) and transient server failures
+BACKOFF_ERRORS = ("Rate limited", "Service unavailable")
+TRANSIENT_EXCEPTIONS = (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                        google_exceptions.DeadlineExceeded)
+MAX_BACKOFF_RETRIES = 5
+BACKOFF_DELAY_SECONDS = 2
 
-        except Exception as e:
-            logging.error(f"Error cleaning response text: {str(e)}")
-            logging.error(f"Raw response: {response.text}")
-            return [{
-                "error": "Error cleaning response text",
-                "error_details": str(e),
-                "raw_response": response.text
-            }]
+def request_gemini_batch(model, indexed_articles, inflection_index, on_object=None):
+    """
+    Streams one multi-article request and decodes each article object as it arrives.
+
+    on_object(obj) is called for every object the moment it completes, so downstream
+    work can start before the response finishes. Returns (objects, complete, error).
+    complete is False when the response was cut off at max_output_tokens, ended
+    early, or contained malformed objects. Those objects are skipped, not fatal.
+    Only the inflection points near the batch's article dates are attached.
+    Compact-form objects are expanded to the full structure first. Decoded objects
+    are schema-coerced and carry "validation_errors" for fields that remain invalid.
+    """
+    articles_by_index = dict(indexed_articles)
+    article_texts = ARTICLE_SEPARATOR.join(format_article(index, article) for index, article in indexed_articles)
+    inflection_points = inflection_index.for_articles([article for _, article in indexed_articles])
+    parser = IncrementalArrayParser()
+    objects = []
+    malformed = []
+    finish_reason = None
 
+    logging.info(f"Sending request to Gemini with {len(indexed_articles)} articles and "
+                 f"{len(inflection_points)} of {len(inflection_index)} inflection points")
+    started = time.monotonic()
+    ttfb = None
+    try:
+        response = model.generate_content(ARTICLES_TEMPLATE.format(
+            inflection_points=format_inflection_points(inflection_points), article_texts=article_texts), stream=True)
+        for chunk in response:
+            if ttfb is None:
+                ttfb = time.monotonic() - started
+            if chunk.candidates and chunk.candidates[0].finish_reason:
+                finish_reason = chunk.candidates[0].finish_reason.name
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks that carry only metadata (e.g. the final finish_reason) have no text
+                continue
+            for kind, value, raw in parser.feed(text):
+                if kind == 'object':
+                    if isinstance(value, dict):
+                        value = expand_compact(value, articles_by_index.get(value.get('x')))
+                    value = SCHEMA_VALIDATOR.annotate(value)
+                    objects.append(value)
+                    if on_object:
+                        on_object(value)
+                else:
+                    index = article_index_of(raw)
+                    logging.error(f"Malformed object for article {index}: {value}")
+                    malformed.append({"article_index": index, "parse_error": value, "raw": raw})
+        logging.info(f"Received response from Gemini: {parser.objects} objects, {parser.malformed} malformed")
+        usage = response.usage_metadata
+        record_llm_call(provider='gemini', model=GEMINI_MODEL, purpose='multi_extract', articles=len(indexed_articles),
+                        input_tokens=usage.prompt_token_count,
+                        cached_input_tokens=getattr(usage, 'cached_content_token_count', 0) or 0,
+                        output_tokens=usage.candidates_token_count, ttfb=ttfb, latency=time.monotonic() - started)
     except Exception as e:
-        logging.error(f"Error processing articles: {str(e)}")
-        return [{
-            "error": "Error processing articles",
+        record_llm_call(provider='gemini', model=GEMINI_MODEL, purpose='multi_extract', articles=len(indexed_articles),
+                        ttfb=ttfb, latency=time.monotonic() - started, error=str(e))
+        if not objects:
+            logging.error(f"Error processing articles: {str(e)}")
+            if isinstance(e, google_exceptions.ResourceExhausted):
+                error = "Rate limited"
+            elif isinstance(e, TRANSIENT_EXCEPTIONS):
+                error = "Service unavailable"
+            else:
+                error = "Error processing articles"
+            return [], True, {
+                "error": error,
+                "error_details": str(e)
+            }
+        logging.warning(f"Gemini stream interrupted after {len(objects)} objects: {e}")
+        return objects, False, {
+            "error": "Stream interrupted",
             "error_details": str(e)
-        }]
+        }
+
+    if finish_reason == 'MAX_TOKENS' or parser.truncated:
+        logging.warning(f"Gemini's response was truncated (finish reason {finish_reason})")
+        return objects, False, {
+            "error": "Response truncated",
+            "finish_reason": finish_reason,
+            "malformed_objects": malformed
+        }
+    if malformed:
+        return objects, False, {
+            "error": "JSON parse error",
+            "malformed_objects": malformed
+        }
+    return objects, True, None
+
+def process_articles_with_gemini(indexed_articles, model, inflection_index, on_object=None, backoff_retries=0):
+    """
+    Extracts a packed batch of (index, article) pairs, retrying only what is missing.
+
+    Objects are matched to articles by article_index. If the response was truncated
+    or malformed, the articles it did not cover are retried. They are retried as
+    one batch when the response made progress, and split in half when it made none.
+    A rate limit (429) or transient API error resends the same batch after an
+    exponential backoff, up to MAX_BACKOFF_RETRIES times.
+    A single article that still fails gets an error record.
+    """
+    indexed_articles = [(index, article) for index, article in indexed_articles if article.get('content')]
+    if not indexed_articles:
+        return []
+
+    objects, complete, error = request_gemini_batch(model, indexed_articles, inflection_index, on_object)
+    wanted = {index for index, _ in indexed_articles}
+    by_index = {}
+    for obj in objects:
+        if isinstance(obj, dict) and obj.get('article_index') in wanted:
+            by_index[obj['article_index']] = obj
+    if complete and not by_index and len(objects) == len(indexed_articles):
+        # The model dropped article_index; a complete array is still in input order
+        by_index = {index: obj for (index, _), obj in zip(indexed_articles, objects)}
+        for index, obj in by_index.items():
+            if isinstance(obj, dict):
+                obj['article_index'] = index
+
+    results = [by_index[index] for index, _ in indexed_articles if index in by_index]
+    missing = [(index, article) for index, article in indexed_articles if index not in by_index]
+    if not missing:
+        return results
+
+    if error is not None and error.get("error") in BACKOFF_ERRORS and backoff_retries < MAX_BACKOFF_RETRIES:
+        retry_delay = BACKOFF_DELAY_SECONDS * 2 ** backoff_retries
+        logging.warning(f"{error['error']}; retrying {len(missing)} articles in {retry_delay} seconds")
+        time.sleep(retry_delay)
+        return results + process_articles_with_gemini(missing, model, inflection_index, on_object, backoff_retries + 1)
+
+    retryable = error is None or error.get("error") in RETRYABLE_ERRORS
+    if not retryable or (len(missing) == 1 and not by_index):
+        logging.error(f"Giving up on {len(missing)} articles: {error}")
+        return results + [dict(error or {"error": "Article missing from response"}, article_index=index)
+                          for index, _ in missing]
+
+    if by_index:
+        logging.info(f"Retrying {len(missing)} articles missing from the response")
+        return results + process_articles_with_gemini(missing, model, inflection_index, on_object)
+
+    half = len(missing) // 2
+    logging.info(f"No usable objects in response; splitting {len(missing)} articles into {half} and {len(missing) - half}")
+    return (results
+            + process_articles_with_gemini(missing[:half], model, inflection_index, on_object)
+            + process_articles_with_gemini(missing[half:], model, inflection_index, on_object))
 
 def save_batch_results(batch_results, batch_number):
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -187,7 +361,28 @@ def cleanup_grpc():
     except Exception as e:
         logging.warning(f"gRPC cleanup warning: {e}")
 
+def record_batch_results(ledger, ids, batch_results):
+    """Checkpoints a batch's outcomes that were not already recorded as they streamed in."""
+    for result in batch_results:
+        index = result.get('article_index') if isinstance(result, dict) else None
+        if index is None or index >= len(ids):
+            continue
+        if 'error' in result:
+            ledger.record_failure(ids[index], result, index)
+        elif ids[index] not in ledger.completed_ids():
+            ledger.record_success(ids[index], result, index)
+
 def main():
+    parser = argparse.ArgumentParser(description="Extract and rank articles against inflection points with Gemini")
+    add_checkpoint_arguments(parser, LEDGER_FILE)
+    add_condense_arguments(parser)
+    add_relevance_arguments(parser)
+    add_clustering_arguments(parser)
+    add_inflection_arguments(parser)
+    parser.add_argument('--compact-output', action='store_true',
+                        help='Ask for short-key output and expand it locally; fits more articles per batch')
+    args = parser.parse_args()
+
     try:
         # Register cleanup function
         atexit.register(cleanup_grpc)
@@ -201,21 +396,80 @@ def main():
             successful_articles = scraped_data['successful_articles']
             total_articles = len(successful_articles)
             logging.info(f"Total successful articles: {total_articles}")
+
+            inflection_index = InflectionIndex.load('inflection_points_OXY.json', args.inflection_window_days)
+
+            ids = [article_id(article) for article in successful_articles]
+            ledger = ExtractionLedger(args.ledger, resume=args.resume)
+            completed = ledger.completed_ids()
+            indexed_articles = [(i, article) for i, article in enumerate(successful_articles)
+                                if article.get('content') and ids[i] not in completed]
+            relevance_filter = relevance_filter_from_args(args)
+            if relevance_filter is not None:
+                kept = []
+                for i, article in indexed_articles:
+                    skip = relevance_filter.check(article)
+                    if skip is None:
+                        kept.append((i, article))
+                    else:
+                        ledger.record_skip(ids[i], dict(skip, article_index=i), i)
+                indexed_articles = kept
+            clusterer = clusterer_from_args(args)
+            duplicate_of = {}
+            if clusterer is not None:
+                _, clusters = clusterer.representatives([article for _, article in indexed_articles])
+                for members in clusters:
+                    for member in members[1:]:
+                        duplicate_of[indexed_articles[member][0]] = indexed_articles[members[0]][0]
+                indexed_articles = [indexed_articles[members[0]] for members in clusters]
+            condenser = condenser_from_args(args)
+            indexed_articles = [(i, condenser.condense_article(article)) for i, article in indexed_articles]
+            # Date order keeps each packed batch's span, and so its inflection-point window, short
+            indexed_articles = sort_by_date(indexed_articles)
+            pending = {index for index, _ in indexed_articles}
+            logging.info(f"{len(indexed_articles)} articles left to process")
+
+            def on_object(obj):
+                # Checkpoint each article the moment its object is complete in the stream
+                index = obj.get('article_index') if isinstance(obj, dict) else None
+                if index in pending:
+                    ledger.record_success(ids[index], obj, index)
+
+            model = create_gemini_model(args.compact_output)
+            batches = pack_articles(indexed_articles, prompt_overhead_tokens(inflection_index, args.compact_output),
+                                    output_tokens_per_article=(COMPACT_OUTPUT_TOKENS_PER_ARTICLE if args.compact_output
+                                                               else OUTPUT_TOKENS_PER_ARTICLE))
             
-            batch_size = 100
+            try:
+                for batch_number, batch in enumerate(batches, start=1):
+                    logging.info(f"Processing batch {batch_number} of {len(batches)} ({len(batch)} articles)")
+                    
+                    batch_results = process_articles_with_gemini(batch, model, inflection_index, on_object)
+                    record_batch_results(ledger, ids, batch_results)
+                    
+                    save_batch_results(batch_results, batch_number)
+                    
+                    logging.info(f"Completed processing batch {batch_number}")
+            finally:
+                ledger.close()
+
             all_results = []
-            
-            for i in range(0, total_articles, batch_size):
-                batch = successful_articles[i:i+batch_size]
-                batch_number = i//batch_size + 1
-                logging.info(f"Processing batch {batch_number} of {(total_articles + batch_size - 1)//batch_size}")
-                
-                batch_results = process_articles_with_gemini(batch)
-                all_results.extend(batch_results)
-                
-                save_batch_results(batch_results, batch_number)
-                
-                logging.info(f"Completed processing batch {batch_number}")
+            seen = set()
+            for i, current_id in enumerate(ids):
+                if current_id in seen:
+                    continue
+                seen.add(current_id)
+                entry = ledger.entries.get(current_id)
+                if entry is not None:
+                    all_results.append(entry['result'] if entry['status'] in ('success', 'skipped') else entry['failure'])
+                elif i in duplicate_of and ids[duplicate_of[i]] in ledger.entries:
+                    # Near-duplicates share their representative's extraction
+                    representative = duplicate_of[i]
+                    entry = ledger.entries[ids[representative]]
+                    result = entry['result'] if entry['status'] in ('success', 'skipped') else entry['failure']
+                    result = propagate_results([successful_articles[representative], successful_articles[i]],
+                                               [[0, 1]], [result])[1]
+                    all_results.append(dict(result, article_index=i) if 'error' not in result else result)
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             output_file = f'processed_articles_all_{timestamp}.json'
@@ -233,5 +487,91 @@ def main():
         # Ensure cleanup happens even if there's an error
         cleanup_grpc()
 
+class StandInGeminiModel:
+    """Answers generate_content from a script: an exception to raise, or the text chunks to stream."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False):
+        self.calls += 1
+        step = self.script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        return StandInStream(step, SimpleNamespace(prompt_token_count=1000, candidates_token_count=100,
+                                                   cached_content_token_count=0))
+
+class StandInStream:
+    def __init__(self, chunks, usage_metadata):
+        self.chunks = chunks
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        for text in self.chunks:
+            yield SimpleNamespace(candidates=[], text=text)
+
+class TestProcessArticlesWithGemini(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.store = news_telemetry.TelemetryStore(os.path.join(self.workdir.name, 'metrics.db'))
+        self.patches = [patch.object(news_telemetry, 'default_store', self.store), patch('time.sleep')]
+        self.sleep = [p.start() for p in self.patches][1]
+        self.inflection_index = InflectionIndex([{'date': '2024-03-01', 'price': 70.0}])
+        self.articles = [(i, {'url': f'https://example.com/{i}', 'content': f'Article {i}'}) for i in range(2)]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.store.close()
+        self.workdir.cleanup()
+
+    def test_rate_limit_is_retried_after_backoff(self):
+        model = StandInGeminiModel([google_exceptions.ResourceExhausted('quota'),
+                                    google_exceptions.ServiceUnavailable('busy'),
+                                    ['```json\n[{"article_index": 0},', ' {"article_index": 1}]\n```']])
+        results = process_articles_with_gemini(self.articles, model, self.inflection_index)
+        self.assertEqual([result['article_index'] for result in results], [0, 1])
+        self.assertEqual(model.calls, 3)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list],
+                         [BACKOFF_DELAY_SECONDS, BACKOFF_DELAY_SECONDS * 2])
+
+    def test_rate_limit_gives_up_after_max_retries(self):
+        model = StandInGeminiModel([google_exceptions.ResourceExhausted('quota')] * (MAX_BACKOFF_RETRIES + 1))
+        results = process_articles_with_gemini(self.articles, model, self.inflection_index)
+        self.assertEqual(model.calls, MAX_BACKOFF_RETRIES + 1)
+        self.assertEqual([(result['error'], result['article_index']) for result in results],
+                         [("Rate limited", 0), ("Rate limited", 1)])
+
+    def test_bare_object_answer_is_complete(self):
+        # No enclosing array and no article_index: still one complete answer for the one article
+        model = StandInGeminiModel([['{"company": {"ticker": "OXY"}}']])
+        results = process_articles_with_gemini(self.articles[:1], model, self.inflection_index)
+        self.assertEqual(model.calls, 1)
+        self.assertNotIn('error', results[0])
+        self.assertEqual((results[0]['article_index'], results[0]['company']['ticker']), (0, 'OXY'))
+
+class TestPackArticles(unittest.TestCase):
+    def setUp(self):
+        # 400 characters of content is ~100 tokens once labelled and separated
+        self.articles = [(i, {'content': 'x' * 400}) for i in range(10)]
+        self.article_tokens = (estimate_tokens(format_article(0, self.articles[0][1]))
+                               + estimate_tokens(ARTICLE_SEPARATOR))
+
+    def test_batches_stay_under_the_input_budget(self):
+        batches = pack_articles(self.articles, fixed_tokens=50, input_budget=50 + 3 * self.article_tokens)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+        self.assertEqual([index for batch in batches for index, _ in batch], list(range(10)))
+
+    def test_batches_stay_under_the_output_budget(self):
+        batches = pack_articles(self.articles, fixed_tokens=50, output_budget=1000, output_tokens_per_article=250)
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+
+    def test_oversized_article_gets_its_own_batch(self):
+        articles = [(0, {'content': 'short'}), (1, {'content': 'x' * 4000}), (2, {'content': 'short'})]
+        batches = pack_articles(articles, fixed_tokens=50, input_budget=500)
+        self.assertEqual([[index for index, _ in batch] for batch in batches], [[0], [1], [2]])
+        self.assertEqual(pack_articles([], fixed_tokens=50), [])
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
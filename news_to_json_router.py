@@ -0,0 +1,103 @@
+import json
+from datetime import datetime
+import logging
+from dotenv import load_dotenv
+import argparse
+from news_extraction_engine import add_engine_arguments, engine_options_from_args, is_skipped
+from news_checkpoint import ExtractionLedger, add_checkpoint_arguments, extract_articles_with_ledger
+from news_condense import add_condense_arguments, condenser_from_args
+from news_relevance import add_relevance_arguments, relevance_filter_from_args
+from news_clustering import add_clustering_arguments, clusterer_from_args
+from news_router import add_router_arguments, router_options_from_args
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+LEDGER_FILE = 'extraction_ledger_router.jsonl'
+
+def process_articles_batch(articles, ledger_path=LEDGER_FILE, resume=False, router_options=None, **engine_options):
+    """
+    Process a batch of articles across Claude, X.AI and Gemini and save results to JSON
+
+    Args:
+        articles: List of dicts containing article info including 'content' field
+        ledger_path: Append-only ledger every result is checkpointed to as it arrives
+        resume: Skip articles the ledger already has a successful result for
+        router_options: Providers and hedging settings for the RouterBackend
+        engine_options: Concurrency, rate limit, condenser, relevance filter and clustering settings
+    """
+    logging.info(f"Starting to process batch of {len(articles)} articles")
+    results = []
+    failures = []
+    skipped = 0
+
+    ledger = ExtractionLedger(ledger_path, resume=resume)
+    try:
+        processed_articles = extract_articles_with_ledger('router', articles, ledger,
+                                                          backend_options=router_options, **engine_options)
+    finally:
+        ledger.close()
+
+    for i, processed in enumerate(processed_articles):
+        if 'error' in processed:
+            failures.append({
+                'article_index': i,
+                'error': processed['error']
+            })
+            logging.error(f"Failed to process article {i+1}. Error: {processed['error']}")
+        elif is_skipped(processed):
+            skipped += 1
+        else:
+            results.append(processed)
+    if skipped:
+        logging.info(f"Skipped {skipped} articles as irrelevant")
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_file = f'processed_articles_{timestamp}.json'
+    failures_file = f'processing_failures_{timestamp}.json'
+
+    logging.info(f"Saving results to {output_file}")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    logging.info(f"Saving failures to {failures_file}")
+    with open(failures_file, 'w', encoding='utf-8') as f:
+        json.dump(failures, f, indent=2, ensure_ascii=False)
+
+    logging.info("Batch processing completed")
+    return output_file, failures_file
+
+if __name__ == "__main__":
+    parser = add_engine_arguments(argparse.ArgumentParser(
+        description="Extract structured data from articles, routing between Claude, X.AI and Gemini"))
+    add_checkpoint_arguments(parser, LEDGER_FILE)
+    add_condense_arguments(parser)
+    add_relevance_arguments(parser)
+    add_clustering_arguments(parser)
+    add_router_arguments(parser)
+    args = parser.parse_args()
+
+    logging.info("Script started")
+    try:
+        with open('scraped_articles_results.json', 'r', encoding='utf-8') as f:
+            scraped_data = json.load(f)
+        logging.info("Successfully loaded scraped_articles_results.json")
+
+        # Process only successfully scraped articles
+        successful_articles = scraped_data['successful_articles']
+        logging.info(f"Found {len(successful_articles)} successful articles to process")
+        output_file, failures_file = process_articles_batch(successful_articles, ledger_path=args.ledger,
+                                                            resume=args.resume,
+                                                            router_options=router_options_from_args(args),
+                                                            condenser=condenser_from_args(args),
+                                                            relevance_filter=relevance_filter_from_args(args),
+                                                            clusterer=clusterer_from_args(args),
+                                                            **engine_options_from_args(args))
+        logging.info(f"Processing completed. Results saved to {output_file}")
+        logging.info(f"Failures logged to {failures_file}")
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+    logging.info("Script finished")
@@ -0,0 +1,253 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import unittest
+import numpy as np
+from news_extraction_engine import article_id
+from news_relevance import hashed_counts
+
+VECTOR_INDEX_PATH = 'article_vectors'
+DEFAULT_DIM = 512
+SEARCH_CHUNK_ROWS = 1 << 17
+
+class VectorIndex:
+    """
+    Local embedding index over article text, for cosine top-k queries without any service.
+
+    Articles are embedded with the relevance classifier's hashed unigram and bigram
+    counts, using sublinear tf. The counts are folded into `dim` dimensions with a
+    sign bit per bucket, a signed hashing trick that keeps inner products unbiased.
+    With reduced_dim, an LSA projection is fitted on the first batch added and then
+    applied to everything after it. Rows are L2-normalized, so a dot product is
+    the cosine.
+
+    Vectors are appended to a raw float32 file (<path>.f32) and read back as a
+    memory-mapped matrix. Row metadata goes to <path>.rows.jsonl and the embedding
+    settings to <path>.meta.npz, so the index grows as articles arrive and is
+    never rewritten.
+    """
+
+    def __init__(self, path=VECTOR_INDEX_PATH, dim=DEFAULT_DIM, reduced_dim=None):
+        self.path = path
+        self.dim = dim
+        self.reduced_dim = reduced_dim
+        self.projection = None
+        if os.path.exists(f"{path}.meta.npz"):
+            with np.load(f"{path}.meta.npz") as meta:
+                self.dim = int(meta['dim'])
+                self.projection = meta['projection'] if meta['projection'].size else None
+            self.reduced_dim = self.projection.shape[1] if self.projection is not None else None
+        self.rows = []
+        # Byte length of the complete rows; add truncates a torn tail back to it before appending
+        self.rows_end = 0
+        if os.path.exists(f"{path}.rows.jsonl"):
+            with open(f"{path}.rows.jsonl", 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('unterminated row')
+                        self.rows.append(json.loads(line))
+                    except ValueError:
+                        # A torn final line; its vector is ignored with it
+                        break
+                    self.rows_end += len(line)
+        self.ids = {row['article_id'] for row in self.rows}
+        self.mapped = None
+
+    @property
+    def width(self):
+        return self.reduced_dim or self.dim
+
+    def __len__(self):
+        return len(self.rows)
+
+    def hashed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            counts = hashed_counts(text or '')
+            if not counts:
+                continue
+            buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            signs = np.where((buckets // self.dim) & 1, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[i], buckets % self.dim, signs * weights)
+        return vectors
+
+    def embed(self, texts):
+        """(len(texts), width) float32 unit vectors; empty texts give zero rows."""
+        vectors = self.hashed(texts)
+        if self.projection is not None:
+            vectors = vectors @ self.projection
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def fit_projection(self, texts):
+        """LSA: the top right singular vectors of the first batch's hashed vectors become the projection."""
+        if len(texts) < self.reduced_dim:
+            raise ValueError(f"Need at least {self.reduced_dim} articles to fit a {self.reduced_dim}-dimension "
+                             f"projection, got {len(texts)}")
+        _, _, vt = np.linalg.svd(self.hashed(texts), full_matrices=False)
+        self.projection = np.ascontiguousarray(vt[:self.reduced_dim].T, dtype=np.float32)
+
+    def add(self, articles):
+        """Appends the articles not yet indexed; returns how many were added."""
+        new = [a for a in articles if a.get('content') and article_id(a) not in self.ids]
+        new = list({article_id(a): a for a in new}.values())
+        if not new:
+            return 0
+        if not os.path.exists(f"{self.path}.meta.npz"):
+            if self.reduced_dim:
+                self.fit_projection([a['content'] for a in new])
+            np.savez(f"{self.path}.meta.npz", dim=self.dim,
+                     projection=self.projection if self.projection is not None else np.zeros(0, dtype=np.float32))
+        vectors = self.embed([a['content'] for a in new])
+        # Truncate past a torn write, so row i of the file is always row i of the metadata
+        with open(f"{self.path}.f32", 'ab') as f:
+            f.truncate(len(self.rows) * self.width * 4)
+            f.write(vectors.astype(np.float32).tobytes())
+        with open(f"{self.path}.rows.jsonl", 'ab') as f:
+            f.truncate(self.rows_end)
+            for article in new:
+                row = {'article_id': article_id(article), 'url': article.get('url'),
+                       'timestamp': article.get('timestamp')}
+                line = (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+                f.write(line)
+                self.rows_end += len(line)
+                self.rows.append(row)
+                self.ids.add(row['article_id'])
+        self.mapped = None
+        logging.info(f"Indexed {len(new)} articles; {len(self.rows)} in total")
+        return len(new)
+
+    def matrix(self):
+        if self.mapped is None or len(self.mapped) != len(self.rows):
+            self.mapped = (np.memmap(f"{self.path}.f32", dtype=np.float32, mode='r', shape=(len(self.rows), self.width))
+                           if self.rows else np.zeros((0, self.width), dtype=np.float32))
+        return self.mapped
+
+    def search(self, queries, k=10):
+        """
+        Top-k rows for each query vector, as [(row, cosine), ...] lists best first.
+
+        All queries are scored together one chunk of rows at a time, so memory stays
+        at chunk x queries however large the index grows.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        matrix = self.matrix()
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(matrix), SEARCH_CHUNK_ROWS):
+            scores = queries @ matrix[start:start + SEARCH_CHUNK_ROWS].T
+            keep = min(k, scores.shape[1])
+            top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if best_rows.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return [[(int(best_rows[q, i]), float(best_scores[q, i])) for i in order[q]] for q in range(len(queries))]
+
+    def search_texts(self, texts, k=10):
+        """Rows closest to each text, e.g. an inflection-point narrative; results carry the row metadata."""
+        return [[dict(self.rows[row], score=round(score, 4)) for row, score in hits]
+                for hits in self.search(self.embed(texts), k)]
+
+    def neighbours(self, rows, k=10):
+        """Indexed articles most similar to already indexed rows, leaving out each row itself."""
+        hits = self.search(np.asarray(self.matrix()[rows]), k + 1)
+        return [[dict(self.rows[hit], score=round(score, 4)) for hit, score in row_hits if hit != row][:k]
+                for row, row_hits in zip(rows, hits)]
+
+    def similar_articles(self, articles, k=10):
+        """Rows most similar to each article, leaving out the article itself when it is indexed."""
+        hits = self.search_texts([a.get('content') or '' for a in articles], k + 1)
+        return [[hit for hit in article_hits if hit['article_id'] != article_id(article)][:k]
+                for article, article_hits in zip(articles, hits)]
+
+class TestVectorIndex(unittest.TestCase):
+    """The index must reload what it wrote, and recover from a write torn by a crash."""
+
+    TOPICS = ['oil prices rose after the opec output cut', 'the bank reported record quarterly earnings',
+              'shareholders approved the merger with the rival chipmaker', 'the drug trial met its primary endpoint']
+
+    def articles(self, start, stop):
+        return [{'url': f'https://news.example/{i}', 'content': f'{self.TOPICS[i % 4]} story {i}', 'timestamp': i}
+                for i in range(start, stop)]
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, 'vectors')
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def test_reload_and_search(self):
+        index = VectorIndex(self.path, dim=256)
+        self.assertEqual(index.add(self.articles(0, 8)), 8)
+        self.assertEqual(index.add(self.articles(4, 10)), 2)
+
+        reloaded = VectorIndex(self.path)
+        self.assertEqual((len(reloaded), reloaded.dim), (10, 256))
+        hits = reloaded.search_texts(['opec cut oil output'], k=3)[0]
+        self.assertEqual(hits[0]['url'], 'https://news.example/0')
+        neighbours = reloaded.neighbours([1], k=2)[0]
+        self.assertEqual([hit['url'] for hit in neighbours], ['https://news.example/5', 'https://news.example/9'])
+
+    def test_torn_row_is_dropped_and_index_keeps_growing(self):
+        index = VectorIndex(self.path, dim=256)
+        index.add(self.articles(0, 2))
+        # A crash after the vector was written but mid-way through its row
+        with open(f"{self.path}.f32", 'ab') as f:
+            f.write(np.ones(256, dtype=np.float32).tobytes())
+        with open(f"{self.path}.rows.jsonl", 'a', encoding='utf-8') as f:
+            f.write('{"article_id": "torn", "url": "https://news.exam')
+
+        for stop, expected in [(3, 3), (4, 4)]:
+            index = VectorIndex(self.path)
+            self.assertEqual(len(index), expected - 1)
+            self.assertEqual(index.add(self.articles(expected - 1, stop)), 1)
+            reloaded = VectorIndex(self.path)
+            self.assertEqual(len(reloaded), expected)
+            self.assertEqual(os.path.getsize(f"{self.path}.f32"), expected * 256 * 4)
+            # Row i of the vectors is still article i
+            newest = self.articles(expected - 1, expected)[0]
+            self.assertEqual(reloaded.search_texts([newest['content']], k=1)[0][0]['url'], newest['url'])
+
+    def test_reduced_dimension_projection(self):
+        articles = self.articles(0, 12)
+        index = VectorIndex(self.path, dim=256, reduced_dim=4)
+        index.add(articles)
+        reloaded = VectorIndex(self.path)
+        self.assertEqual((reloaded.width, reloaded.matrix().shape), (4, (12, 4)))
+        self.assertTrue(np.allclose(np.linalg.norm(reloaded.matrix(), axis=1), 1, atol=1e-5))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build or query the local article vector index")
+    parser.add_argument('--index', default=VECTOR_INDEX_PATH, help='Index path prefix')
+    parser.add_argument('--dim', type=int, default=DEFAULT_DIM, help='Hashed dimensions (new index only)')
+    parser.add_argument('--reduced-dim', type=int, default=None,
+                        help='Fit an LSA projection to this many dimensions on the first batch (new index only)')
+    parser.add_argument('--add', metavar='ARTICLES_JSON', help='Index the successful articles of a scrape results file')
+    parser.add_argument('--query', nargs='*', default=[], help='Texts to search for')
+    parser.add_argument('--similar-to', nargs='*', default=[], help='URLs of indexed articles to find neighbours of')
+    parser.add_argument('-k', type=int, default=10, help='Results per query')
+    args = parser.parse_args()
+
+    index = VectorIndex(args.index, args.dim, args.reduced_dim)
+    if args.add:
+        with open(args.add, 'r', encoding='utf-8') as f:
+            articles = json.load(f)['successful_articles']
+        index.add(articles)
+    if args.query:
+        for text, hits in zip(args.query, index.search_texts(args.query, args.k)):
+            print(json.dumps({'query': text, 'results': hits}, indent=2, ensure_ascii=False))
+    if args.similar_to:
+        row_by_url = {row['url']: i for i, row in enumerate(index.rows)}
+        wanted = [url for url in args.similar_to if url in row_by_url]
+        for url, hits in zip(wanted, index.neighbours([row_by_url[url] for url in wanted], args.k)):
+            print(json.dumps({'url': url, 'results': hits}, indent=2, ensure_ascii=False))